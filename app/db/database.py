@@ -1,21 +1,86 @@
-from sqlmodel import Field, SQLModel, String, Column, TEXT
+from sqlmodel import Field, Relationship, SQLModel, String, Column, TEXT
+from sqlalchemy import BigInteger, Index, Text, UniqueConstraint, event, inspect, literal, select
 from typing import Optional
+from datetime import datetime
+
+# Relationships are only loaded on request (see app/internal/expand.py) and
+# never cascade: passive_deletes="all" leaves the foreign keys of children
+# to the database when a parent is deleted, as before.
 
 class DeviceGroup(SQLModel, table=True):
     DG_id: Optional[int] = Field(default=None, index=True, primary_key=True)
     DG_libelle: str = Field(index=True, sa_type=TEXT)
 
+    devices: list["Device"] = Relationship(back_populates="group", passive_deletes="all")
+    packages: list["Package"] = Relationship(back_populates="device_group", passive_deletes="all")
+
+# one row per (ancestor, descendant) pair of nested device groups, each group
+# being its own ancestor at depth 0 (see app/internal/groups.py)
+class DeviceGroupClosure(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_devicegroupclosure_descendant_depth", "DGC_descendant", "DGC_depth"),
+    )
+
+    DGC_ancestor: int = Field(primary_key=True, foreign_key="devicegroup.DG_id")
+    DGC_descendant: int = Field(primary_key=True, foreign_key="devicegroup.DG_id")
+    DGC_depth: int
+
+@event.listens_for(DeviceGroupClosure.__table__, "after_create")
+def add_group_roots(table, connection, **kw):
+    """
+    Make the device groups that predate nesting roots of their own trees.
+    """
+    connection.execute(table.insert().from_select(
+        ["DGC_ancestor", "DGC_descendant", "DGC_depth"],
+        select(DeviceGroup.DG_id, DeviceGroup.DG_id, literal(0)),
+    ))
+
+# a single row, locked by every transaction that changes the tree of device
+# groups, so those changes run one at a time (see app/internal/groups.py)
+class DeviceGroupTreeLock(SQLModel, table=True):
+    DGTL_id: Optional[int] = Field(default=None, primary_key=True)
+
+@event.listens_for(DeviceGroupTreeLock.__table__, "after_create")
+def add_tree_lock(table, connection, **kw):
+    """
+    Insert the lock row.
+    """
+    connection.execute(table.insert().values(DGTL_id=1))
+
 class Device(SQLModel, table=True):
+    __table_args__ = (
+        Index("ft_device_search", "DEV_name", "DEV_os", mariadb_prefix="FULLTEXT"),
+    )
+
     DEV_id: Optional[int] = Field(default=None, index=True, primary_key=True)
     DEV_name: str = Field(index=True, sa_type=TEXT)
     DEV_os: str = Field(index=True, sa_type=TEXT)
     DG_id: int | None = Field(default=None, index=True, foreign_key="devicegroup.DG_id")
 
+    group: Optional[DeviceGroup] = Relationship(back_populates="devices")
+    packages: list["Package"] = Relationship(back_populates="device", passive_deletes="all")
+
+class DeviceToken(SQLModel, table=True):
+    DEV_id: Optional[int] = Field(default=None, index=True, primary_key=True, foreign_key="device.DEV_id", ondelete="CASCADE")
+    DT_tokenHash: str = Field(sa_type=String(64))
+
+class DeviceStatus(SQLModel, table=True):
+    DEV_id: Optional[int] = Field(default=None, index=True, primary_key=True, foreign_key="device.DEV_id", ondelete="CASCADE")
+    DS_lastSeen: datetime = Field(index=True)
+    DS_ip: Optional[str] = Field(default=None, sa_type=String(45))
+    DS_packages: Optional[str] = Field(default=None, sa_type=TEXT)
+
 class PackageGroup(SQLModel, table=True):
     PG_id: Optional[int] = Field(default=None, index=True, primary_key=True)
     PG_libelle: str = Field(index=True, sa_type=TEXT)
 
+    packages: list["Package"] = Relationship(back_populates="package_group", passive_deletes="all")
+
 class Package(SQLModel, table=True):
+    __table_args__ = (
+        Index("ft_package_search", "PACK_name", "PACK_type", mariadb_prefix="FULLTEXT"),
+    )
+
     PACK_id: Optional[int] = Field(default=None, index=True, primary_key=True)
     PACK_name: str = Field(index=True, sa_type=TEXT)
     PACK_type: str = Field(index=True, sa_type=TEXT)
@@ -24,6 +89,126 @@ class Package(SQLModel, table=True):
     DG_id: int | None = Field(default=None, index=True, foreign_key="devicegroup.DG_id")
     PG_id: int | None = Field(default=None, index=True, foreign_key="packagegroup.PG_id")
 
+    device: Optional[Device] = Relationship(back_populates="packages")
+    device_group: Optional[DeviceGroup] = Relationship(back_populates="packages")
+    package_group: Optional[PackageGroup] = Relationship(back_populates="packages")
+
+class PackageVersion(SQLModel, table=True):
+    __table_args__ = (
+        UniqueConstraint("PACK_id", "PV_number"),
+    )
+
+    PV_id: Optional[int] = Field(default=None, primary_key=True)
+    PACK_id: int = Field(index=True, foreign_key="package.PACK_id", ondelete="CASCADE")
+    PV_number: int
+    # SHA-256 of the content, also its name in the blob storage
+    PV_sha256: str = Field(index=True, sa_type=String(64))
+    PV_size: int = Field(sa_type=BigInteger)
+    PV_created: datetime = Field(default_factory=datetime.utcnow)
+
+class DeploymentJob(SQLModel, table=True):
+    DEPJ_id: Optional[int] = Field(default=None, index=True, primary_key=True)
+    DG_id: int | None = Field(default=None, index=True, foreign_key="devicegroup.DG_id")
+    PG_id: int | None = Field(default=None, index=True, foreign_key="packagegroup.PG_id")
+    DEPJ_status: str = Field(default="pending", index=True, sa_type=String(16))
+    DEPJ_waveSize: int = Field(default=50, gt=0)
+    DEPJ_maxInFlight: int = Field(default=20, gt=0)
+    DEPJ_bandwidthLimit: Optional[int] = Field(default=None, gt=0)
+    DEPJ_maxAttempts: int = Field(default=3, gt=0)
+    DEPJ_created: Optional[datetime] = Field(default_factory=datetime.utcnow)
+    DEPJ_updated: Optional[datetime] = Field(default_factory=datetime.utcnow)
+
+class DeploymentTarget(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_deploymenttarget_job_status", "DEPJ_id", "DEPT_status", "DEPT_wave"),
+    )
+
+    DEPJ_id: Optional[int] = Field(default=None, primary_key=True, foreign_key="deploymentjob.DEPJ_id")
+    DEV_id: Optional[int] = Field(default=None, index=True, primary_key=True, foreign_key="device.DEV_id", ondelete="CASCADE")
+    DEPT_wave: int
+    DEPT_status: str = Field(default="waiting", sa_type=String(16))
+    DEPT_attempts: int = 0
+    DEPT_nextAttempt: Optional[datetime] = None
+    DEPT_updated: datetime = Field(default_factory=datetime.utcnow)
+
+# A group deleted in the background: its dependents are detached or removed
+# in batches, each in its own transaction, then the group row itself.
+# DELJ_entity is "devicegroup" or "packagegroup", see app/internal/deletions.py
+class DeletionJob(SQLModel, table=True):
+    DELJ_id: Optional[int] = Field(default=None, primary_key=True)
+    DELJ_entity: str = Field(sa_type=String(32))
+    DELJ_rowId: int = Field(index=True)
+    DELJ_status: str = Field(default="pending", index=True, sa_type=String(16))
+    DELJ_total: int = 0
+    DELJ_done: int = 0
+    DELJ_error: Optional[str] = Field(default=None, sa_type=TEXT)
+    DELJ_user: Optional[str] = Field(default=None, sa_type=String(255))
+    DELJ_created: datetime = Field(default_factory=datetime.utcnow)
+    DELJ_updated: datetime = Field(default_factory=datetime.utcnow)
+
+class ReplicaHeartbeat(SQLModel, table=True):
+    RH_id: Optional[int] = Field(default=None, primary_key=True)
+    RH_tick: int = Field(sa_type=BigInteger)
+
+class ChangeLog(SQLModel, table=True):
+    CL_id: Optional[int] = Field(default=None, index=True, primary_key=True)
+    CL_entity: str = Field(index=True, sa_type=String(32))
+    CL_rowId: int = Field(index=True)
+    CL_op: str = Field(sa_type=String(16))
+    CL_time: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+@event.listens_for(ChangeLog.__table__, "after_create")
+def log_existing_rows(table, connection, **kw):
+    """
+    Log the rows that predate the change log as created, so since=0 reads everything.
+    """
+    existing = inspect(connection)
+    for entity, model, key in (
+        ("devicegroup", DeviceGroup, DeviceGroup.DG_id),
+        ("device", Device, Device.DEV_id),
+        ("packagegroup", PackageGroup, PackageGroup.PG_id),
+        ("package", Package, Package.PACK_id),
+    ):
+        if existing.has_table(model.__tablename__):
+            connection.execute(table.insert().from_select(
+                ["CL_entity", "CL_rowId", "CL_op", "CL_time"],
+                select(literal(entity), key, literal("create"), literal(datetime.utcnow())),
+            ))
+
+class AuditEvent(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_auditevent_user_time", "AE_user", "AE_time"),
+        Index("ix_auditevent_route_time", "AE_route", "AE_time"),
+        Index("ix_auditevent_status_time", "AE_status", "AE_time"),
+    )
+
+    AE_id: Optional[int] = Field(default=None, primary_key=True)
+    AE_time: datetime = Field(index=True)
+    AE_user: Optional[str] = Field(default=None, sa_type=String(255))
+    AE_method: Optional[str] = Field(default=None, sa_type=String(8))
+    AE_route: Optional[str] = Field(default=None, sa_type=String(255))
+    AE_status: Optional[str] = Field(default=None, sa_type=String(16))
+    AE_message: str = Field(sa_type=TEXT)
+
+@event.listens_for(AuditEvent.__table__, "after_create")
+def partition_audit_events(table, connection, **kw):
+    """
+    On MariaDB, partition the new audit table by month of AE_time.
+
+    The partition of the current month is followed by a catch-all one, which
+    app/internal/audit.py splits as months go by.
+    """
+    if connection.dialect.name not in ("mariadb", "mysql"):
+        return
+    today = datetime.utcnow().date()
+    month_end = today.replace(year=today.year + today.month // 12, month=today.month % 12 + 1, day=1)
+    connection.exec_driver_sql(
+        f"ALTER TABLE {table.name} DROP PRIMARY KEY, ADD PRIMARY KEY (AE_id, AE_time) "
+        f"PARTITION BY RANGE (TO_DAYS(AE_time)) ("
+        f"PARTITION p{today:%Y%m} VALUES LESS THAN (TO_DAYS('{month_end}')), "
+        f"PARTITION pmax VALUES LESS THAN MAXVALUE)"
+    )
+
 class User(SQLModel, table=True):
     USER_id: Optional[int] = Field(default=None, index=True, primary_key=True)
     USER_username: str = Field(index=True, sa_type=TEXT)
@@ -31,5 +216,41 @@ class User(SQLModel, table=True):
     USER_type: int = Field(index=True)
     USER_isActive: bool = Field(index=True)
 
+class RefreshToken(SQLModel, table=True):
+    RT_id: Optional[int] = Field(default=None, index=True, primary_key=True)
+    USER_id: int = Field(index=True, foreign_key="user.USER_id", ondelete="CASCADE")
+    RT_family: str = Field(index=True, sa_type=String(32))
+    RT_tokenHash: str = Field(unique=True, sa_type=String(64))
+    RT_expires: datetime = Field(index=True)
+    RT_used: bool = False
+    RT_revoked: bool = False
+
+class RequestProfile(SQLModel, table=True):
+    PROF_id: Optional[int] = Field(default=None, primary_key=True)
+    PROF_time: datetime = Field(index=True)
+    PROF_user: str = Field(sa_type=String(255))
+    PROF_method: str = Field(sa_type=String(8))
+    PROF_route: str = Field(index=True, sa_type=String(255))
+    PROF_statusCode: Optional[int] = None
+    PROF_duration: float
+    PROF_samples: int
+    PROF_queries: int
+    PROF_queryTime: float
+    # JSON: the sampled stacks and the SQL statements, see app/internal/profiling.py
+    PROF_report: str = Field(sa_type=Text(2**32 - 1))
+
 def create_db(engine):
+    """
+    Create the missing tables, then the indexes missing from existing tables.
+
+    Args:
+        engine (Engine): The database engine.
+    """
     SQLModel.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
@@ -1,45 +1,149 @@
-from sqlmodel import Session, create_engine, select
+from sqlmodel import Session, select
 from typing import Annotated
+from functools import lru_cache
 from pydantic import BaseModel
-from fastapi import Depends, HTTPException
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from fastapi import Depends, HTTPException, Request, Response
 from fastapi.security import OAuth2PasswordBearer
-from os import getenv
-from dotenv import load_dotenv
 from .db.database import User
+from .settings import Settings, get_settings
 
-def get_session():
-    with Session(engine) as session:
+SettingsDep = Annotated[Settings, Depends(get_settings)]
+
+def get_engine():
+    """
+    Get the database engine for the current settings, creating it on first use.
+
+    The MariaDB dialect and driver are only imported then, so importing the
+    application does not pay for them until the first query.
+
+    Returns:
+        Engine: The shared database engine.
+    """
+    return _create_engine(get_settings())
+
+def get_replica_engines():
+    """
+    Get the engines of the read replicas listed in DB_REPLICA_URLS, creating them on first use.
+
+    Returns:
+        list[Engine]: The replica engines, empty without replicas.
+    """
+    return _create_replica_engines(get_settings())
+
+@lru_cache
+def _create_engine(settings: Settings):
+    return _engine(settings.sqlalchemy_url, settings)
+
+@lru_cache
+def _create_replica_engines(settings: Settings):
+    return [_engine(url, settings) for url in settings.replica_urls]
+
+def _engine(url: str, settings: Settings):
+    from sqlmodel import create_engine
+    if url.startswith("sqlite"):
+        return create_engine(url, connect_args={"check_same_thread": False})
+    return create_engine(
+        url,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+
+@lru_cache
+def get_pwd_context():
+    """
+    Build the password hashing context on first use.
+
+    Returns:
+        CryptContext: The bcrypt password context.
+    """
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def get_session(response: Response):
+    with Session(get_engine()) as session:
+        # marked on commit, so the client then reads its own writes (see app/internal/replicas.py)
+        session.info["response"] = response
+        yield session
+
+def get_read_session(request: Request):
+    """
+    Get a session for a handler that only reads, on a read replica when one is usable.
+
+    Yields:
+        Session: A session on an up-to-date replica, or on the primary.
+    """
+    from .internal.replicas import replicas, written_at
+    with Session(replicas.engine_for(written_at(request))) as session:
         yield session
 
 SessionDep = Annotated[Session, Depends(get_session)]
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+ReadSessionDep = Annotated[Session, Depends(get_read_session)]
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
-load_dotenv()
-user = getenv('DB_USER')
-password = getenv('DB_PASS')
-host = getenv('DB_HOST')
-dbname = getenv('DB_NAME')
+class TokenData(BaseModel):
+    username: str
 
-engine = create_engine(
-    f"mariadb+mariadbconnector://{user}:{password}@{host}/{dbname}"
-)
+# (secret key, token) -> (username, expiry timestamp) of access tokens already verified
+_verified_tokens = {}
+_VERIFIED_TOKENS_MAX = 10000
 
-SECRET_KEY = getenv('SECRET_KEY')
-ALGORITHM = getenv('ALGORITHM')
-ACCESS_TOKEN_EXPIRE_MINUTES = int(getenv('ACCESS_TOKEN_EXPIRE_MINUTES'))
+def decode_access_token(token: str):
+    """
+    Check the signature and expiry of an access token.
 
-class TokenData(BaseModel):
-    username: str
+    A client sends the same token with every request until it expires, so
+    the result is kept and later requests only pay a dictionary lookup.
+
+    Args:
+        token (str): The JWT token.
 
-def get_current_user(session: SessionDep, token: str = Depends(oauth2_scheme)):
+    Returns:
+        str | None: The username, or None if the token is not valid.
+    """
+    import jwt
+    import time
+    settings = get_settings()
+    key = (settings.secret_key, token)
+    cached = _verified_tokens.get(key)
+    if cached is not None:
+        if cached[1] > time.time():
+            return cached[0]
+        _verified_tokens.pop(key, None)
+    try:
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm], options={"require": ["exp"]})
+    except jwt.PyJWTError:
+        return None
+    username = payload.get("username")
+    if not isinstance(username, str):
+        return None
+    if len(_verified_tokens) >= _VERIFIED_TOKENS_MAX:
+        _verified_tokens.clear()
+    _verified_tokens[key] = (username, payload["exp"])
+    return username
+
+def request_client(request: Request):
+    """
+    The user a request comes from, according to its bearer token.
+
+    Returns:
+        str | None: The username, or None without a valid token.
+    """
+    authorization = request.headers.get("authorization")
+    if not authorization or not authorization.lower().startswith("bearer "):
+        return None
+    return decode_access_token(authorization[7:])
+
+def get_current_user(session: ReadSessionDep, token: str = Depends(oauth2_scheme)):
     """
     Get the current user based on the provided token.
 
+    The user is read from a replica when one is usable, so read-only
+    requests do not touch the primary at all.
+
     Args:
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         token (str): The JWT token.
 
     Returns:
@@ -50,14 +154,10 @@ def get_current_user(session: SessionDep, token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("username")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    username = decode_access_token(token)
+    if username is None:
         raise credentials_exception
+    token_data = TokenData(username=username)
 
     user = session.exec(select(User).where(User.USER_username == token_data.username)).first()
     if user is None:
@@ -0,0 +1,258 @@
+from collections import deque
+from starlette.responses import JSONResponse
+from ..dependencies import decode_access_token
+from ..settings import get_settings
+from .agents import device_tokens
+from .shaping import TokenBucket
+import asyncio
+import math
+import time
+
+# priorities, served in this order when requests queue for a slot
+INTERACTIVE = 0
+AGENT = 1
+ANONYMOUS = 2
+PRIORITIES = {"user": INTERACTIVE, "agent": AGENT}
+
+
+async def principal(scope):
+    """
+    Identify who sends a request, from its credentials.
+
+    A request is only counted as a device's once its X-Device-Token is
+    verified, so a client cannot spread its requests over made-up device IDs
+    or spend the limit of another device. Any other request is keyed on its
+    address.
+
+    Returns:
+        tuple[str, str]: The kind ("user", "agent" or "anonymous") and the identity.
+    """
+    headers = dict(scope["headers"])
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    if authorization.lower().startswith("bearer "):
+        username = decode_access_token(authorization[7:])
+        if username is not None:
+            return "user", username
+    device_id = headers.get(b"x-device-id", b"").decode("latin-1")
+    token = headers.get(b"x-device-token", b"").decode("latin-1")
+    # cache nodes have no device tokens to check against
+    if device_id.isdigit() and token and get_settings().node_mode != "cache":
+        if await device_tokens.verify(int(device_id), token):
+            return "agent", device_id
+    client = scope.get("client")
+    return "anonymous", client[0] if client else "unknown"
+
+
+class RateLimiter:
+    """
+    Token buckets per principal, and per principal and route prefix (RATE_LIMIT_ROUTES).
+
+    A rate of 0 disables the matching bucket.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.limited = 0
+
+    def bucket(self, key, rate: float, burst: float):
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.rate != rate:
+            if len(self.buckets) >= 10000:
+                # forget the buckets refilled long ago, they are full again
+                now = time.monotonic()
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket.last < 60}
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def check(self, kind: str, identity: str, path: str):
+        """
+        Take a token for a request from each bucket it falls under.
+
+        Args:
+            kind (str): The kind of principal.
+            identity (str): The principal.
+            path (str): The request path.
+
+        Returns:
+            float: 0 if the request may go on, else the seconds until it would be allowed.
+        """
+        settings = get_settings()
+        limits = []
+        rate = {"user": settings.rate_limit_user, "agent": settings.rate_limit_agent}.get(kind, settings.rate_limit_anonymous)
+        if rate:
+            limits.append(((kind, identity), rate, max(settings.rate_limit_burst, 1)))
+        for prefix, route_rate in settings.route_rate_limits:
+            if path.startswith(prefix):
+                limits.append(((kind, identity, prefix), route_rate, max(route_rate, 1)))
+        taken = []
+        for key, rate, burst in limits:
+            bucket = self.bucket(key, rate, burst)
+            delay = bucket.reserve(1)
+            if delay > 0:
+                # give back what this request took, it is refused
+                for refunded in taken + [bucket]:
+                    refunded.tokens += 1
+                self.limited += 1
+                return delay
+            taken.append(bucket)
+        return 0.0
+
+
+class ConcurrencyLimiter:
+    """
+    Caps the requests being handled at MAX_CONCURRENT_REQUESTS.
+
+    Requests over the cap queue for a slot, interactive users ahead of
+    agents and agents ahead of anonymous requests, for at most
+    ADMISSION_QUEUE_TIMEOUT seconds. The queue latency is measured as the
+    wait of the oldest queued request: while it exceeds
+    ADMISSION_SHED_LATENCY, new agent and anonymous requests are refused at
+    once instead of making the queue longer.
+    """
+
+    def __init__(self):
+        self.active = 0
+        # per priority: (enqueue time, future) of each waiting request
+        self.waiters = [deque(), deque(), deque()]
+        self.shed = 0
+        self.timed_out = 0
+
+    def queue_latency(self):
+        """
+        How long the oldest queued request has been waiting, in seconds.
+        """
+        now = time.monotonic()
+        return max((now - queue[0][0] for queue in self.waiters if queue), default=0.0)
+
+    async def acquire(self, priority: int):
+        """
+        Wait for a slot.
+
+        Args:
+            priority (int): INTERACTIVE, AGENT or ANONYMOUS.
+
+        Returns:
+            bool: True once the request holds a slot, False if it is refused.
+        """
+        settings = get_settings()
+        if self.active < settings.max_concurrent_requests and not any(self.waiters):
+            self.active += 1
+            return True
+        if priority != INTERACTIVE and self.queue_latency() > settings.admission_shed_latency:
+            self.shed += 1
+            return False
+        waiter = (time.monotonic(), asyncio.get_running_loop().create_future())
+        self.waiters[priority].append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], settings.admission_queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return False
+        except BaseException:
+            # cancelled, e.g. the client went away: hand over a slot it may have just been given
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+        finally:
+            try:
+                self.waiters[priority].remove(waiter)
+            except ValueError:
+                pass
+        return True
+
+    def release(self):
+        """
+        Free a slot, handing it to the next queued request if any.
+        """
+        for queue in self.waiters:
+            while queue:
+                _, future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.active -= 1
+
+    def stats(self):
+        """
+        The slots in use, the queued requests and the refused ones.
+        """
+        return {
+            "active": self.active,
+            "queued": {
+                "interactive": len(self.waiters[INTERACTIVE]),
+                "agents": len(self.waiters[AGENT]),
+                "anonymous": len(self.waiters[ANONYMOUS]),
+            },
+            "queue_latency": round(self.queue_latency(), 3),
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+        }
+
+
+class AdmissionMiddleware:
+    """
+    Refuses requests over their rate limits (429) and admits the others under the concurrency cap (503 when shed).
+
+    Refused requests get a Retry-After header. A request gives its slot back
+    as soon as its response starts, so long downloads and event streams do
+    not hold one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        settings = get_settings()
+        if scope["type"] != "http" or not (
+            settings.max_concurrent_requests or settings.rate_limit_user or settings.rate_limit_agent
+            or settings.rate_limit_anonymous or settings.rate_limit_routes
+        ):
+            return await self.app(scope, receive, send)
+        kind, identity = await principal(scope)
+        delay = rate_limits.check(kind, identity, scope["path"])
+        if delay > 0:
+            return await refuse(429, "Too many requests", delay)(scope, receive, send)
+        if not settings.max_concurrent_requests:
+            return await self.app(scope, receive, send)
+        if not await admission.acquire(PRIORITIES.get(kind, ANONYMOUS)):
+            retry = max(admission.queue_latency(), settings.admission_shed_latency)
+            return await refuse(503, "Server busy", retry)(scope, receive, send)
+
+        released = False
+
+        async def send_releasing(message):
+            nonlocal released
+            if message["type"] == "http.response.start" and not released:
+                released = True
+                admission.release()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_releasing)
+        finally:
+            if not released:
+                admission.release()
+
+
+def refuse(status_code: int, detail: str, retry_after: float):
+    """
+    Build the response refusing a request.
+
+    Returns:
+        JSONResponse: The error, with a Retry-After header in whole seconds.
+    """
+    return JSONResponse({"detail": detail}, status_code=status_code, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def stats():
+    """
+    The state of the admission control.
+
+    Returns:
+        dict: The concurrency limiter state and the number of rate-limited requests.
+    """
+    return {**admission.stats(), "rate_limited": rate_limits.limited}
+
+
+rate_limits = RateLimiter()
+admission = ConcurrencyLimiter()
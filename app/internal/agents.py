@@ -0,0 +1,219 @@
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from ..db.database import Device, DeviceStatus, DeviceToken
+from ..dependencies import get_engine
+from ..settings import get_settings
+import anyio.to_thread
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def hash_device_token(token: str):
+    """
+    Hash a device token for storage.
+
+    Device tokens are long random strings, so a single SHA-256 is enough and
+    keeps each check-in far cheaper than a bcrypt verify.
+
+    Args:
+        token (str): The plain device token.
+
+    Returns:
+        str: The hex digest of the token.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def new_device_token():
+    """
+    Generate a new random device token.
+
+    Returns:
+        tuple[str, str]: The plain token and its hash.
+    """
+    token = secrets.token_urlsafe(32)
+    return token, hash_device_token(token)
+
+
+class DeviceTokenCache:
+    """
+    Caches the token hash of each device so check-ins rarely touch the database.
+
+    A reissued token is picked up once the cached entry expires.
+    """
+
+    def __init__(self):
+        self._hashes = {}
+
+    def _lookup(self, device_id: int):
+        with Session(get_engine()) as session:
+            device_token = session.get(DeviceToken, device_id)
+            return device_token.DT_tokenHash if device_token else None
+
+    async def verify(self, device_id: int, token: str):
+        """
+        Check a device token.
+
+        Args:
+            device_id (int): The device presenting the token.
+            token (str): The plain token.
+
+        Returns:
+            bool: True if the token belongs to the device.
+        """
+        entry = self._hashes.get(device_id)
+        if entry is None or entry[0] < time.monotonic():
+            token_hash = await anyio.to_thread.run_sync(self._lookup, device_id)
+            if len(self._hashes) >= 10000:
+                # the admission control looks up any device ID a client sends
+                now = time.monotonic()
+                self._hashes = {key: cached for key, cached in self._hashes.items() if cached[0] >= now}
+            entry = (time.monotonic() + get_settings().agent_token_cache_ttl, token_hash)
+            self._hashes[device_id] = entry
+        return entry[1] is not None and hmac.compare_digest(entry[1], hash_device_token(token))
+
+    def forget(self, device_id: int):
+        """
+        Drop the cached hash of a device, e.g. after its token was reissued.
+
+        Args:
+            device_id (int): The device ID.
+        """
+        self._hashes.pop(device_id, None)
+
+
+def upsert_statement(session, model, rows: list[dict], key: str):
+    """
+    Build an INSERT that updates the existing rows on primary key conflicts.
+
+    Args:
+        session (Session): The database session.
+        model (SQLModel): The table to write.
+        rows (list[dict]): The rows to write.
+        key (str): The primary key column.
+
+    Returns:
+        Insert: The upsert statement.
+    """
+    columns = [column for column in rows[0] if column != key]
+    dialect = session.get_bind().dialect.name
+    if dialect in ("mariadb", "mysql"):
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(model).values(rows)
+        return statement.on_duplicate_key_update({column: statement.inserted[column] for column in columns})
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(model).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[key],
+        set_={column: statement.excluded[column] for column in columns},
+    )
+
+
+class HeartbeatBuffer:
+    """
+    Collects device check-ins in memory and writes them in batches.
+
+    Repeated check-ins from the same device between two flushes are coalesced
+    into the latest one, so the database sees at most one row write per device
+    per flush interval regardless of how often agents report.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def record(self, device_id: int, ip: str | None, packages: list[str]):
+        """
+        Record a check-in; it is written on the next flush.
+
+        Args:
+            device_id (int): The device checking in.
+            ip (str | None): The address the check-in came from.
+            packages (list[str]): The names of the packages installed on the device.
+        """
+        row = {
+            "DEV_id": device_id,
+            "DS_lastSeen": datetime.utcnow(),
+            "DS_ip": ip,
+            "DS_packages": json.dumps(packages),
+        }
+        with self._lock:
+            self._pending[device_id] = row
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return list(pending.values())
+
+    def _requeue(self, rows: list[dict]):
+        with self._lock:
+            for row in rows:
+                self._pending.setdefault(row["DEV_id"], row)
+
+    def flush(self):
+        """
+        Write the buffered check-ins with one upsert per batch.
+
+        Check-ins from devices deleted in the meantime are dropped. If the
+        database is unavailable the check-ins stay buffered for the next flush.
+
+        Returns:
+            int: The number of device statuses written.
+        """
+        rows = self._drain()
+        if not rows:
+            return 0
+        batch_size = get_settings().heartbeat_batch_size
+        flushed = written = 0
+        try:
+            with Session(get_engine()) as session:
+                for flushed in range(0, len(rows), batch_size):
+                    batch = rows[flushed:flushed + batch_size]
+                    try:
+                        session.exec(upsert_statement(session, DeviceStatus, batch, "DEV_id"))
+                        session.commit()
+                    except IntegrityError:
+                        session.rollback()
+                        existing = set(session.exec(
+                            select(Device.DEV_id).where(Device.DEV_id.in_([row["DEV_id"] for row in batch]))
+                        ).all())
+                        batch = [row for row in batch if row["DEV_id"] in existing]
+                        if batch:
+                            session.exec(upsert_statement(session, DeviceStatus, batch, "DEV_id"))
+                            session.commit()
+                    written += len(batch)
+                flushed = len(rows)
+        except Exception:
+            logger.exception("Heartbeat flush failed, keeping %d check-ins buffered", len(rows) - flushed)
+            self._requeue(rows[flushed:])
+        return written
+
+    async def run(self):
+        """
+        Flush the buffer every HEARTBEAT_FLUSH_INTERVAL seconds until cancelled.
+        """
+        try:
+            while True:
+                await asyncio.sleep(get_settings().heartbeat_flush_interval)
+                await anyio.to_thread.run_sync(self.flush)
+        finally:
+            await anyio.to_thread.run_sync(self.flush)
+
+
+device_tokens = DeviceTokenCache()
+heartbeats = HeartbeatBuffer()
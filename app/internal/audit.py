@@ -0,0 +1,237 @@
+from collections import deque
+from datetime import date, datetime, timedelta
+from sqlalchemy import delete, insert, or_, text
+from sqlmodel import Session, select
+from ..db.database import AuditEvent
+from ..dependencies import get_engine
+from ..settings import get_settings
+import anyio.to_thread
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AuditHandler(logging.Handler):
+    """
+    Buffers the records of the ITAM logger and writes them to AuditEvent in batches.
+
+    Records are only appended to memory on the request path. Above
+    AUDIT_QUEUE_SIZE buffered records, the oldest ones are dropped and counted
+    rather than slowing requests down.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
+        self.dropped = 0
+
+    def emit(self, record):
+        row = {
+            "AE_time": datetime.utcfromtimestamp(record.created),
+            "AE_user": record.current_user,
+            "AE_method": record.method,
+            "AE_route": record.url[:255] if record.url else None,
+            "AE_status": record.status,
+            "AE_message": record.getMessage(),
+        }
+        with self._pending_lock:
+            if len(self._pending) >= get_settings().audit_queue_size:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(row)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def write(self):
+        """
+        Insert the buffered events, AUDIT_BATCH_SIZE rows per statement.
+
+        If the database is unavailable the events stay buffered for the next write.
+
+        Returns:
+            int: The number of events written.
+        """
+        with self._pending_lock:
+            rows, self._pending = list(self._pending), deque()
+        if not rows:
+            return 0
+        batch_size = get_settings().audit_batch_size
+        written = 0
+        try:
+            with Session(get_engine()) as session:
+                for written in range(0, len(rows), batch_size):
+                    session.exec(insert(AuditEvent), params=rows[written:written + batch_size])
+                    session.commit()
+                written = len(rows)
+        except Exception:
+            logger.exception("Audit write failed, keeping %d events buffered", len(rows) - written)
+            with self._pending_lock:
+                self._pending.extendleft(reversed(rows[written:]))
+        return written
+
+    async def run(self):
+        """
+        Write the buffered events every AUDIT_FLUSH_INTERVAL seconds until cancelled.
+        """
+        try:
+            while True:
+                await asyncio.sleep(get_settings().audit_flush_interval)
+                await anyio.to_thread.run_sync(self.write)
+        finally:
+            await anyio.to_thread.run_sync(self.write)
+
+
+def to_days(day: date):
+    """
+    The MariaDB TO_DAYS() of a date.
+    """
+    return day.toordinal() + 365
+
+
+def next_month(day: date):
+    """
+    The first day of the month after the one of a date.
+    """
+    return day.replace(year=day.year + day.month // 12, month=day.month % 12 + 1, day=1)
+
+
+def maintain_partitions(session, cutoff: datetime):
+    """
+    Rotate the monthly partitions of the audit table on MariaDB.
+
+    Splits the partition of next month out of the catch-all one ahead of
+    time, and drops the partitions holding only events older than cutoff,
+    which is much cheaper than deleting their rows.
+
+    Args:
+        session (Session): The database session.
+        cutoff (datetime): Events before it are expired.
+
+    Returns:
+        int: The number of partitions dropped.
+    """
+    if session.get_bind().dialect.name not in ("mariadb", "mysql"):
+        return 0
+    partitions = session.exec(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND PARTITION_NAME IS NOT NULL"
+    ), params={"table": AuditEvent.__tablename__}).all()
+    if not partitions:
+        return 0
+    names = {name for name, _ in partitions}
+    month = next_month(datetime.utcnow().date())
+    if f"p{month:%Y%m}" not in names and "pmax" in names:
+        session.exec(text(
+            f"ALTER TABLE {AuditEvent.__tablename__} REORGANIZE PARTITION pmax INTO ("
+            f"PARTITION p{month:%Y%m} VALUES LESS THAN ({to_days(next_month(month))}), "
+            f"PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        ))
+    expired = [name for name, bound in partitions if bound != "MAXVALUE" and int(bound) <= to_days(cutoff.date())]
+    # the newest partition is kept, so the table always has one below the catch-all
+    expired = sorted(expired)[:len(partitions) - 2]
+    if expired:
+        session.exec(text(f"ALTER TABLE {AuditEvent.__tablename__} DROP PARTITION {', '.join(expired)}"))
+    return len(expired)
+
+
+def purge_events(session, retention_days: int, batch_size: int):
+    """
+    Remove the audit events older than the retention period.
+
+    Whole monthly partitions are dropped on MariaDB; the remaining expired
+    rows are deleted in small batches.
+
+    Args:
+        session (Session): The database session.
+        retention_days (int): How long events are kept.
+        batch_size (int): The number of events deleted per transaction.
+
+    Returns:
+        int: The number of events deleted row by row.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    maintain_partitions(session, cutoff)
+    deleted = 0
+    while True:
+        ids = session.exec(
+            select(AuditEvent.AE_id).where(AuditEvent.AE_time < cutoff).order_by(AuditEvent.AE_time).limit(batch_size)
+        ).all()
+        if not ids:
+            return deleted
+        session.exec(delete(AuditEvent).where(AuditEvent.AE_id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+def parse_cursor(cursor: str):
+    """
+    Read a cursor returned by `search_events`.
+
+    Args:
+        cursor (str): The cursor, "<AE_time>,<AE_id>" of the last event of a page.
+
+    Returns:
+        tuple[datetime, int]: The time and ID of that event.
+
+    Raises:
+        ValueError: The cursor is malformed.
+    """
+    time, _, event_id = cursor.rpartition(",")
+    return datetime.fromisoformat(time), int(event_id)
+
+
+def search_events(session, conditions: list, cursor: tuple[datetime, int] | None, limit: int):
+    """
+    Read the audit events matching conditions, newest first.
+
+    Pages follow (AE_time, AE_id), so the (column, AE_time) indexes serve
+    both the filter and the order, and on MariaDB only the partitions of
+    the months read are scanned.
+
+    Args:
+        session (Session): The database session.
+        conditions (list): WHERE clauses on AuditEvent.
+        cursor (tuple[datetime, int] | None): The parsed cursor of the previous page, None for the first one.
+        limit (int): The maximum number of events.
+
+    Returns:
+        tuple[list[AuditEvent], str | None]: The events and the cursor of the next page, None on the last one.
+    """
+    if cursor is not None:
+        time, event_id = cursor
+        conditions = [
+            *conditions,
+            AuditEvent.AE_time <= time,
+            or_(AuditEvent.AE_time < time, AuditEvent.AE_id < event_id),
+        ]
+    events = session.exec(
+        select(AuditEvent).where(*conditions).order_by(AuditEvent.AE_time.desc(), AuditEvent.AE_id.desc()).limit(limit + 1)
+    ).all()
+    if len(events) > limit:
+        last = events[limit - 1]
+        return events[:limit], f"{last.AE_time.isoformat()},{last.AE_id}"
+    return events, None
+
+
+async def purge_periodically():
+    """
+    Purge the expired audit events every AUDIT_PURGE_INTERVAL seconds until cancelled.
+    """
+    def purge():
+        settings = get_settings()
+        with Session(get_engine()) as session:
+            return purge_events(session, settings.audit_retention_days, 1000)
+
+    while True:
+        try:
+            await anyio.to_thread.run_sync(purge)
+        except Exception:
+            logger.exception("Purging the audit events failed")
+        await asyncio.sleep(get_settings().audit_purge_interval)
+
+
+audit_events = AuditHandler()
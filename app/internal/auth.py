@@ -1,17 +1,17 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, Query, status, APIRouter
-from fastapi.responses import RedirectResponse
+from fastapi import Request, Depends, HTTPException, APIRouter
 from typing import Annotated
 from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime, timedelta
-from jose import JWTError, jwt
+from sqlalchemy import delete, update
 from sqlmodel import select
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from ..db.database import User, DeviceGroup
-from ..dependencies import SessionDep, pwd_context, oauth2_scheme, get_current_user, ALGORITHM, SECRET_KEY, ACCESS_TOKEN_EXPIRE_MINUTES, TokenData
+from fastapi.security import OAuth2PasswordRequestForm
+from ..db.database import RefreshToken, User
+from ..dependencies import SessionDep, get_pwd_context, get_current_user
+from ..settings import get_settings
 from ..internal.logger import logger
-from ..db.database import User, User
-from requests import get
+import hashlib
+import secrets
 
 router = APIRouter(
     prefix="/auth",
@@ -22,6 +22,10 @@ router = APIRouter(
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 def verify_password(plain_password, hashed_password):
@@ -35,7 +39,7 @@ def verify_password(plain_password, hashed_password):
     Returns:
         bool: True if the passwords match, False otherwise.
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     """
@@ -47,7 +51,7 @@ def get_password_hash(password):
     Returns:
         str: The hashed password.
     """
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """
@@ -60,15 +64,73 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     Returns:
         str: The encoded JWT token.
     """
+    import jwt
+    settings = get_settings()
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        expire = datetime.utcnow() + timedelta(minutes=settings.access_token_expire_minutes)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
     return encoded_jwt
 
+def hash_refresh_token(token: str):
+    """
+    Hash a refresh token for storage.
+
+    Refresh tokens are long random strings, so a single SHA-256 is enough and
+    renewing a session costs no bcrypt verify.
+
+    Args:
+        token (str): The plain refresh token.
+
+    Returns:
+        str: The hex digest of the token.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_tokens(session: SessionDep, user: User, family: Optional[str] = None):
+    """
+    Create an access token and a refresh token for a user.
+
+    The refresh token is stored hashed. Every token rotated from the same
+    login shares its family, so a reused token can revoke them all.
+
+    Args:
+        session (SessionDep): The database session, committed here.
+        user (User): The user.
+        family (Optional[str]): The family of the rotated token, or None for a new login.
+
+    Returns:
+        dict: The Token fields.
+    """
+    settings = get_settings()
+    refresh_token = secrets.token_urlsafe(32)
+    session.add(RefreshToken(
+        USER_id=user.USER_id,
+        RT_family=family or secrets.token_hex(16),
+        RT_tokenHash=hash_refresh_token(refresh_token),
+        RT_expires=datetime.utcnow() + timedelta(days=settings.refresh_token_expire_days),
+    ))
+    session.commit()
+    access_token = create_access_token(
+        data={"username": user.USER_username},
+        expires_delta=timedelta(minutes=settings.access_token_expire_minutes),
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+def revoke_family(session: SessionDep, family: str):
+    """
+    Revoke every refresh token of a family.
+
+    Args:
+        session (SessionDep): The database session, committed here.
+        family (str): The family.
+    """
+    session.exec(update(RefreshToken).where(RefreshToken.RT_family == family).values(RT_revoked=True))
+    session.commit()
+
 def verify_access(requiredAccountNumber: int, currentAccountNumber):
     """
     Verify if the current user has the required access level.
@@ -77,11 +139,8 @@ def verify_access(requiredAccountNumber: int, currentAccountNumber):
         requiredAccountNumber (int): The required access level.
         currentAccountNumber (int): The access level of the current user
     """
-    currentUser = get("http://127.0.0.1:8000/auth/me")
     if currentAccountNumber > requiredAccountNumber:
-        raise HTTPException(status_code=400, detail="not enough rights") 
-    
-
+        raise HTTPException(status_code=400, detail="not enough rights")
 
 
 @router.post("/login", response_model=Token)
@@ -102,21 +161,82 @@ def login(session: SessionDep, request: Request, form_data: Annotated[OAuth2Pass
             'method': request.method,
             'url': request.url.path,
             'status': 'fail',
-            'user': form_data.username
+            'current_user': form_data.username
         })
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"username": user.USER_username},
-        expires_delta=access_token_expires,
-    )
+    # expired refresh tokens of the user are no longer needed for reuse detection
+    session.exec(delete(RefreshToken).where(RefreshToken.USER_id == user.USER_id, RefreshToken.RT_expires < datetime.utcnow()))
+    tokens = issue_tokens(session, user)
     logger.warning("Login successful", extra={
         'method': request.method,
         'url': request.url.path,
-        'status': 'fail',
-        'user': form_data.username
+        'status': 'success',
+        'current_user': form_data.username
     })
-    return {"access_token": access_token, "token_type": "bearer"}
+    return tokens
+
+@router.post("/refresh", response_model=Token)
+def refresh(session: SessionDep, request: Request, body: RefreshRequest):
+    """
+    Exchange a refresh token for a new access token and a new refresh token.
+
+    Each refresh token can be used once. Presenting one that was already
+    used means it leaked, so its whole family is revoked and the user has to
+    log in again.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        body (RefreshRequest): The refresh token.
+
+    Returns:
+        Token: The new tokens.
+    """
+    credentials_exception = HTTPException(
+        status_code=401,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    token = session.exec(select(RefreshToken).where(RefreshToken.RT_tokenHash == hash_refresh_token(body.refresh_token))).first()
+    if not token or token.RT_revoked or token.RT_expires < datetime.utcnow():
+        raise credentials_exception
+    user = session.get(User, token.USER_id)
+    if not user:
+        raise credentials_exception
+    # only one of two concurrent uses of the same token can flip RT_used
+    result = session.exec(
+        update(RefreshToken).where(RefreshToken.RT_id == token.RT_id, RefreshToken.RT_used.is_(False)).values(RT_used=True)
+    )
+    if result.rowcount != 1:
+        revoke_family(session, token.RT_family)
+        logger.warning("Refresh token reused, session revoked.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': user.USER_username
+        })
+        raise credentials_exception
+    return issue_tokens(session, user, token.RT_family)
+
+@router.post("/logout")
+def logout(session: SessionDep, request: Request, body: RefreshRequest):
+    """
+    Revoke a refresh token and every token rotated from the same login.
+
+    Access tokens already issued stay valid until they expire.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        body (RefreshRequest): The refresh token.
+
+    Returns:
+        Dict: A message confirming the logout.
+    """
+    token = session.exec(select(RefreshToken).where(RefreshToken.RT_tokenHash == hash_refresh_token(body.refresh_token))).first()
+    if token:
+        revoke_family(session, token.RT_family)
+    return {"detail": "Logged out successfully"}
 
 @router.get("/me", response_model=User)
 def get_me(current_user: User = Depends(get_current_user)):
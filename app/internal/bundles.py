@@ -0,0 +1,135 @@
+from fastapi.responses import StreamingResponse
+from ..settings import get_settings
+from .shaping import downloads
+from .storage import get_storage
+import logging
+import shutil
+import tempfile
+import zipfile as zf
+
+logger = logging.getLogger(__name__)
+
+
+def iter_file(file, chunk_size: int):
+    """
+    Read a file object chunk by chunk, closing it at the end.
+
+    Args:
+        file: The file object, positioned at the start.
+        chunk_size (int): The size of each chunk.
+
+    Yields:
+        bytes: The file content.
+    """
+    try:
+        while chunk := file.read(chunk_size):
+            yield chunk
+    finally:
+        file.close()
+
+
+def manifest(filenames):
+    """
+    Describe deploy files by name, size and content hash.
+
+    Files of packages that were never uploaded are left out, so one such
+    package does not break the downloads and prefetches of its whole group.
+
+    Args:
+        filenames (List[str]): The names of the stored files.
+
+    Returns:
+        list[dict]: One {"name", "size", "sha256"} entry per stored file.
+    """
+    storage = get_storage()
+    entries = []
+    for name in filenames:
+        try:
+            entries.append({"name": name, "size": storage.size(name), "sha256": storage.digest(name)})
+        except FileNotFoundError:
+            logger.warning("Package file %s not found, left out of the manifest", name)
+    return entries
+
+
+def zip_response(entries, client: str, group: int = None):
+    """
+    Create a zip archive from files read one after the other.
+
+    The archive is written to a temporary file that only stays in memory
+    while it is smaller than BUNDLE_SPOOL_SIZE, then streamed in chunks
+    shaped by the download rate limits.
+
+    Args:
+        entries (List[tuple[str, int, Callable]]): The name in the archive, the size and a
+            function opening each file.
+        client (str): The client downloading the archive, for its rate limit.
+        group (int): The device group the archive is for, for its rate limit.
+
+    Returns:
+        StreamingResponse: The zip archive as a streaming response.
+    """
+    settings = get_settings()
+    archive = tempfile.SpooledTemporaryFile(max_size=settings.bundle_spool_size)
+    with zf.ZipFile(archive, mode='w', compression=zf.ZIP_DEFLATED, compresslevel=settings.zip_compression_level) as temp_zip:
+        for name, file_size, open_file in entries:
+            with open_file() as source, temp_zip.open(name, "w", force_zip64=file_size > zf.ZIP64_LIMIT) as target:
+                shutil.copyfileobj(source, target, settings.download_chunk_size)
+    size = archive.tell()
+    archive.seek(0)
+    return StreamingResponse(
+        downloads.shape(iter_file(archive, settings.download_chunk_size), client, group),
+        media_type="application/x-zip-compressed",
+        headers = {"Content-Disposition": "attachment; filename=archive.zip", "Content-Length": str(size)}
+    )
+
+
+def zipfiles(filenames, client: str, group: int = None):
+    """
+    Create a zip archive from a list of stored filenames.
+
+    Files that were never uploaded are left out, as in `manifest`.
+
+    Args:
+        filenames (List[str]): The list of filenames to include in the zip archive.
+        client (str): The client downloading the archive, for its rate limit.
+        group (int): The device group the archive is for, for its rate limit.
+
+    Returns:
+        StreamingResponse: The zip archive as a streaming response.
+    """
+    storage = get_storage()
+    entries = []
+    for name in filenames:
+        try:
+            entries.append((name, storage.size(name), lambda name=name: storage.open(name)))
+        except FileNotFoundError:
+            logger.warning("Package file %s not found, left out of the archive", name)
+    return zip_response(entries, client, group)
+
+
+def file_response(file, size: int, name: str, digest: str, client: str, group: int = None, headers: dict = None):
+    """
+    Stream one file, shaped by the download rate limits.
+
+    Args:
+        file: The file object, positioned at the start; closed at the end.
+        size (int): The size of the file.
+        name (str): The file name sent to the client.
+        digest (str): The SHA-256 of the file, sent as its ETag.
+        client (str): The client downloading the file, for its rate limit.
+        group (int): The device group of the client, for its rate limit.
+        headers (dict): More response headers.
+
+    Returns:
+        StreamingResponse: The file as a streaming response.
+    """
+    return StreamingResponse(
+        downloads.shape(iter_file(file, get_settings().download_chunk_size), client, group),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}"',
+            "Content-Length": str(size),
+            "ETag": f'"{digest}"',
+            **(headers or {}),
+        }
+    )
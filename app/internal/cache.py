@@ -0,0 +1,53 @@
+import threading
+import time
+
+
+class TTLCache:
+    """
+    A small thread-safe in-process cache whose entries expire after a fixed time.
+
+    Only one caller computes a missing or expired entry; concurrent callers
+    for the same key wait for it instead of running the same query.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, ttl: float, factory):
+        """
+        Get the cached value for a key, computing it with factory if needed.
+
+        Args:
+            key: The cache key.
+            ttl (float): How long a computed value stays valid, in seconds.
+            factory (Callable[[], Any]): Computes the value.
+
+        Returns:
+            Any: The cached or freshly computed value.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            value = factory()
+            self._entries[key] = (time.monotonic() + ttl, value)
+            return value
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or every entry when no key is given.
+
+        Args:
+            key: The cache key to drop.
+        """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
@@ -0,0 +1,374 @@
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from fastapi import HTTPException
+from ..settings import get_settings
+import anyio.to_thread
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# request headers that carry the caller's credentials to the primary
+FORWARDED_HEADERS = ("authorization", "x-device-id", "x-device-token")
+
+
+class BlobCache:
+    """
+    A size-bounded LRU disk cache of package files, keyed by their SHA-256.
+
+    Blobs live in CACHE_DIRECTORY/<first two hex digits>/<sha256>. Their
+    modification time records their last use, so the LRU order survives a
+    restart. Blobs in use by a response are pinned and never evicted.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pins = Counter()
+        self.names = {}
+        self.lock = threading.Lock()
+        # key -> [lock, number of threads holding or waiting for it]
+        self.fetch_locks = {}
+        self.loaded = False
+
+    def path(self, digest: str):
+        """
+        The path of a blob in the cache directory.
+        """
+        return os.path.join(get_settings().cache_directory, digest[:2], digest)
+
+    def load(self):
+        """
+        Index the blobs already on disk, least recently used first.
+        """
+        with self.lock:
+            if self.loaded:
+                return
+            found = []
+            for root, _, files in os.walk(get_settings().cache_directory):
+                for name in files:
+                    if len(name) == 64 and not name.startswith("tmp"):
+                        stat = os.stat(os.path.join(root, name))
+                        found.append((stat.st_mtime, name, stat.st_size))
+            for _, digest, size in sorted(found):
+                self.entries[digest] = size
+                self.size += size
+            self.loaded = True
+
+    def get(self, digest: str):
+        """
+        Look a blob up, marking it as recently used.
+
+        Args:
+            digest (str): The SHA-256 of the blob.
+
+        Returns:
+            str | None: The path of the blob, or None if it is not cached.
+        """
+        self.load()
+        with self.lock:
+            if digest not in self.entries:
+                return None
+            self.entries.move_to_end(digest)
+        path = self.path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.entries.pop(digest, 0)
+            return None
+        return path
+
+    def add(self, digest: str, temp_path: str, size: int):
+        """
+        Move a downloaded file into the cache, evicting old blobs if it is full.
+
+        Args:
+            digest (str): The verified SHA-256 of the file.
+            temp_path (str): The downloaded file, in the cache directory.
+            size (int): Its size.
+        """
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        with self.lock:
+            if digest not in self.entries:
+                self.size += size
+            self.entries[digest] = size
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used blobs until the cache fits CACHE_MAX_BYTES.
+        Must be called with the lock held.
+        """
+        max_bytes = get_settings().cache_max_bytes
+        for digest in list(self.entries):
+            if self.size <= max_bytes:
+                return
+            if self.pins[digest]:
+                continue
+            self.size -= self.entries.pop(digest)
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def pinned(self, digests):
+        """
+        Protect blobs from eviction while they are read.
+
+        Args:
+            digests (list[str]): The SHA-256 of the blobs.
+        """
+        with self.lock:
+            self.pins.update(digests)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pins.subtract(digests)
+                self.pins += Counter()
+
+    def fetch(self, name: str, digest: str, headers: dict):
+        """
+        Make sure a file is cached, downloading it from the primary if needed.
+
+        Concurrent requests for the same blob wait for one download instead of
+        crossing the WAN several times.
+
+        Args:
+            name (str): The file name on the primary.
+            digest (str): The expected SHA-256.
+            headers (dict): The credentials forwarded to the primary.
+
+        Returns:
+            str: The path of the cached blob.
+        """
+        path = self.get(digest)
+        if path is not None:
+            return path
+        with self.single_flight(digest):
+            path = self.get(digest)
+            if path is None:
+                with upstream.stream(f"/files/{name}", headers) as response:
+                    path = self.store(name, response, digest)
+        return path
+
+    def revalidate(self, name: str, headers: dict):
+        """
+        Get a file by name, checking with the primary that the cached copy is current.
+
+        The primary answers 304 without a body when the cached SHA-256 still
+        matches, so only changed or missing files are downloaded.
+
+        Args:
+            name (str): The file name on the primary.
+            headers (dict): The credentials forwarded to the primary.
+
+        Returns:
+            tuple[str, str]: The path and the SHA-256 of the cached blob.
+        """
+        with self.single_flight(name):
+            digest = self.names.get(name)
+            if digest is not None and self.get(digest) is not None:
+                headers = {**headers, "if-none-match": f'"{digest}"'}
+            with upstream.stream(f"/files/{name}", headers) as response:
+                if response.status_code == 304:
+                    path = self.get(digest)
+                    if path is not None:
+                        return path, digest
+                    headers.pop("if-none-match")
+                else:
+                    path = self.store(name, response)
+                    return path, self.names[name]
+            with upstream.stream(f"/files/{name}", headers) as response:
+                path = self.store(name, response)
+                return path, self.names[name]
+
+    @contextmanager
+    def single_flight(self, key):
+        """
+        Let one thread at a time download a given file.
+
+        The lock of a key is shared by every thread waiting for it and only
+        dropped by the last one, so a late caller cannot start a second download.
+        """
+        with self.lock:
+            entry = self.fetch_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.fetch_locks[key]
+
+    def store(self, name: str, response, digest: str = None):
+        """
+        Write a file sent by the primary into the cache, verifying its SHA-256.
+
+        Args:
+            name (str): The file name on the primary.
+            response (httpx.Response): The streamed response of `/files/{name}`.
+            digest (str): The expected SHA-256, defaults to the ETag of the response.
+
+        Returns:
+            str: The path of the cached blob.
+        """
+        directory = get_settings().cache_directory
+        os.makedirs(directory, exist_ok=True)
+        expected = digest or response.headers.get("etag", "").strip('"')
+        hasher = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=directory, prefix="tmp", delete=False) as file:
+            try:
+                for chunk in response.iter_bytes(get_settings().download_chunk_size):
+                    hasher.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                os.remove(file.name)
+                raise
+        if hasher.hexdigest() != expected:
+            os.remove(file.name)
+            logger.error("Checksum mismatch for %s from upstream", name)
+            raise HTTPException(status_code=502, detail="Upstream file does not match its checksum")
+        self.add(expected, file.name, size)
+        self.names[name] = expected
+        return self.path(expected)
+
+
+class Upstream:
+    """
+    The HTTP client a cache node uses to reach the primary at UPSTREAM_URL.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+
+            settings = get_settings()
+            self._client = httpx.Client(base_url=settings.upstream_url, timeout=settings.upstream_timeout)
+        return self._client
+
+    def check(self, response):
+        """
+        Pass errors of the primary on to the client, e.g. a 401 for bad credentials.
+        """
+        if response.status_code >= 400:
+            response.read()
+            try:
+                detail = response.json().get("detail", response.text)
+            except ValueError:
+                detail = response.text
+            raise HTTPException(status_code=response.status_code, detail=detail)
+        return response
+
+    def request(self, method: str, path: str, headers: dict, **kwargs):
+        """
+        Send a request to the primary.
+
+        Raises:
+            HTTPException: 502 if the primary cannot be reached, or its own error.
+        """
+        import httpx
+
+        try:
+            return self.check(self.client.request(method, path, headers=headers, **kwargs))
+        except httpx.HTTPError as error:
+            logger.error("Upstream request %s %s failed: %s", method, path, error)
+            raise HTTPException(status_code=502, detail="Upstream unavailable")
+
+    @contextmanager
+    def stream(self, path: str, headers: dict):
+        """
+        Stream a response of the primary.
+
+        Raises:
+            HTTPException: 502 if the primary cannot be reached, or its own error.
+        """
+        import httpx
+
+        try:
+            with self.client.stream("GET", path, headers=headers) as response:
+                yield self.check(response)
+        except httpx.HTTPError as error:
+            logger.error("Upstream request GET %s failed: %s", path, error)
+            raise HTTPException(status_code=502, detail="Upstream unavailable")
+
+    def login(self):
+        """
+        Log in with UPSTREAM_USERNAME and UPSTREAM_PASSWORD.
+
+        Returns:
+            dict: The Authorization header to send.
+        """
+        settings = get_settings()
+        token = self.request("POST", "/auth/login", {}, data={
+            "username": settings.upstream_username,
+            "password": settings.upstream_password,
+        }).json()["access_token"]
+        return {"authorization": f"Bearer {token}"}
+
+
+def forwarded_headers(request):
+    """
+    The credentials of a request, to authorise it against the primary.
+
+    Args:
+        request (Request): The request sent to the cache node.
+
+    Returns:
+        dict: The headers to forward.
+    """
+    return {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+
+
+def prefetch():
+    """
+    Cache the files of the packages of every CACHE_PREFETCH_GROUPS device group.
+
+    Returns:
+        int: The number of files downloaded.
+    """
+    settings = get_settings()
+    if not settings.prefetch_groups:
+        return 0
+    headers = upstream.login() if settings.upstream_username else {}
+    fetched = 0
+    for group in settings.prefetch_groups:
+        for entry in upstream.request("GET", f"/devicegroups/{group}/manifest", headers).json()["files"]:
+            if blobs.get(entry["sha256"]) is None:
+                blobs.fetch(entry["name"], entry["sha256"], headers)
+                fetched += 1
+    return fetched
+
+
+async def prefetch_periodically():
+    """
+    Prefetch every CACHE_PREFETCH_INTERVAL seconds until cancelled.
+    """
+    while True:
+        try:
+            fetched = await anyio.to_thread.run_sync(prefetch)
+            if fetched:
+                logger.info("Prefetched %d files", fetched)
+        except Exception:
+            logger.exception("Prefetching from upstream failed")
+        await asyncio.sleep(get_settings().cache_prefetch_interval)
+
+
+blobs = BlobCache()
+upstream = Upstream()
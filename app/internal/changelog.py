@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, literal
+from sqlmodel import Session, select
+from ..db.database import ChangeLog, Device, DeviceGroup, Package, PackageGroup
+from ..dependencies import get_engine
+from ..settings import get_settings
+import anyio.to_thread
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# entity name -> (model, primary key column)
+ENTITIES = {
+    "device": (Device, Device.DEV_id),
+    "devicegroup": (DeviceGroup, DeviceGroup.DG_id),
+    "package": (Package, Package.PACK_id),
+    "packagegroup": (PackageGroup, PackageGroup.PG_id),
+}
+
+
+def record_change(session, entity: str, row_id: int, op: str):
+    """
+    Add a change log entry to the session, so it is committed with the change itself.
+
+    Args:
+        session (Session): The database session holding the change.
+        entity (str): The changed entity, a key of ENTITIES.
+        row_id (int): The primary key of the changed row.
+        op (str): "create", "update" or "delete".
+    """
+    session.add(ChangeLog(CL_entity=entity, CL_rowId=row_id, CL_op=op))
+
+
+def record_bulk_change(session, entity: str, conditions: list, op: str = "update"):
+    """
+    Log a change for every row matching conditions with one INSERT ... SELECT.
+
+    Must run in the same transaction as the bulk statement, before it if the
+    statement changes the columns used by conditions.
+
+    Args:
+        session (Session): The database session holding the change.
+        entity (str): The changed entity, a key of ENTITIES.
+        conditions (list): The WHERE clauses of the bulk statement.
+        op (str): The operation applied to the rows.
+    """
+    model, key = ENTITIES[entity]
+    session.exec(
+        insert(ChangeLog).from_select(
+            ["CL_entity", "CL_rowId", "CL_op", "CL_time"],
+            select(literal(entity), key, literal(op), literal(datetime.utcnow())).where(*conditions),
+        )
+    )
+
+
+def read_changes(session, since: int, limit: int):
+    """
+    Read the changes made after a cursor, with the current state of each changed row.
+
+    Several changes to the same row collapse into the latest one. Rows that no
+    longer exist are returned as tombstones: op "delete" and no data.
+
+    Entry IDs are handed out when a transaction writes, not when it commits,
+    so a missing ID may still show up. Reading stops before such a gap until
+    the entries after it are CHANGELOG_SETTLE_TIME seconds old; an older gap
+    is a transaction that rolled back.
+
+    Args:
+        session (Session): The database session.
+        since (int): The cursor returned by the previous call, or by `settled_cursor`.
+        limit (int): The maximum number of change log entries to read.
+
+    Returns:
+        tuple[list[dict], int, bool]: The changes, the next cursor and whether more changes are waiting.
+    """
+    entries = session.exec(
+        select(ChangeLog).where(ChangeLog.CL_id > since).order_by(ChangeLog.CL_id).limit(limit + 1)
+    ).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    recent = datetime.utcnow() - timedelta(seconds=get_settings().changelog_settle_time)
+    expected = since + 1
+    for index, entry in enumerate(entries):
+        if entry.CL_id != expected and entry.CL_time > recent:
+            entries, has_more = entries[:index], False
+            break
+        expected = entry.CL_id + 1
+    latest = {}
+    for entry in entries:
+        latest.pop((entry.CL_entity, entry.CL_rowId), None)
+        latest[(entry.CL_entity, entry.CL_rowId)] = entry
+
+    rows = {}
+    for entity, (model, key) in ENTITIES.items():
+        ids = [row_id for (name, row_id), entry in latest.items() if name == entity and entry.CL_op != "delete"]
+        if ids:
+            for row in session.exec(select(model).where(key.in_(ids))).all():
+                rows[(entity, getattr(row, key.key))] = row
+
+    changes = []
+    for (entity, row_id), entry in latest.items():
+        row = rows.get((entity, row_id))
+        changes.append({
+            "entity": entity,
+            "id": row_id,
+            "op": entry.CL_op if row is not None else "delete",
+            "version": entry.CL_id,
+            "data": row.model_dump() if row is not None else None,
+        })
+    cursor = entries[-1].CL_id if entries else since
+    return changes, cursor, has_more
+
+
+def settled_cursor(session):
+    """
+    A cursor to follow the changes from, taken before reading the current rows.
+
+    Every entry up to it is committed or rolled back, see `read_changes`.
+    Changes made while the rows are read come again after it, and apply as
+    the same current data.
+
+    Returns:
+        int: The cursor.
+    """
+    recent = datetime.utcnow() - timedelta(seconds=get_settings().changelog_settle_time)
+    return session.exec(select(func.max(ChangeLog.CL_id)).where(ChangeLog.CL_time <= recent)).one() or 0
+
+
+def oldest_change(session):
+    """
+    Get the oldest change log entry still kept.
+
+    Returns:
+        int | None: Its ID, or None if nothing was ever logged.
+    """
+    return session.exec(select(func.min(ChangeLog.CL_id))).one()
+
+
+def purge_changes(session, retention_days: int, batch_size: int):
+    """
+    Delete change log entries older than the retention period, in small batches.
+
+    The newest entry is always kept, so the oldest kept entry tells how far
+    back cursors remain valid.
+
+    Args:
+        session (Session): The database session.
+        retention_days (int): How long entries are kept.
+        batch_size (int): The number of entries deleted per transaction.
+
+    Returns:
+        int: The number of entries deleted.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    newest = session.exec(select(func.max(ChangeLog.CL_id))).one()
+    if newest is None:
+        return 0
+    deleted = 0
+    while True:
+        ids = session.exec(
+            select(ChangeLog.CL_id).where(ChangeLog.CL_time < cutoff, ChangeLog.CL_id < newest)
+            .order_by(ChangeLog.CL_id).limit(batch_size)
+        ).all()
+        if not ids:
+            return deleted
+        session.exec(delete(ChangeLog).where(ChangeLog.CL_id.in_(ids)))
+        session.commit()
+        deleted += len(ids)
+
+
+async def purge_periodically():
+    """
+    Purge the expired change log entries every CHANGELOG_PURGE_INTERVAL seconds until cancelled.
+    """
+    def purge():
+        settings = get_settings()
+        with Session(get_engine()) as session:
+            return purge_changes(session, settings.changelog_retention_days, 1000)
+
+    while True:
+        try:
+            await anyio.to_thread.run_sync(purge)
+        except Exception:
+            logger.exception("Purging the change log failed")
+        await asyncio.sleep(get_settings().changelog_purge_interval)
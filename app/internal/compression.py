@@ -0,0 +1,208 @@
+from functools import lru_cache
+from starlette.datastructures import Headers, MutableHeaders
+from ..settings import get_settings
+import zlib
+
+
+class GzipEncoder:
+    """
+    gzip, understood by every client.
+    """
+
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    """
+    brotli, smaller than gzip at a similar cost. Requires brotli.
+    """
+
+    def __init__(self, quality: int):
+        import brotli
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdEncoder:
+    """
+    zstd, the fastest of the three for a given ratio. Requires zstandard.
+    """
+
+    def __init__(self, level: int):
+        import zstandard
+        self.zstandard = zstandard
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(self.zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# Content-Encoding -> (encoder, optional module it needs)
+ENCODERS = {
+    "zstd": (ZstdEncoder, "zstandard"),
+    "br": (BrotliEncoder, "brotli"),
+    "gzip": (GzipEncoder, None),
+}
+
+
+@lru_cache
+def available_encodings():
+    """
+    The encodings whose optional module is installed.
+
+    Returns:
+        set[str]: The Content-Encoding names.
+    """
+    available = set()
+    for name, (_, module) in ENCODERS.items():
+        try:
+            if module:
+                __import__(module)
+        except ImportError:
+            continue
+        available.add(name)
+    return available
+
+
+def encoder(name: str):
+    """
+    A new encoder for one response, at the configured level.
+
+    Args:
+        name (str): The Content-Encoding.
+
+    Returns:
+        GzipEncoder | BrotliEncoder | ZstdEncoder: The encoder.
+    """
+    settings = get_settings()
+    level = {
+        "zstd": settings.compression_zstd_level,
+        "br": settings.compression_brotli_quality,
+        "gzip": settings.compression_gzip_level,
+    }[name]
+    return ENCODERS[name][0](level)
+
+
+def negotiate(accept_encoding: str):
+    """
+    Choose the encoding of a response from the Accept-Encoding of the request.
+
+    The first of COMPRESSION_ENCODINGS the client accepts wins, whatever
+    the q-values of the others.
+
+    Args:
+        accept_encoding (str): The Accept-Encoding header.
+
+    Returns:
+        str | None: The encoding, or None to send the response as is.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    for name in get_settings().compression_encoding_list:
+        if name in available_encodings() and accepted.get(name, accepted.get("*", 0.0)) > 0:
+            return name
+    return None
+
+
+def compressible(headers: Headers):
+    """
+    Whether a response may be compressed: a type of COMPRESSION_TYPES, not encoded yet.
+    """
+    if "content-encoding" in headers:
+        return False
+    content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    return any(content_type.startswith(prefix) for prefix in get_settings().compression_type_list)
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with the best encoding the client accepts: zstd, brotli or gzip.
+
+    Only types listed in COMPRESSION_TYPES (JSON and text by default) are
+    compressed, so zip bundles, file downloads, exports and event streams
+    go out untouched; so do bodies under COMPRESSION_MIN_SIZE bytes. A
+    streamed body is compressed chunk by chunk, each flushed as it comes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # held back until the first body chunk shows whether to compress
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                if compressible(headers):
+                    headers.add_vary_header("Accept-Encoding")
+                    if more_body or len(body) >= get_settings().compression_min_size:
+                        compressor = encoder(encoding)
+                        headers["Content-Encoding"] = encoding
+                        del headers["Content-Length"]
+                if compressor is not None and not more_body:
+                    body = compressor.compress(body) + compressor.finish()
+                    headers["Content-Length"] = str(len(body))
+                    message = {**message, "body": body}
+                elif compressor is not None:
+                    message = {**message, "body": compressor.compress(body) + compressor.flush()}
+                await send(start)
+                start = None
+                return await send(message)
+            if compressor is not None:
+                data = compressor.compress(body) + (compressor.flush() if more_body else compressor.finish())
+                message = {**message, "body": data}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+        if start is not None:
+            await send(start)
@@ -0,0 +1,196 @@
+from fastapi import HTTPException
+from sqlalchemy import delete as sql_delete, insert, inspect, update as sql_update
+from sqlalchemy.exc import IntegrityError
+from .changelog import record_change
+import re
+
+# driver error -> broken constraint: MariaDB error numbers first, then the
+# messages of SQLite, which has no error numbers
+_ERRNOS = {
+    1062: "unique", 1586: "unique",
+    1216: "foreign key", 1452: "foreign key",
+    1048: "not null", 1364: "not null",
+}
+_MESSAGES = (
+    ("UNIQUE constraint", "unique"),
+    ("FOREIGN KEY constraint", "foreign key"),
+    ("NOT NULL constraint", "not null"),
+)
+# the column named by a NOT NULL error: "... failed: device.DEV_os" or "Column 'DEV_os' ..."
+_NULL_COLUMN = re.compile(r"failed: \w+\.(\w+)|Column '(\w+)'")
+
+
+def _key(model):
+    return inspect(model).primary_key[0]
+
+
+def _row(model, result):
+    # a plain instance, outside the session, so reading it after the commit
+    # does not reload it
+    return model(**result._mapping) if result is not None else None
+
+
+def violation(error: IntegrityError):
+    """
+    The kind of constraint an INSERT or UPDATE broke.
+
+    Args:
+        error (IntegrityError): The error raised by the statement.
+
+    Returns:
+        str | None: "unique" for a duplicate primary or unique key, "foreign key",
+        "not null", or None for another constraint.
+    """
+    orig = error.orig
+    errno = getattr(orig, "errno", None)
+    if errno is None and orig is not None and orig.args and isinstance(orig.args[0], int):
+        errno = orig.args[0]
+    if errno in _ERRNOS:
+        return _ERRNOS[errno]
+    message = str(orig)
+    for marker, kind in _MESSAGES:
+        if marker in message:
+            return kind
+    return None
+
+
+def reject_invalid(error: IntegrityError):
+    """
+    Raise the HTTP error for a row refused by the database for another reason than a duplicate key.
+
+    A missing required field or a reference to a row that does not exist is
+    a 422 error; another constraint is a 400 error. A duplicate key returns
+    normally, for the caller to report.
+
+    Args:
+        error (IntegrityError): The error raised by the statement.
+    """
+    kind = violation(error)
+    if kind == "unique":
+        return
+    if kind == "foreign key":
+        raise HTTPException(status_code=422, detail="A referenced row does not exist")
+    if kind == "not null":
+        column = _NULL_COLUMN.search(str(error.orig))
+        name = next((group for group in column.groups() if group), None) if column else None
+        raise HTTPException(status_code=422, detail=f"{name} is required" if name else "A required field is missing")
+    raise HTTPException(status_code=400, detail="The row breaks a database constraint")
+
+
+def sent_fields(row, fields: list[str]):
+    """
+    The values of the fields a client actually sent in a request body.
+
+    Args:
+        row: The request body, a table model.
+        fields (list[str]): The fields that may be written.
+
+    Returns:
+        dict: Field name -> value, for the fields among `fields` present in the body.
+    """
+    return {field: getattr(row, field) for field in fields if field in row.model_fields_set}
+
+
+def create(session, row, entity: str | None = None):
+    """
+    Insert a row with a single INSERT ... RETURNING.
+
+    There is no existence check beforehand: a duplicate key is detected from
+    the constraint error of the insert itself, which also holds when two
+    requests race. Other constraint errors raise an HTTP error, see
+    `reject_invalid`.
+
+    Args:
+        session (Session): The database session, committed here.
+        row: The row to insert. A primary key of None is generated by the database.
+        entity (str | None): The change log entity of the row, if it has one.
+
+    Returns:
+        The inserted row, or None if it conflicts with an existing row.
+    """
+    model = type(row)
+    key = _key(model)
+    values = row.model_dump()
+    if values.get(key.key) is None:
+        values.pop(key.key, None)
+    table = model.__table__
+    statement = insert(table).values(**values)
+    try:
+        if session.get_bind().dialect.insert_returning:
+            created = _row(model, session.execute(statement.returning(*table.columns)).one())
+        else:
+            created = model(**values)
+            setattr(created, key.key, session.execute(statement).inserted_primary_key[0])
+        if entity:
+            record_change(session, entity, getattr(created, key.key), "create")
+        session.commit()
+    except IntegrityError as error:
+        session.rollback()
+        reject_invalid(error)
+        return None
+    return created
+
+
+def update(session, model, row_id: int, values: dict, entity: str | None = None):
+    """
+    Write the given fields of a row with a single UPDATE ... WHERE.
+
+    Only the columns in `values` are written. The updated row comes back
+    through RETURNING where the database supports it, else from one SELECT.
+
+    Args:
+        session (Session): The database session, committed here.
+        model: The table model.
+        row_id (int): The primary key of the row.
+        values (dict): Column name -> new value or SQL expression.
+        entity (str | None): The change log entity of the row, if it has one.
+
+    Returns:
+        The updated row, or None if there is no such row.
+    """
+    if not values:
+        return session.get(model, row_id)
+    table = model.__table__
+    statement = sql_update(table).where(_key(model) == row_id).values(**values)
+    try:
+        if session.get_bind().dialect.update_returning:
+            updated = _row(model, session.execute(statement.returning(*table.columns)).one_or_none())
+            if updated is None:
+                session.rollback()
+                return None
+        else:
+            if session.execute(statement).rowcount != 1:
+                session.rollback()
+                return None
+            updated = None
+        if entity:
+            record_change(session, entity, row_id, "update")
+        session.commit()
+    except IntegrityError as error:
+        session.rollback()
+        reject_invalid(error)
+        raise HTTPException(status_code=400, detail="The update conflicts with an existing row")
+    return updated if updated is not None else session.get(model, row_id, populate_existing=True)
+
+
+def delete(session, model, row_id: int, entity: str | None = None):
+    """
+    Delete a row with a single DELETE ... WHERE.
+
+    Args:
+        session (Session): The database session, committed here.
+        model: The table model.
+        row_id (int): The primary key of the row.
+        entity (str | None): The change log entity of the row, if it has one.
+
+    Returns:
+        bool: False if there was no such row.
+    """
+    result = session.execute(sql_delete(model.__table__).where(_key(model) == row_id))
+    if result.rowcount != 1:
+        session.rollback()
+        return False
+    if entity:
+        record_change(session, entity, row_id, "delete")
+    session.commit()
+    return True
@@ -0,0 +1,226 @@
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import delete, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from ..db.database import DeletionJob, DeploymentJob, DeploymentTarget, Device, DeviceGroup, Package, PackageGroup
+from ..dependencies import get_engine
+from ..settings import get_settings
+from .changelog import record_bulk_change, record_change
+from .groups import has_children, unlink
+import anyio.to_thread
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# job states: pending -> running -> done, or failed with DELJ_error set
+ACTIVE = ("pending", "running")
+
+# entity -> (group model, primary key column,
+#            [(dependent model, its key, its group column, its change log entity)],
+#            group column of the deployment jobs)
+# Devices and packages are detached from the group; deployment jobs of the
+# group are removed with their targets.
+GROUPS = {
+    "devicegroup": (DeviceGroup, DeviceGroup.DG_id, [
+        (Device, Device.DEV_id, Device.DG_id, "device"),
+        (Package, Package.PACK_id, Package.DG_id, "package"),
+    ], DeploymentJob.DG_id),
+    "packagegroup": (PackageGroup, PackageGroup.PG_id, [
+        (Package, Package.PACK_id, Package.PG_id, "package"),
+    ], DeploymentJob.PG_id),
+}
+
+
+def count_dependents(session, entity: str, group_id: int):
+    """
+    Count the rows a deletion job has to go through before deleting a group.
+
+    Returns:
+        int: The number of detached rows, deployment jobs and deployment targets.
+    """
+    _, _, dependents, job_column = GROUPS[entity]
+    total = sum(
+        session.exec(select(func.count()).select_from(model).where(column == group_id)).one()
+        for model, _, column, _ in dependents
+    )
+    jobs = select(DeploymentJob.DEPJ_id).where(job_column == group_id)
+    total += session.exec(select(func.count()).select_from(DeploymentJob).where(job_column == group_id)).one()
+    total += session.exec(select(func.count()).select_from(DeploymentTarget).where(DeploymentTarget.DEPJ_id.in_(jobs))).one()
+    return total
+
+
+def reject_deleted_groups(session, DG_id: int | None = None, PG_id: int | None = None):
+    """
+    Raise a 409 error when rows are attached to a group that is being deleted.
+
+    The deletion job would detach them again without telling anyone.
+
+    Args:
+        session (Session): The database session.
+        DG_id (int | None): The device group the rows are attached to, if any.
+        PG_id (int | None): The package group the rows are attached to, if any.
+    """
+    for entity, group_id, label in (("devicegroup", DG_id, "Device group"), ("packagegroup", PG_id, "Package group")):
+        if group_id is not None and session.exec(select(DeletionJob.DELJ_id).where(
+            DeletionJob.DELJ_entity == entity, DeletionJob.DELJ_rowId == group_id, DeletionJob.DELJ_status.in_(ACTIVE)
+        ).limit(1)).first() is not None:
+            raise HTTPException(status_code=409, detail=f"{label} is being deleted")
+
+
+def start_deletion(session, entity: str, group_id: int, user: str | None):
+    """
+    Queue the deletion of a group, or return the deletion already queued for it.
+
+    Args:
+        session (Session): The database session, committed here.
+        entity (str): "devicegroup" or "packagegroup".
+        group_id (int): The group to delete.
+        user (str | None): The user asking for the deletion.
+
+    Returns:
+        DeletionJob: The job.
+    """
+    job = session.exec(select(DeletionJob).where(
+        DeletionJob.DELJ_entity == entity, DeletionJob.DELJ_rowId == group_id, DeletionJob.DELJ_status.in_(ACTIVE)
+    )).first()
+    if job is None:
+        job = DeletionJob(DELJ_entity=entity, DELJ_rowId=group_id, DELJ_user=user,
+                          DELJ_total=count_dependents(session, entity, group_id))
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+    return job
+
+
+def _detach(session, model, key, column, entity: str, group_id: int, limit: int):
+    ids = session.exec(select(key).where(column == group_id).order_by(key).limit(limit)).all()
+    if ids:
+        record_bulk_change(session, entity, [key.in_(ids)])
+        session.exec(update(model).where(key.in_(ids)).values({column.key: None}).execution_options(synchronize_session=False))
+    return len(ids)
+
+
+def _remove_deployment(session, job_column, group_id: int, limit: int):
+    # one deployment job at a time: its targets by batches, then the job
+    job_id = session.exec(select(DeploymentJob.DEPJ_id).where(job_column == group_id).order_by(DeploymentJob.DEPJ_id).limit(1)).first()
+    if job_id is None:
+        return 0
+    session.exec(update(DeploymentJob).where(DeploymentJob.DEPJ_id == job_id).values(DEPJ_status="cancelled"))
+    devices = session.exec(
+        select(DeploymentTarget.DEV_id).where(DeploymentTarget.DEPJ_id == job_id).order_by(DeploymentTarget.DEV_id).limit(limit)
+    ).all()
+    if devices:
+        session.exec(delete(DeploymentTarget).where(DeploymentTarget.DEPJ_id == job_id, DeploymentTarget.DEV_id.in_(devices)))
+        return len(devices)
+    session.exec(delete(DeploymentJob).where(DeploymentJob.DEPJ_id == job_id))
+    return 1
+
+
+def run_batch(session, job: DeletionJob):
+    """
+    Process one batch of a deletion job, or delete the group once nothing refers to it.
+
+    The batch only changes up to DELETION_BATCH_SIZE rows and is committed
+    with the progress of the job, so a restart resumes where it stopped.
+
+    Args:
+        session (Session): The database session; the job row is locked.
+        job (DeletionJob): The job.
+    """
+    model, key, dependents, job_column = GROUPS[job.DELJ_entity]
+    limit = get_settings().deletion_batch_size
+    done = 0
+    for dependent, dependent_key, column, entity in dependents:
+        done = _detach(session, dependent, dependent_key, column, entity, job.DELJ_rowId, limit)
+        if done:
+            break
+    if not done:
+        done = _remove_deployment(session, job_column, job.DELJ_rowId, limit)
+    if done:
+        job.DELJ_status = "running"
+        job.DELJ_done += done
+        if job.DELJ_done > job.DELJ_total:
+            # rows were attached before the job was seen: count what is left
+            job.DELJ_total = job.DELJ_done + count_dependents(session, job.DELJ_entity, job.DELJ_rowId)
+    else:
+        if job.DELJ_entity == "devicegroup":
+            if has_children(session, job.DELJ_rowId):
+                raise ValueError("device group has subgroups")
+            unlink(session, job.DELJ_rowId)
+        if session.exec(delete(model).where(key == job.DELJ_rowId)).rowcount:
+            record_change(session, job.DELJ_entity, job.DELJ_rowId, "delete")
+        job.DELJ_status = "done"
+        job.DELJ_total = job.DELJ_done
+        logger.info("Deleted %s %d", job.DELJ_entity, job.DELJ_rowId)
+    job.DELJ_updated = datetime.utcnow()
+    session.add(job)
+
+
+class DeletionWorker:
+    """
+    Runs the deletion jobs, one batch of each active job per tick.
+
+    Ticks follow each other DELETION_BATCH_PAUSE seconds apart while there is
+    work, so other transactions get the tables between batches, and
+    DELETION_TICK_INTERVAL seconds apart when there is none.
+    """
+
+    def fail(self, job_id: int, error: Exception):
+        """
+        Mark a job as failed, in a transaction of its own.
+        """
+        with Session(get_engine()) as session:
+            session.exec(update(DeletionJob).where(DeletionJob.DELJ_id == job_id).values(
+                DELJ_status="failed", DELJ_error=str(error), DELJ_updated=datetime.utcnow()
+            ))
+            session.commit()
+
+    def tick(self):
+        """
+        Run one batch of every active job, each in its own short transaction.
+
+        Returns:
+            bool: True if a job is still active.
+        """
+        active = False
+        with Session(get_engine()) as session:
+            job_ids = session.exec(select(DeletionJob.DELJ_id).where(DeletionJob.DELJ_status.in_(ACTIVE))).all()
+            for job_id in job_ids:
+                job = session.exec(select(DeletionJob).where(DeletionJob.DELJ_id == job_id).with_for_update()).first()
+                if job is None or job.DELJ_status not in ACTIVE:
+                    session.rollback()
+                    continue
+                try:
+                    run_batch(session, job)
+                    status = job.DELJ_status
+                    session.commit()
+                except IntegrityError:
+                    # a row was attached to the group since the batch read; detached next tick
+                    session.rollback()
+                    active = True
+                    continue
+                except Exception as error:
+                    session.rollback()
+                    logger.exception("Deletion job %d failed", job_id)
+                    self.fail(job_id, error)
+                    continue
+                active = active or status in ACTIVE
+        return active
+
+    async def run(self):
+        """
+        Tick until cancelled.
+        """
+        while True:
+            try:
+                active = await anyio.to_thread.run_sync(self.tick)
+            except Exception:
+                logger.exception("Deletion worker tick failed")
+                active = False
+            settings = get_settings()
+            await asyncio.sleep(settings.deletion_batch_pause if active else settings.deletion_tick_interval)
+
+
+deletions = DeletionWorker()
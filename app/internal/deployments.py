@@ -0,0 +1,305 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, or_, update
+from sqlmodel import Session, select
+from ..db.database import Device, DeviceGroupClosure, Package, DeploymentJob, DeploymentTarget
+from ..dependencies import get_engine
+from ..settings import get_settings
+from .groups import inherited_packages, subtree
+import anyio.to_thread
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# target states: waiting -> ready -> downloading -> done, with failed
+# attempts going back to waiting until DEPJ_maxAttempts is reached
+IN_FLIGHT = ("ready", "downloading")
+FINISHED = ("done", "failed")
+
+
+def target_devices(session, job: DeploymentJob):
+    """
+    List the devices a job deploys to.
+
+    A device group job targets the devices of the group and of the groups
+    nested under it. A package group job targets the devices its packages
+    are assigned to, directly or through their device group or a group above.
+
+    Args:
+        session (Session): The database session.
+        job (DeploymentJob): The job.
+
+    Returns:
+        list[int]: The device IDs, in ID order.
+    """
+    if job.DG_id is not None:
+        statement = select(Device.DEV_id).where(Device.DG_id.in_(subtree(job.DG_id)))
+    else:
+        packages = select(Package.DEV_id, Package.DG_id).where(Package.PG_id == job.PG_id).subquery()
+        groups = select(DeviceGroupClosure.DGC_descendant).where(DeviceGroupClosure.DGC_ancestor.in_(select(packages.c.DG_id)))
+        statement = select(Device.DEV_id).where(or_(
+            Device.DEV_id.in_(select(packages.c.DEV_id)),
+            Device.DG_id.in_(groups),
+        ))
+    return session.exec(statement.order_by(Device.DEV_id)).all()
+
+
+def job_packages(session, job: DeploymentJob, device: Device):
+    """
+    List the package files a job deploys to one device.
+
+    Those are the packages of the device, assigned to it or inherited from
+    its group and the groups above, restricted to the package group of a
+    package group job.
+
+    Args:
+        session (Session): The database session.
+        job (DeploymentJob): The job.
+        device (Device): The target device.
+
+    Returns:
+        list[str]: The package file names.
+    """
+    statement = inherited_packages(device.DEV_id)
+    if job.DG_id is None:
+        statement = statement.where(Package.PG_id == job.PG_id)
+    return [package.PACK_name for package in session.exec(statement)]
+
+
+def device_package(session, device_id: int, package_id: int):
+    """
+    A package a device may download: assigned to it, or inherited from its groups.
+
+    Args:
+        session (Session): The database session.
+        device_id (int): The device.
+        package_id (int): The package.
+
+    Returns:
+        Package | None: The package, or None if it is not one of the device's.
+    """
+    return session.exec(inherited_packages(device_id).where(Package.PACK_id == package_id)).first()
+
+
+def awaiting_wave(session, device_id: int, package: Package):
+    """
+    Whether a deployment job covering a package has not released a device yet.
+
+    Such a device gets the package with its wave, inside the job's in-flight cap.
+
+    Args:
+        session (Session): The database session.
+        device_id (int): The device.
+        package (Package): One of the device's packages.
+
+    Returns:
+        bool: True if the device waits for its wave.
+    """
+    return session.exec(
+        select(DeploymentTarget.DEPJ_id)
+        .join(DeploymentJob, DeploymentJob.DEPJ_id == DeploymentTarget.DEPJ_id)
+        .where(
+            DeploymentTarget.DEV_id == device_id,
+            DeploymentTarget.DEPT_status == "waiting",
+            DeploymentJob.DEPJ_status.in_(("pending", "running")),
+            or_(DeploymentJob.DG_id.is_not(None), DeploymentJob.PG_id == package.PG_id),
+        )
+        .limit(1)
+    ).first() is not None
+
+
+def create_targets(session, job: DeploymentJob):
+    """
+    Split the devices of a job into waves of DEPJ_waveSize devices.
+
+    Args:
+        session (Session): The database session holding the job.
+        job (DeploymentJob): The job, already flushed.
+
+    Returns:
+        int: The number of targets.
+    """
+    devices = target_devices(session, job)
+    if devices:
+        session.exec(insert(DeploymentTarget), params=[
+            {"DEPJ_id": job.DEPJ_id, "DEV_id": device_id, "DEPT_wave": index // job.DEPJ_waveSize,
+             "DEPT_status": "waiting", "DEPT_attempts": 0, "DEPT_updated": datetime.utcnow()}
+            for index, device_id in enumerate(devices)
+        ])
+    return len(devices)
+
+
+def job_progress(session, job_id: int):
+    """
+    Count the targets of a job per state.
+
+    Args:
+        session (Session): The database session.
+        job_id (int): The job ID.
+
+    Returns:
+        dict[str, int]: The number of targets per state.
+    """
+    rows = session.exec(
+        select(DeploymentTarget.DEPT_status, func.count())
+        .where(DeploymentTarget.DEPJ_id == job_id)
+        .group_by(DeploymentTarget.DEPT_status)
+    ).all()
+    return dict(rows)
+
+
+def retry_delay(attempts: int):
+    """
+    The exponential backoff before a failed target is tried again.
+
+    Args:
+        attempts (int): The number of failed attempts so far.
+
+    Returns:
+        timedelta: The delay.
+    """
+    settings = get_settings()
+    return timedelta(seconds=min(settings.deploy_retry_base * 2 ** (attempts - 1), settings.deploy_retry_max))
+
+
+def fail_target(session, target: DeploymentTarget, max_attempts: int):
+    """
+    Record a failed attempt, scheduling a retry unless the attempts are exhausted.
+
+    Args:
+        session (Session): The database session.
+        target (DeploymentTarget): The target that failed.
+        max_attempts (int): The maximum number of attempts of its job.
+    """
+    now = datetime.utcnow()
+    target.DEPT_attempts += 1
+    if target.DEPT_attempts >= max_attempts:
+        target.DEPT_status = "failed"
+    else:
+        target.DEPT_status = "waiting"
+        target.DEPT_nextAttempt = now + retry_delay(target.DEPT_attempts)
+    target.DEPT_updated = now
+    session.add(target)
+
+
+def claim_target(session, job_id: int, device_id: int):
+    """
+    Start the download of a device released by the scheduler.
+
+    Only one request can claim a target: the state change is a conditional UPDATE.
+
+    Args:
+        session (Session): The database session.
+        job_id (int): The job ID.
+        device_id (int): The device ID.
+
+    Returns:
+        bool: True if the target was ready and is now downloading.
+    """
+    result = session.exec(
+        update(DeploymentTarget)
+        .where(DeploymentTarget.DEPJ_id == job_id, DeploymentTarget.DEV_id == device_id, DeploymentTarget.DEPT_status == "ready")
+        .values(DEPT_status="downloading", DEPT_updated=datetime.utcnow())
+    )
+    session.commit()
+    return result.rowcount == 1
+
+
+class DeploymentScheduler:
+    """
+    Releases the devices of running deployment jobs wave by wave.
+
+    A wave starts once every device of the previous wave is done or has
+    failed for good. Inside a wave, at most DEPJ_maxInFlight devices (fewer if
+    DEPJ_bandwidthLimit divided by DEPLOY_CLIENT_RATE is lower) are released
+    at a time. Devices that do not report back within DEPLOY_TIMEOUT count as
+    a failed attempt and are retried with exponential backoff.
+    """
+
+    def capacity(self, job: DeploymentJob):
+        """
+        The maximum number of devices of a job downloading at the same time.
+
+        Args:
+            job (DeploymentJob): The job.
+
+        Returns:
+            int: The in-flight cap.
+        """
+        if job.DEPJ_bandwidthLimit is None:
+            return job.DEPJ_maxInFlight
+        return max(1, min(job.DEPJ_maxInFlight, job.DEPJ_bandwidthLimit // get_settings().deploy_client_rate))
+
+    def tick_job(self, session, job: DeploymentJob):
+        """
+        Advance one job: expire stale downloads, release devices, detect completion.
+
+        Args:
+            session (Session): The database session; the job row is locked.
+            job (DeploymentJob): The job.
+        """
+        now = datetime.utcnow()
+        stale = session.exec(select(DeploymentTarget).where(
+            DeploymentTarget.DEPJ_id == job.DEPJ_id,
+            DeploymentTarget.DEPT_status.in_(IN_FLIGHT),
+            DeploymentTarget.DEPT_updated < now - timedelta(seconds=get_settings().deploy_timeout),
+        )).all()
+        for target in stale:
+            fail_target(session, target, job.DEPJ_maxAttempts)
+        session.flush()
+
+        progress = job_progress(session, job.DEPJ_id)
+        if sum(progress.get(state, 0) for state in FINISHED) == sum(progress.values()):
+            job.DEPJ_status = "done"
+        else:
+            wave = session.exec(select(func.min(DeploymentTarget.DEPT_wave)).where(
+                DeploymentTarget.DEPJ_id == job.DEPJ_id,
+                DeploymentTarget.DEPT_status.not_in(FINISHED),
+            )).one()
+            free = self.capacity(job) - sum(progress.get(state, 0) for state in IN_FLIGHT)
+            if free > 0:
+                released = session.exec(select(DeploymentTarget.DEV_id).where(
+                    DeploymentTarget.DEPJ_id == job.DEPJ_id,
+                    DeploymentTarget.DEPT_status == "waiting",
+                    DeploymentTarget.DEPT_wave == wave,
+                    or_(DeploymentTarget.DEPT_nextAttempt == None, DeploymentTarget.DEPT_nextAttempt <= now),
+                ).order_by(DeploymentTarget.DEV_id).limit(free)).all()
+                if released:
+                    session.exec(
+                        update(DeploymentTarget)
+                        .where(DeploymentTarget.DEPJ_id == job.DEPJ_id, DeploymentTarget.DEV_id.in_(released))
+                        .values(DEPT_status="ready", DEPT_updated=now)
+                    )
+        job.DEPJ_updated = now
+        session.add(job)
+
+    def tick(self):
+        """
+        Advance every pending or running job, each in its own short transaction.
+        """
+        with Session(get_engine()) as session:
+            job_ids = session.exec(
+                select(DeploymentJob.DEPJ_id).where(DeploymentJob.DEPJ_status.in_(("pending", "running")))
+            ).all()
+            for job_id in job_ids:
+                job = session.exec(select(DeploymentJob).where(DeploymentJob.DEPJ_id == job_id).with_for_update()).first()
+                if job is None or job.DEPJ_status not in ("pending", "running"):
+                    session.rollback()
+                    continue
+                job.DEPJ_status = "running"
+                self.tick_job(session, job)
+                session.commit()
+
+    async def run(self):
+        """
+        Tick every DEPLOY_TICK_INTERVAL seconds until cancelled.
+        """
+        while True:
+            try:
+                await anyio.to_thread.run_sync(self.tick)
+            except Exception:
+                logger.exception("Deployment scheduler tick failed")
+            await asyncio.sleep(get_settings().deploy_tick_interval)
+
+
+scheduler = DeploymentScheduler()
@@ -0,0 +1,129 @@
+from sqlmodel import Session
+from ..dependencies import get_engine
+from ..settings import get_settings
+from .changelog import read_changes, settled_cursor
+import anyio.to_thread
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """
+    The queue of encoded events waiting to be sent to one client.
+    """
+
+    def __init__(self, topics: set[str] | None, size: int):
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize=size)
+        self.loop = asyncio.get_running_loop()
+        self.dropped = 0
+
+    def offer(self, event: str):
+        """
+        Queue an event without ever blocking the publisher.
+
+        When the client does not keep up and its queue is full, the queued
+        events are replaced by a single resync event: the client is expected
+        to reload its data instead of receiving a partial history.
+
+        Args:
+            event (str): The JSON encoded event.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(json.dumps({"op": "resync"}))
+
+
+class ChangeFeed:
+    """
+    Publishes create, update and delete events to the subscribed clients.
+
+    Events come from the change log, so writes handled by any worker reach
+    the subscribers of every worker. Each event is encoded once and fanned out
+    to every subscriber queue.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._cursor = None
+
+    async def subscribe(self, topics: set[str] | None = None):
+        """
+        Register a new client; it receives every change committed from now on.
+
+        Args:
+            topics (set[str] | None): The entities to receive, or None for all of them.
+
+        Returns:
+            Subscription: The client subscription.
+        """
+        if self._cursor is None:
+            self._cursor = await anyio.to_thread.run_sync(self._latest)
+        subscription = Subscription(topics, get_settings().events_queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """
+        Remove a client.
+
+        Args:
+            subscription (Subscription): The client subscription.
+        """
+        self._subscribers.discard(subscription)
+
+    def publish(self, change: dict):
+        """
+        Send a change to the subscribed clients.
+
+        Args:
+            change (dict): The change, as returned by read_changes. Its version
+                can be used as the `since` cursor of `/changes/` after a resync.
+        """
+        encoded = json.dumps(change, default=str)
+        loop = asyncio.get_running_loop()
+        for subscription in list(self._subscribers):
+            if subscription.topics is None or change["entity"] in subscription.topics:
+                if subscription.loop is loop:
+                    subscription.offer(encoded)
+                else:
+                    subscription.loop.call_soon_threadsafe(subscription.offer, encoded)
+
+    def _latest(self):
+        with Session(get_engine()) as session:
+            # the latest changes may be published again, but none is skipped
+            return settled_cursor(session)
+
+    def _poll(self, cursor: int):
+        with Session(get_engine()) as session:
+            changes, cursor, _ = read_changes(session, cursor, get_settings().events_batch_size)
+            return changes, cursor
+
+    async def run(self):
+        """
+        Publish the new change log entries every EVENTS_POLL_INTERVAL seconds until cancelled.
+
+        The change log is only read while clients are subscribed.
+        """
+        while True:
+            await asyncio.sleep(get_settings().events_poll_interval)
+            if not self._subscribers:
+                self._cursor = None
+                continue
+            try:
+                changes, self._cursor = await anyio.to_thread.run_sync(self._poll, self._cursor)
+            except Exception:
+                logger.exception("Reading the change log failed")
+                continue
+            for change in changes:
+                self.publish(change)
+
+
+changes = ChangeFeed()
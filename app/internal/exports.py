@@ -0,0 +1,199 @@
+from datetime import datetime
+from sqlalchemy import Boolean, DateTime, Integer
+from sqlmodel import Session, select
+from ..db.database import Device, DeviceGroup, DeviceStatus, Package, PackageGroup
+from ..dependencies import get_engine
+import csv
+import io
+import zlib
+
+# exported name -> table model
+TABLES = {
+    "devices": Device,
+    "devicegroups": DeviceGroup,
+    "devicestatus": DeviceStatus,
+    "packages": Package,
+    "packagegroups": PackageGroup,
+}
+
+# format -> (media type, file extension)
+FORMATS = {
+    "csv.gz": ("application/gzip", "csv.gz"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def iter_batches(model, batch_size: int):
+    """
+    Read a whole table in primary key order, batch_size rows at a time.
+
+    The rows come from a server-side cursor where the driver supports it,
+    so only one batch is held in memory. The session is opened here rather
+    than taken from the request, because the response body is produced after
+    the request dependencies are closed.
+
+    Args:
+        model: The table model.
+        batch_size (int): The number of rows per batch.
+
+    Yields:
+        list[tuple]: The rows of a batch, one value per column.
+    """
+    table = model.__table__
+    with Session(get_engine()) as session:
+        result = session.connection().execution_options(stream_results=True, yield_per=batch_size).execute(
+            select(*table.columns).order_by(*table.primary_key.columns)
+        )
+        for partition in result.partitions(batch_size):
+            yield partition
+
+
+class _Sink:
+    """
+    A write-only file collecting what an encoder writes, drained after each batch.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+def csv_gzip(model, batches):
+    """
+    Encode batches as gzip-compressed CSV with a header row.
+
+    Yields:
+        bytes: The compressed output.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(model.__table__.columns.keys())
+    for batch in batches:
+        writer.writerows(
+            ["" if value is None else value.isoformat() if isinstance(value, datetime) else value for value in row]
+            for row in batch
+        )
+        data = compressor.compress(text.getvalue().encode())
+        text.seek(0)
+        text.truncate()
+        if data:
+            yield data
+    yield compressor.compress(text.getvalue().encode()) + compressor.flush()
+
+
+def arrow_schema(model):
+    """
+    The Arrow schema of a table.
+
+    Returns:
+        pyarrow.Schema: One nullable field per column.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for column in model.__table__.columns:
+        if isinstance(column.type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp("us")
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.key, arrow_type))
+    return pa.schema(fields)
+
+
+def to_record_batch(schema, batch):
+    """
+    Turn rows into an Arrow record batch, column by column.
+    """
+    import pyarrow as pa
+
+    columns = list(zip(*batch)) if batch else [[] for _ in schema]
+    return pa.record_batch([pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+
+
+def arrow_stream(model, batches):
+    """
+    Encode batches as a zstd-compressed Arrow IPC stream, one record batch per batch.
+
+    Yields:
+        bytes: The encoded output.
+    """
+    import pyarrow as pa
+
+    schema = arrow_schema(model)
+    sink = _Sink()
+    options = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema, options=options) as writer:
+        for batch in batches:
+            writer.write_batch(to_record_batch(schema, batch))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def parquet(model, batches):
+    """
+    Encode batches as a zstd-compressed Parquet file, one row group per batch.
+
+    Yields:
+        bytes: The encoded output.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(model)
+    sink = _Sink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="zstd") as writer:
+        for batch in batches:
+            writer.write_batch(to_record_batch(schema, batch))
+            yield sink.drain()
+    yield sink.drain()
+
+
+ENCODERS = {"csv.gz": csv_gzip, "arrow": arrow_stream, "parquet": parquet}
+
+
+def export(model, format: str, batch_size: int):
+    """
+    Stream a whole table in an export format.
+
+    Args:
+        model: The table model.
+        format (str): A key of FORMATS.
+        batch_size (int): The number of rows read and encoded at a time.
+
+    Yields:
+        bytes: The encoded table.
+    """
+    yield from ENCODERS[format](model, iter_batches(model, batch_size))
+
+
+def pyarrow_available():
+    """
+    Whether the optional pyarrow package, needed for Arrow and Parquet, is installed.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
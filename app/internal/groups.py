@@ -0,0 +1,182 @@
+from fastapi import HTTPException
+from sqlalchemy import delete, insert, literal, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlmodel import select
+from ..db.database import Device, DeviceGroup, DeviceGroupClosure, DeviceGroupTreeLock, Package
+from .changelog import record_change
+from .crud import reject_invalid
+
+# Device groups nest. The tree is kept as a closure table: DeviceGroupClosure
+# holds a row for every group and each of its ancestors, itself included at
+# depth 0, so subtrees and ancestor chains are single indexed lookups
+# whatever the depth of the tree.
+
+Closure = DeviceGroupClosure
+
+
+def subtree(group_id):
+    """
+    The groups under a group, the group included.
+
+    Args:
+        group_id: The group ID, or a column holding it.
+
+    Returns:
+        Select: The IDs of the groups, for use with `in_()`.
+    """
+    return select(Closure.DGC_descendant).where(Closure.DGC_ancestor == group_id)
+
+
+def ancestors(group_id):
+    """
+    The groups above a group, the group included.
+
+    Args:
+        group_id: The group ID, or a column holding it.
+
+    Returns:
+        Select: The IDs of the groups, for use with `in_()`.
+    """
+    return select(Closure.DGC_ancestor).where(Closure.DGC_descendant == group_id)
+
+
+def subtree_devices(group_id):
+    """
+    The devices of a group and of all the groups under it.
+
+    Returns:
+        Select: The devices.
+    """
+    return select(Device).where(Device.DG_id.in_(subtree(group_id)))
+
+
+def inherited_packages(device_id):
+    """
+    The packages of a device: assigned to it, to its group or to any group above.
+
+    Args:
+        device_id: The device ID, or a column holding it.
+
+    Returns:
+        Select: The packages.
+    """
+    groups = select(Closure.DGC_ancestor).join(Device, Device.DG_id == Closure.DGC_descendant).where(Device.DEV_id == device_id)
+    return select(Package).where(or_(Package.DEV_id == device_id, Package.DG_id.in_(groups)))
+
+
+def parent(session, group_id: int):
+    """
+    The ID of the group directly above a group, or None for a root.
+    """
+    return session.exec(
+        select(Closure.DGC_ancestor).where(Closure.DGC_descendant == group_id, Closure.DGC_depth == 1)
+    ).first()
+
+
+def _lock_tree(session):
+    # until the commit; the reads that follow are locking reads, so they see
+    # the tree as the previous change left it, not the transaction's snapshot
+    locked = session.exec(select(DeviceGroupTreeLock.DGTL_id).where(DeviceGroupTreeLock.DGTL_id == 1).with_for_update()).first()
+    if locked is None:
+        session.add(DeviceGroupTreeLock(DGTL_id=1))
+        session.flush()
+
+
+def _link(session, group_id: int, parent_id: int | None):
+    # the group itself, then each ancestor of the parent one level further away
+    session.exec(insert(Closure).values(DGC_ancestor=group_id, DGC_descendant=group_id, DGC_depth=0))
+    if parent_id is not None:
+        session.exec(insert(Closure).from_select(
+            ["DGC_ancestor", "DGC_descendant", "DGC_depth"],
+            select(Closure.DGC_ancestor, literal(group_id), Closure.DGC_depth + 1).where(Closure.DGC_descendant == parent_id),
+        ))
+
+
+def create_group(session, group: DeviceGroup, parent_id: int | None):
+    """
+    Insert a device group under a parent, with its closure rows, in one transaction.
+
+    Args:
+        session (Session): The database session, committed here.
+        group (DeviceGroup): The group to insert. A DG_id of None is generated by the database.
+        parent_id (int | None): The group to nest it in, None for a root group.
+
+    Returns:
+        DeviceGroup | None: The inserted group, or None if it conflicts with an existing group.
+        Other constraint errors raise an HTTP error, see `crud.reject_invalid`.
+    """
+    group = DeviceGroup(**group.model_dump())
+    if parent_id is not None:
+        _lock_tree(session)
+    session.add(group)
+    try:
+        session.flush()
+        _link(session, group.DG_id, parent_id)
+        record_change(session, "devicegroup", group.DG_id, "create")
+        session.commit()
+    except IntegrityError as error:
+        session.rollback()
+        reject_invalid(error)
+        return None
+    session.refresh(group)
+    return group
+
+
+def move_group(session, group_id: int, parent_id: int | None):
+    """
+    Move a device group, with everything under it, below another group.
+
+    The links from the old ancestors to the subtree are deleted, then each
+    new ancestor is linked to each group of the subtree with one
+    INSERT ... SELECT. Changes of the tree are serialised on the
+    DeviceGroupTreeLock row, and the cycle check reads the subtree under
+    that lock, so concurrent moves cannot build a cycle.
+
+    Args:
+        session (Session): The database session, committed here.
+        group_id (int): The group to move.
+        parent_id (int | None): The new parent, None to make the group a root.
+
+    Returns:
+        bool: False if the new parent is the group itself or under it.
+        A conflict with a concurrent change of the groups is a 409 error.
+    """
+    _lock_tree(session)
+    members = session.exec(subtree(group_id).with_for_update()).all()
+    if parent_id in members:
+        session.rollback()
+        return False
+    try:
+        session.exec(delete(Closure).where(Closure.DGC_descendant.in_(members), Closure.DGC_ancestor.not_in(members)))
+        if parent_id is not None:
+            above = aliased(Closure)
+            below = aliased(Closure)
+            session.exec(insert(Closure).from_select(
+                ["DGC_ancestor", "DGC_descendant", "DGC_depth"],
+                select(above.DGC_ancestor, below.DGC_descendant, above.DGC_depth + below.DGC_depth + 1)
+                .where(above.DGC_descendant == parent_id, below.DGC_ancestor == group_id),
+            ))
+        record_change(session, "devicegroup", group_id, "update")
+        session.commit()
+    except IntegrityError:
+        # e.g. a group deleted meanwhile
+        session.rollback()
+        raise HTTPException(status_code=409, detail="The device groups changed at the same time, try again")
+    return True
+
+
+def has_children(session, group_id: int):
+    """
+    Whether groups are nested in a group.
+    """
+    return session.exec(
+        select(Closure.DGC_descendant).where(Closure.DGC_ancestor == group_id, Closure.DGC_depth == 1).limit(1)
+    ).first() is not None
+
+
+def unlink(session, group_id: int):
+    """
+    Remove the closure rows of a group without children, before deleting it in the same transaction.
+    """
+    session.exec(delete(Closure).where(Closure.DGC_descendant == group_id))
@@ -1,12 +1,43 @@
-from ..dependencies import SessionDep, get_current_user
 import logging
 
 formatter = logging.Formatter(
     "%(asctime)s - %(name)s - %(levelname)s - Method: '%(method)s' - URL: '%(url)s' - Status: '%(status)s' - User: '%(current_user)s' - Details: '%(message)s'"
 )
 
+
+class RequestFields(logging.Filter):
+    """
+    Give every record the request fields, so the formatter and the audit store always find them.
+
+    Records logged with `user` instead of `current_user` are normalised.
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "current_user"):
+            record.current_user = getattr(record, "user", None)
+        for name in ("method", "url", "status"):
+            if not hasattr(record, name):
+                setattr(record, name, None)
+        return True
+
+
+def audit_file_handler(path: str):
+    """
+    Build the handler appending the records to the audit log file (AUDIT_LOG_FILE).
+
+    Args:
+        path (str): The file path, empty for no file.
+
+    Returns:
+        logging.FileHandler | None: The handler, or None without a file.
+    """
+    if not path:
+        return None
+    handler = logging.FileHandler(path, 'a')
+    handler.setFormatter(formatter)
+    return handler
+
+
 logger = logging.getLogger('ITAM')
 logger.setLevel(logging.WARNING)
-fh = logging.FileHandler('api.log', 'a')
-fh.setFormatter(formatter)
-logger.addHandler(fh)
\ No newline at end of file
+logger.addFilter(RequestFields())
@@ -0,0 +1,301 @@
+from collections import Counter
+from contextvars import Context, ContextVar
+from datetime import datetime
+from functools import lru_cache
+from sqlalchemy import delete, event
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+from starlette.datastructures import Headers
+from urllib.parse import parse_qs
+from ..db.database import RequestProfile, User
+from ..dependencies import decode_access_token, get_engine
+from ..settings import get_settings
+import anyio.to_thread
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# the profile of the request the current code runs for, if any
+_current = ContextVar("profile", default=None)
+
+
+@lru_cache(maxsize=4096)
+def _short_path(filename: str):
+    for path in sorted(filter(None, sys.path), key=len, reverse=True):
+        if filename.startswith(path + os.sep):
+            return filename[len(path) + 1:]
+    return filename
+
+
+def collapse(frame):
+    """
+    The stack of a frame in the collapsed format of flamegraph.pl: outermost frame first, separated by ";".
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{_short_path(code.co_filename)}:{code.co_qualname}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profile:
+    """
+    The stacks sampled and the SQL statements run while handling one request.
+
+    A thread samples the stacks of all threads every PROFILE_SAMPLE_INTERVAL
+    seconds and keeps those working for the request: the event loop while
+    it runs the request's middleware, and the threads with its Request on
+    their stack or running in its context, like the threadpool workers
+    running sync handlers and dependencies. Samples are wall-clock, so time
+    spent waiting on the database shows too.
+    """
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.stacks = Counter()
+        self.samples = 0
+        self.queries = []
+        self.query_count = 0
+        self.query_time = 0.0
+        self.started = None
+        self.duration = None
+        self._loop_thread = threading.get_ident()
+        # thread -> the frame of its stack that showed it works for the request
+        self._anchors = {}
+        # thread -> (top frame, its last instruction, verdict), a blocked thread keeps its verdict
+        self._verdicts = {}
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self.started
+        self._anchors.clear()
+        self._verdicts.clear()
+
+    def _anchor(self, frame, loop_thread: bool):
+        called = None
+        while frame is not None:
+            local = frame.f_locals
+            if loop_thread and local.get("scope") is self.scope:
+                return frame
+            if getattr(local.get("request"), "scope", None) is self.scope:
+                return frame
+            context = local.get("context")
+            if isinstance(context, Context) and context.get(_current) is self:
+                # the worker frame outlives the call it runs in the context, so the call is the anchor
+                return called
+            called = frame
+            frame = frame.f_back
+        return None
+
+    def _serves(self, ident, frame):
+        seen = self._verdicts.get(ident)
+        if seen is not None and seen[0] is frame and seen[1] == frame.f_lasti:
+            return seen[2]
+        anchor = self._anchors.get(ident)
+        caller = frame
+        while caller is not None and caller is not anchor:
+            caller = caller.f_back
+        if caller is None:
+            # reading the locals of each frame is slow, only done when the stack changed below the anchor
+            anchor = self._anchor(frame, ident == self._loop_thread)
+            self._anchors[ident] = anchor
+        serves = anchor is not None
+        self._verdicts[ident] = (frame, frame.f_lasti, serves)
+        return serves
+
+    def _sample(self):
+        interval = get_settings().profile_sample_interval
+        own = threading.get_ident()
+        while not self._stopped.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own and self._serves(ident, frame):
+                    self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+    def query(self, statement: str, duration: float, rows: int):
+        """
+        Record an SQL statement run for the request.
+
+        Args:
+            statement (str): The SQL, without its parameters.
+            duration (float): How long it took, in seconds.
+            rows (int): The rows it matched, -1 when unknown.
+        """
+        self.query_count += 1
+        self.query_time += duration
+        if len(self.queries) < get_settings().profile_max_queries:
+            self.queries.append({"statement": statement, "ms": round(duration * 1000, 3), "rows": rows})
+
+    def report(self):
+        """
+        The profile as stored in RequestProfile.PROF_report.
+
+        Returns:
+            dict: The sampled stacks with their counts, and the SQL statements in order.
+        """
+        return {
+            "sample_interval_ms": get_settings().profile_sample_interval * 1000,
+            "samples": self.samples,
+            "stacks": dict(self.stacks.most_common()),
+            "sql": {
+                "count": self.query_count,
+                "total_ms": round(self.query_time * 1000, 3),
+                "statements": self.queries,
+            },
+        }
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None and context is not None:
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    start = getattr(context, "_profile_start", None)
+    if profile is not None and start is not None:
+        profile.query(statement, time.perf_counter() - start, cursor.rowcount)
+
+
+# number of requests being profiled; the SQL listeners are only installed meanwhile
+_profiling = 0
+_profiling_lock = threading.Lock()
+
+
+def _listen():
+    global _profiling
+    with _profiling_lock:
+        if _profiling == 0:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        _profiling += 1
+
+
+# the values of the flag that turn profiling on
+_ENABLED = ("1", "true")
+
+
+def _unlisten():
+    global _profiling
+    with _profiling_lock:
+        _profiling -= 1
+        if _profiling == 0:
+            event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def requested(scope):
+    """
+    Whether a request asks to be profiled, with an X-Profile header or a profile query parameter set to 1 or true.
+    """
+    if b"profile" in scope["query_string"]:
+        values = parse_qs(scope["query_string"].decode("latin-1")).get("profile", [])
+        if any(value.lower() in _ENABLED for value in values):
+            return True
+    return any(name == b"x-profile" and value.decode("latin-1").strip().lower() in _ENABLED for name, value in scope["headers"])
+
+
+def admin_username(scope):
+    """
+    The administrator sending a request, according to its bearer token.
+
+    Returns:
+        str | None: The username, or None if the request is not from an administrator.
+    """
+    authorization = Headers(scope=scope).get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        return None
+    username = decode_access_token(authorization[7:])
+    if username is None:
+        return None
+    with Session(get_engine()) as session:
+        user = session.exec(select(User).where(User.USER_username == username)).first()
+    if user is None or user.USER_type != 0:
+        return None
+    return username
+
+
+def store(profile: Profile, scope, username: str, status_code: int | None):
+    """
+    Save a profile, then forget the ones beyond the PROFILE_RETENTION newest.
+
+    Returns:
+        int: The ID of the profile.
+    """
+    report = profile.report()
+    with Session(get_engine()) as session:
+        row = RequestProfile(
+            PROF_time=datetime.utcnow(),
+            PROF_user=username,
+            PROF_method=scope["method"],
+            PROF_route=scope["path"][:255],
+            PROF_statusCode=status_code,
+            PROF_duration=round(profile.duration * 1000, 3),
+            PROF_samples=profile.samples,
+            PROF_queries=report["sql"]["count"],
+            PROF_queryTime=report["sql"]["total_ms"],
+            PROF_report=json.dumps(report),
+        )
+        session.add(row)
+        session.commit()
+        profile_id = row.PROF_id
+        session.exec(delete(RequestProfile).where(RequestProfile.PROF_id <= profile_id - get_settings().profile_retention))
+        session.commit()
+    return profile_id
+
+
+class ProfileMiddleware:
+    """
+    Profiles the requests of administrators sending an `X-Profile: 1` header or a profile=1 query parameter.
+
+    The report, stored in RequestProfile, holds the sampled stacks and the
+    SQL statements with their timings; it is read at GET /profiles/. Other
+    requests only pay for looking for the flag.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not requested(scope):
+            return await self.app(scope, receive, send)
+        username = await anyio.to_thread.run_sync(admin_username, scope)
+        if username is None:
+            return await self.app(scope, receive, send)
+
+        status_code = None
+
+        async def send_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        profile = Profile(scope)
+        _listen()
+        token = _current.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            profile.stop()
+            _current.reset(token)
+            _unlisten()
+            try:
+                profile_id = await anyio.to_thread.run_sync(store, profile, scope, username, status_code)
+                logger.info("Profiled %s %s as profile %d", scope["method"], scope["path"], profile_id)
+            except Exception:
+                logger.exception("Storing the profile of %s %s failed", scope["method"], scope["path"])
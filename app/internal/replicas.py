@@ -0,0 +1,158 @@
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session
+from ..db.database import ReplicaHeartbeat
+from ..dependencies import get_engine, get_replica_engines
+from ..settings import get_settings
+import anyio.to_thread
+import asyncio
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# carry the time of a client's last write between its requests
+WRITE_HEADER = "X-Last-Write"
+WRITE_COOKIE = "last_write"
+
+
+class ReplicaSet:
+    """
+    Routes the sessions of read-only handlers to the read replicas that are up to date.
+
+    Every DB_REPLICA_CHECK_INTERVAL seconds the primary writes a tick to the
+    ReplicaHeartbeat row. The tick each replica has replicated gives its lag,
+    to within one interval. A replica that fails, or lags more than
+    DB_REPLICA_MAX_LAG seconds, gets no reads until it catches up; with no
+    usable replica, reads go to the primary.
+
+    A response to a request that committed a write carries the time of the
+    commit, in the X-Last-Write header and the cookie of the same name. A
+    client sending it back only reads from the replicas that replicated a
+    tick written after it, else from the primary, so it reads its own writes
+    whichever worker or process serves it.
+    """
+
+    def __init__(self):
+        self.healthy = []
+        # replica URL -> lag in seconds, None while unknown or unreachable
+        self.lags = {}
+        # replica engine -> the last tick it had replicated, in ms
+        self.ticks = {}
+        self._last_tick = None
+        self._turn = itertools.count()
+
+    def mark(self, response):
+        """
+        Give a client the time of the write it just committed.
+
+        Args:
+            response (Response): The response to the request that wrote.
+        """
+        settings = get_settings()
+        written = str(time.time_ns() // 1_000_000)
+        response.headers[WRITE_HEADER] = written
+        response.set_cookie(WRITE_COOKIE, written, httponly=True, samesite="lax",
+                            max_age=int(settings.db_replica_max_lag + settings.db_replica_check_interval) + 1)
+
+    def engine_for(self, written: int | None):
+        """
+        Choose the engine a read-only session of a client uses.
+
+        Args:
+            written (int | None): The time of the client's last write in ms, see `written_at`.
+
+        Returns:
+            Engine: A usable replica holding that write, in turn, or the primary.
+        """
+        healthy = self.healthy
+        if written is not None:
+            healthy = [engine for engine in healthy if self.ticks.get(engine, 0) >= written]
+        if not healthy:
+            return get_engine()
+        return healthy[next(self._turn) % len(healthy)]
+
+    def check(self):
+        """
+        Measure the lag of each replica, then write the next heartbeat tick on the primary.
+        """
+        engines = get_replica_engines()
+        if not engines:
+            return
+        max_lag = get_settings().db_replica_max_lag
+        healthy = []
+        for engine in engines:
+            url = engine.url.render_as_string(hide_password=True)
+            try:
+                with Session(engine) as session:
+                    heartbeat = session.get(ReplicaHeartbeat, 1)
+            except Exception:
+                logger.warning("Read replica %s is unreachable", url, exc_info=True)
+                heartbeat = None
+            self.ticks[engine] = heartbeat.RH_tick if heartbeat is not None else 0
+            if heartbeat is None or self._last_tick is None:
+                lag = None
+            else:
+                # a replica holding the last tick written is current
+                lag = max(self._last_tick - heartbeat.RH_tick, 0) / 1000
+            usable = lag is not None and lag <= max_lag
+            if usable != (engine in self.healthy):
+                logger.warning("Read replica %s %s (lag: %s s)", url, "back in use" if usable else "taken out of use", lag)
+            self.lags[url] = lag
+            if usable:
+                healthy.append(engine)
+        self.healthy = healthy
+
+        tick = time.time_ns() // 1_000_000
+        with Session(get_engine()) as session:
+            session.merge(ReplicaHeartbeat(RH_id=1, RH_tick=tick))
+            session.commit()
+        self._last_tick = tick
+
+    async def run(self):
+        """
+        Check the replicas every DB_REPLICA_CHECK_INTERVAL seconds until cancelled.
+        """
+        if not get_replica_engines():
+            return
+        while True:
+            try:
+                await anyio.to_thread.run_sync(self.check)
+            except Exception:
+                logger.exception("Checking the read replicas failed")
+            await asyncio.sleep(get_settings().db_replica_check_interval)
+
+    def stats(self):
+        """
+        Describe the replicas.
+
+        Returns:
+            list[dict]: The URL, lag and state of each replica.
+        """
+        healthy = {engine.url.render_as_string(hide_password=True) for engine in self.healthy}
+        return [{"url": url, "lag": lag, "in_use": url in healthy} for url, lag in self.lags.items()]
+
+
+def written_at(request):
+    """
+    The time of a client's last write, as sent back from `ReplicaSet.mark`.
+
+    Returns:
+        int | None: The time in ms, or None if the client sent none.
+    """
+    value = request.headers.get(WRITE_HEADER) or request.cookies.get(WRITE_COOKIE)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+replicas = ReplicaSet()
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _record_write(session):
+    response = session.info.get("response")
+    if response is not None and get_settings().db_replica_urls:
+        replicas.mark(response)
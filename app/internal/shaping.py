@@ -0,0 +1,197 @@
+from starlette.concurrency import iterate_in_threadpool
+from ..settings import get_settings
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` tokens per second, holding at most `burst`.
+
+    Consumers reserve tokens before waiting for them: the balance may go
+    negative, and each consumer sleeps until its own reservation is covered.
+    Reservations are therefore served in arrival order, without a lock.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def reserve(self, amount: int):
+        """
+        Take tokens from the bucket.
+
+        Args:
+            amount (int): The number of tokens.
+
+        Returns:
+            float: How long to wait, in seconds, before the tokens are available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    def try_consume(self, amount: int = 1):
+        """
+        Take tokens from the bucket only if they are available now.
+
+        Args:
+            amount (int): The number of tokens.
+
+        Returns:
+            bool: True if the tokens were taken.
+        """
+        if self.reserve(amount) > 0:
+            self.tokens += amount
+            return False
+        return True
+
+    async def consume(self, amount: int):
+        """
+        Take tokens from the bucket, waiting until they are available.
+
+        Args:
+            amount (int): The number of tokens.
+        """
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class Meter:
+    """
+    Counts bytes and keeps a rate averaged over one-second windows.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.rate = 0.0
+        self.window = time.monotonic()
+        self.window_bytes = 0
+        self.streams = 0
+
+    def add(self, amount: int):
+        """
+        Count bytes sent.
+        """
+        self.total += amount
+        self.window_bytes += amount
+        self.roll()
+
+    def roll(self):
+        """
+        Start a new window once the current one is a second old.
+        """
+        now = time.monotonic()
+        elapsed = now - self.window
+        if elapsed >= 1:
+            self.rate = self.window_bytes / elapsed
+            self.window = now
+            self.window_bytes = 0
+
+    def snapshot(self):
+        """
+        The current rate, bytes counted and open streams.
+        """
+        self.roll()
+        return {"bytes_per_second": round(self.rate), "bytes_total": self.total, "streams": self.streams}
+
+
+class DownloadShaper:
+    """
+    Shapes file downloads with a global, a per-device-group and a per-client token bucket.
+
+    Every chunk waits for its client's bucket, then its group's, then the
+    global one. Since each stream only reserves its next chunk, clients
+    queued on the global bucket take turns chunk by chunk, and a client
+    opening many streams is still held to its own rate. A rate of 0
+    disables the matching bucket.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.meters = {}
+
+    def bucket(self, key, rate: int):
+        """
+        Get the bucket of a key, holding one second of traffic, or None if its rate is 0.
+        """
+        if not rate:
+            return None
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.rate != rate:
+            burst = max(rate, get_settings().download_chunk_size)
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def meter(self, key):
+        """
+        Get the meter of a key.
+        """
+        meter = self.meters.get(key)
+        if meter is None:
+            meter = self.meters[key] = Meter()
+        return meter
+
+    def release(self, key):
+        """
+        End a stream of a key, forgetting the key once it has no stream left.
+        """
+        meter = self.meters[key]
+        meter.streams -= 1
+        if meter.streams == 0 and key != "global":
+            del self.meters[key]
+            self.buckets.pop(key, None)
+
+    async def shape(self, chunks, client: str, group: int = None):
+        """
+        Stream chunks no faster than the configured rates.
+
+        Args:
+            chunks: A synchronous iterator of bytes, read in the thread pool.
+            client (str): The client identity, e.g. its address or device ID.
+            group (int): The device group of the client, if any.
+
+        Yields:
+            bytes: The chunks.
+        """
+        settings = get_settings()
+        keys = [("client", client)] + ([("group", group)] if group is not None else []) + ["global"]
+        rates = [settings.download_client_rate_limit, settings.download_group_rate_limit, settings.download_rate_limit]
+        if group is None:
+            rates.pop(1)
+        meters = [self.meter(key) for key in keys]
+        for meter in meters:
+            meter.streams += 1
+        try:
+            async for chunk in iterate_in_threadpool(chunks):
+                for key, rate in zip(keys, rates):
+                    bucket = self.bucket(key, rate)
+                    if bucket is not None:
+                        await bucket.consume(len(chunk))
+                for meter in meters:
+                    meter.add(len(chunk))
+                yield chunk
+        finally:
+            for key in keys:
+                self.release(key)
+
+    def stats(self):
+        """
+        The live download throughput, globally, per device group and per client.
+
+        Returns:
+            dict: The current rate, bytes served and open streams of each.
+        """
+        stats = {"global": self.meter("global").snapshot(), "groups": {}, "clients": {}}
+        for key, meter in list(self.meters.items()):
+            if key != "global":
+                stats[key[0] + "s"][str(key[1])] = meter.snapshot()
+        return stats
+
+
+downloads = DownloadShaper()
@@ -0,0 +1,429 @@
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from fastapi import HTTPException
+from ..settings import Settings, get_settings
+import anyio.to_thread
+import hashlib
+import os
+import tempfile
+
+# local path -> (mtime_ns, size, sha256), so unchanged files are only hashed once
+_digests = {}
+
+
+def check_name(name: str):
+    """
+    Reject file names that would escape the storage root.
+
+    Args:
+        name (str): The file name.
+
+    Returns:
+        str: The file name.
+    """
+    if not name or name in (".", "..") or os.path.basename(name) != name or "\\" in name:
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return name
+
+
+def hash_file(file, chunk_size: int):
+    """
+    Hash a file object from its current position to the end.
+
+    Args:
+        file: The file object.
+        chunk_size (int): The size of each read.
+
+    Returns:
+        str: The SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    while chunk := file.read(chunk_size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Storage(ABC):
+    """
+    Where deploy files are kept. Files are flat: names have no directory part.
+    """
+
+    @abstractmethod
+    def names(self):
+        """
+        List the stored file names.
+        """
+
+    @abstractmethod
+    def exists(self, name: str):
+        """
+        Whether a file is stored.
+        """
+
+    @abstractmethod
+    def size(self, name: str):
+        """
+        The size of a file in bytes.
+        """
+
+    @abstractmethod
+    def digest(self, name: str):
+        """
+        The SHA-256 of a file.
+        """
+
+    @abstractmethod
+    def open(self, name: str):
+        """
+        Open a file for streaming reads; the caller closes it.
+        """
+
+    @abstractmethod
+    def writer(self, name: str):
+        """
+        Start writing a file chunk by chunk; see Writer.
+        """
+
+    def save(self, name: str, file):
+        """
+        Store the content of a file object, replacing any file of the same name.
+
+        Args:
+            name (str): The file name.
+            file: A readable file object, positioned at the start.
+
+        Returns:
+            str: The SHA-256 of the stored content.
+        """
+        writer = self.writer(name)
+        try:
+            while chunk := file.read(get_settings().upload_chunk_size):
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    @abstractmethod
+    def delete(self, name: str):
+        """
+        Delete a file.
+
+        Returns:
+            bool: False if there was no such file.
+        """
+
+    def url(self, name: str):
+        """
+        A URL clients can download the file from directly, if the backend has one.
+
+        Returns:
+            str | None: The URL, or None to stream the file through the API.
+        """
+        return None
+
+
+class Writer(ABC):
+    """
+    A file being written. Nothing is visible under its name until commit().
+    """
+
+    def __init__(self, temp):
+        self.temp = temp
+        self.digest = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        """
+        Append a chunk.
+        """
+        self.digest.update(chunk)
+        self.temp.write(chunk)
+
+    @abstractmethod
+    def commit(self):
+        """
+        Publish the file.
+
+        Returns:
+            str: The SHA-256 of its content.
+        """
+
+    def abort(self):
+        """
+        Drop what was written.
+        """
+        self.temp.close()
+
+
+class LocalWriter(Writer):
+    """
+    Writes to a temporary file next to the target, fsynced then renamed over it.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".tmp", delete=False))
+        self.path = path
+
+    def commit(self):
+        try:
+            self.temp.flush()
+            os.fsync(self.temp.fileno())
+            self.temp.close()
+            os.replace(self.temp.name, self.path)
+        except BaseException:
+            self.abort()
+            raise
+        stat = os.stat(self.path)
+        _digests[self.path] = (stat.st_mtime_ns, stat.st_size, self.digest.hexdigest())
+        return self.digest.hexdigest()
+
+    def abort(self):
+        self.temp.close()
+        try:
+            os.remove(self.temp.name)
+        except FileNotFoundError:
+            pass
+
+
+class S3Writer(Writer):
+    """
+    Spools to a temporary file, uploaded with its SHA-256 in the metadata on commit.
+    """
+
+    def __init__(self, storage, name: str):
+        super().__init__(tempfile.SpooledTemporaryFile(max_size=get_settings().upload_chunk_size))
+        self.storage = storage
+        self.name = name
+
+    def commit(self):
+        try:
+            self.temp.seek(0)
+            self.storage.client.upload_fileobj(
+                self.temp, self.storage.bucket, self.storage.key(self.name),
+                ExtraArgs={"Metadata": {"sha256": self.digest.hexdigest()}}, Config=self.storage.transfer,
+            )
+        finally:
+            self.temp.close()
+        return self.digest.hexdigest()
+
+
+class LocalStorage(Storage):
+    """
+    Files in a directory of the local filesystem (DEPLOY_DIRECTORY).
+
+    Writes go to a temporary file that is fsynced, then renamed over the
+    target, so readers never see a partial file.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, name: str):
+        return os.path.join(self.directory, check_name(name))
+
+    def names(self):
+        return [name for name in os.listdir(self.directory)
+                if not name.startswith(".tmp") and os.path.isfile(os.path.join(self.directory, name))]
+
+    def exists(self, name: str):
+        return os.path.isfile(self.path(name))
+
+    def size(self, name: str):
+        return os.path.getsize(self.path(name))
+
+    def digest(self, name: str):
+        path = self.path(name)
+        stat = os.stat(path)
+        cached = _digests.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        with open(path, "rb") as file:
+            digest = hash_file(file, get_settings().upload_chunk_size)
+        _digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def open(self, name: str):
+        return open(self.path(name), "rb")
+
+    def writer(self, name: str):
+        return LocalWriter(self.path(name))
+
+    def delete(self, name: str):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class S3Storage(Storage):
+    """
+    Files in an S3-compatible bucket (AWS S3, MinIO, Ceph...), under S3_PREFIX.
+
+    Uploads above UPLOAD_CHUNK_SIZE are sent as multipart uploads. The
+    SHA-256 of each object is kept in its metadata. With
+    STORAGE_PRESIGNED_DOWNLOADS, file downloads are redirected to presigned
+    URLs so the bytes do not go through the API.
+
+    Requires boto3.
+    """
+
+    def __init__(self, settings: Settings):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = settings.s3_bucket
+        self.prefix = settings.s3_prefix
+        self.expiry = settings.s3_presign_expiry
+        self.presigned = settings.storage_presigned_downloads
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=settings.s3_endpoint_url,
+            region_name=settings.s3_region,
+            aws_access_key_id=settings.s3_access_key or None,
+            aws_secret_access_key=settings.s3_secret_key or None,
+        )
+        # S3 parts are at least 5 MiB
+        part_size = max(settings.upload_chunk_size, 5 * 1024 * 1024)
+        self.transfer = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)
+
+    def key(self, name: str):
+        return self.prefix + check_name(name)
+
+    def head(self, name: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def names(self):
+        names = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.prefix):
+            names.extend(item["Key"][len(self.prefix):] for item in page.get("Contents", []))
+        return [name for name in names if name and "/" not in name]
+
+    def exists(self, name: str):
+        return self.head(name) is not None
+
+    def size(self, name: str):
+        head = self.head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        return head["ContentLength"]
+
+    def digest(self, name: str):
+        head = self.head(name)
+        if head is None:
+            raise FileNotFoundError(name)
+        digest = head.get("Metadata", {}).get("sha256")
+        if digest is None:
+            # uploaded by another tool: hash it once and keep the result
+            with self.open(name) as file:
+                digest = hash_file(file, get_settings().download_chunk_size)
+            self.client.copy_object(
+                Bucket=self.bucket, Key=self.key(name), CopySource={"Bucket": self.bucket, "Key": self.key(name)},
+                Metadata={"sha256": digest}, MetadataDirective="REPLACE",
+            )
+        return digest
+
+    def open(self, name: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(name))["Body"]
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                raise FileNotFoundError(name)
+            raise
+
+    def writer(self, name: str):
+        # the digest goes in the object metadata, which is sent first
+        return S3Writer(self, check_name(name))
+
+    def delete(self, name: str):
+        if not self.exists(name):
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        return True
+
+    def url(self, name: str):
+        if not self.presigned:
+            return None
+        return self.client.generate_presigned_url("get_object", ExpiresIn=self.expiry, Params={
+            "Bucket": self.bucket,
+            "Key": self.key(name),
+            "ResponseContentDisposition": f'attachment; filename="{name}"',
+        })
+
+
+async def save_upload(storage: Storage, name: str, upload):
+    """
+    Store an uploaded file without holding a worker thread for the whole transfer.
+
+    The upload is read UPLOAD_CHUNK_SIZE bytes at a time; only the reads
+    from the spooled upload and the writes to storage use the thread pool,
+    one chunk at a time.
+
+    Args:
+        storage (Storage): The storage backend.
+        name (str): The file name.
+        upload (UploadFile): The uploaded file.
+
+    Returns:
+        str: The SHA-256 of the stored content.
+    """
+    chunk_size = get_settings().upload_chunk_size
+    writer = await anyio.to_thread.run_sync(storage.writer, name)
+    try:
+        while chunk := await upload.read(chunk_size):
+            await anyio.to_thread.run_sync(writer.write, chunk)
+    except BaseException:
+        await anyio.to_thread.run_sync(writer.abort)
+        raise
+    return await anyio.to_thread.run_sync(writer.commit)
+
+
+@lru_cache
+def _create_storage(settings: Settings):
+    if settings.storage_backend == "s3":
+        return S3Storage(settings)
+    os.makedirs(settings.deploy_directory, exist_ok=True)
+    return LocalStorage(settings.deploy_directory)
+
+
+def get_storage():
+    """
+    Get the storage backend selected by STORAGE_BACKEND.
+
+    Returns:
+        Storage: The storage of deploy files.
+    """
+    return _create_storage(get_settings())
+
+
+@lru_cache
+def _create_blob_storage(settings: Settings):
+    if settings.storage_backend == "s3":
+        storage = S3Storage(settings)
+        storage.prefix = settings.s3_prefix + "versions/"
+        return storage
+    directory = os.path.join(settings.deploy_directory, "versions")
+    os.makedirs(directory, exist_ok=True)
+    return LocalStorage(directory)
+
+
+def get_blob_storage():
+    """
+    Get the storage of package versions and deltas, named by content.
+
+    It is the "versions" directory (or key prefix) of the deploy storage,
+    which the deploy file listing leaves out.
+
+    Returns:
+        Storage: The storage of version blobs and deltas.
+    """
+    return _create_blob_storage(get_settings())
@@ -0,0 +1,284 @@
+from contextlib import contextmanager
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from ..db.database import Package, PackageVersion
+from ..settings import get_settings
+from .bundles import file_response
+from .changelog import record_change
+from .storage import get_blob_storage, get_storage, hash_file
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# package ID -> [lock, threads holding or waiting for it], see _single_flight
+_publish_locks = {}
+_locks_lock = threading.Lock()
+# names of the deltas being computed, and the cap on how many at a time
+_pending_deltas = set()
+_delta_slots = None
+
+
+def latest_version(session, package_id: int):
+    """
+    The newest version of a package.
+
+    Returns:
+        PackageVersion | None: The version, or None if the package has none.
+    """
+    return session.exec(
+        select(PackageVersion).where(PackageVersion.PACK_id == package_id).order_by(PackageVersion.PV_number.desc()).limit(1)
+    ).first()
+
+
+def find_version(session, package_id: int, number: int):
+    """
+    A version of a package by number.
+
+    Returns:
+        PackageVersion | None: The version, or None if there is no such version.
+    """
+    return session.exec(
+        select(PackageVersion).where(PackageVersion.PACK_id == package_id, PackageVersion.PV_number == number)
+    ).first()
+
+
+def _add_version(session, package_id: int, digest: str, size: int):
+    number = session.exec(
+        select(func.coalesce(func.max(PackageVersion.PV_number), 0)).where(PackageVersion.PACK_id == package_id)
+    ).one() + 1
+    version = PackageVersion(PACK_id=package_id, PV_number=number, PV_sha256=digest, PV_size=size)
+    session.add(version)
+    session.flush()
+    return version
+
+
+def publish_version(session, package: Package, file):
+    """
+    Store a new version of a package and make it the file deployed under the package name.
+
+    The content is kept in the blob storage under its SHA-256, so identical
+    builds are stored once. A package whose file predates versioning gets
+    that file recorded as its first version, so agents holding it receive a
+    delta too. Uploading the content of the latest version again creates
+    no version.
+
+    The deployed file is only replaced once the version is committed, from
+    the blob of the latest version, so it never holds content whose version
+    was rolled back.
+
+    Args:
+        session (Session): The database session, committed here.
+        package (Package): The package.
+        file: A readable, seekable file object with the new content.
+
+    Returns:
+        tuple[PackageVersion, bool] | None: The version and whether it was created,
+        or None if another upload created a version of the package at the same time.
+    """
+    storage = get_storage()
+    blobs = get_blob_storage()
+    digest = hash_file(file, get_settings().upload_chunk_size)
+    size = file.tell()
+    latest = latest_version(session, package.PACK_id)
+    if latest is not None and latest.PV_sha256 == digest:
+        _deploy_latest(session, package)
+        return latest, False
+    version = None
+    if latest is None and storage.exists(package.PACK_name):
+        current = storage.digest(package.PACK_name)
+        if not blobs.exists(current):
+            with storage.open(package.PACK_name) as source:
+                blobs.save(current, source)
+        version = _add_version(session, package.PACK_id, current, storage.size(package.PACK_name))
+        if current != digest:
+            version = None
+    if version is None:
+        file.seek(0)
+        if not blobs.exists(digest):
+            blobs.save(digest, file)
+        version = _add_version(session, package.PACK_id, digest, size)
+    record_change(session, "package", package.PACK_id, "update")
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return None
+    session.refresh(version)
+    _deploy_latest(session, package)
+    return version, True
+
+
+def _deploy_latest(session, package: Package):
+    # one upload at a time copies, each the version latest by then, so the
+    # last copy is of the latest version whatever order the commits came in
+    storage = get_storage()
+    blobs = get_blob_storage()
+    with _single_flight(_publish_locks, package.PACK_id):
+        latest = latest_version(session, package.PACK_id)
+        if storage.exists(package.PACK_name) and storage.digest(package.PACK_name) == latest.PV_sha256:
+            return
+        with blobs.open(latest.PV_sha256) as source:
+            storage.save(package.PACK_name, source)
+
+
+def delta_name(source: PackageVersion, target: PackageVersion):
+    """
+    The name of the delta from one version to another in the blob storage.
+    """
+    return f"{source.PV_sha256}-{target.PV_sha256}.zst"
+
+
+def window_log(source: PackageVersion, target: PackageVersion):
+    """
+    The zstd window log of the delta between two versions, to pass as `--long=` when applying it.
+    """
+    return max(10, (max(source.PV_size, target.PV_size) - 1).bit_length())
+
+
+@contextmanager
+def _single_flight(locks: dict, key):
+    # the lock of a key is dropped by the last thread holding or waiting for it
+    with _locks_lock:
+        entry = locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del locks[key]
+
+
+def make_delta(source: PackageVersion, target: PackageVersion):
+    """
+    Compute the delta from one version to another and store it in the blob storage.
+
+    The delta is a zstd frame compressed with the source version as raw
+    content dictionary, like `zstd --patch-from`; it is applied with
+    `zstd -d --patch-from=<source> --long=<window log>`. The source is held
+    in memory as the dictionary; the target is streamed through the
+    compressor into the storage.
+
+    Args:
+        source (PackageVersion): The version the agent holds.
+        target (PackageVersion): The version it needs.
+
+    Returns:
+        int: The size of the delta.
+    """
+    import zstandard
+
+    settings = get_settings()
+    blobs = get_blob_storage()
+    with blobs.open(source.PV_sha256) as file:
+        dictionary = zstandard.ZstdCompressionDict(file.read(), dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    params = zstandard.ZstdCompressionParameters.from_level(
+        settings.package_delta_level, window_log=window_log(source, target), enable_ldm=True
+    )
+    compressor = zstandard.ZstdCompressor(dict_data=dictionary, compression_params=params)
+    name = delta_name(source, target)
+    writer = blobs.writer(name)
+    try:
+        with blobs.open(target.PV_sha256) as file:
+            reader = compressor.stream_reader(file, size=target.PV_size)
+            while chunk := reader.read(settings.upload_chunk_size):
+                writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    size = blobs.size(name)
+    logger.info("Delta of package %d from version %d to %d: %d bytes for %d",
+                target.PACK_id, source.PV_number, target.PV_number, size, target.PV_size)
+    return size
+
+
+def _compute_delta(source: PackageVersion, target: PackageVersion):
+    name = delta_name(source, target)
+    try:
+        with _delta_slots:
+            make_delta(source, target)
+    except Exception:
+        logger.exception("Computing the delta %s failed", name)
+    finally:
+        with _locks_lock:
+            _pending_deltas.discard(name)
+
+
+def schedule_delta(source: PackageVersion, target: PackageVersion):
+    """
+    Compute a delta in a background thread, unless it is already being computed.
+
+    At most PACKAGE_DELTA_WORKERS deltas are computed at a time, each
+    holding its source version in memory.
+    """
+    global _delta_slots
+    name = delta_name(source, target)
+    with _locks_lock:
+        if name in _pending_deltas:
+            return
+        _pending_deltas.add(name)
+        if _delta_slots is None:
+            _delta_slots = threading.BoundedSemaphore(get_settings().package_delta_workers)
+    # detached copies: the request's session is closed by the time the thread runs
+    source, target = PackageVersion(**source.model_dump()), PackageVersion(**target.model_dump())
+    threading.Thread(target=_compute_delta, args=(source, target), name=f"delta-{name[:16]}", daemon=True).start()
+
+
+def get_delta(source: PackageVersion, target: PackageVersion):
+    """
+    The delta from one version to another, computed in the background on first request then kept.
+
+    Returns:
+        int | None: The size of the delta, or None when the full version should
+        be sent: zstandard is not installed, a version is larger than
+        PACKAGE_DELTA_MAX_SIZE, the delta is not computed yet, or it is not
+        smaller than the version.
+    """
+    if source.PV_number >= target.PV_number or max(source.PV_size, target.PV_size) > get_settings().package_delta_max_size:
+        return None
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return None
+    blobs = get_blob_storage()
+    name = delta_name(source, target)
+    if not blobs.exists(name):
+        schedule_delta(source, target)
+        return None
+    size = blobs.size(name)
+    return size if size < target.PV_size else None
+
+
+def version_response(session, package: Package, target: PackageVersion, from_version: int | None, client: str, group: int = None):
+    """
+    Send a version of a package: only the delta when the client holds an older version.
+
+    The response carries the version number in X-Package-Version and its
+    SHA-256 as ETag. A delta is marked by X-Delta-From, the version it
+    applies to, and X-Delta-Window-Log.
+
+    Args:
+        session (Session): The database session.
+        package (Package): The package.
+        target (PackageVersion): The version to send.
+        from_version (int | None): The version the client holds, if any.
+        client (str): The client downloading, for its rate limit.
+        group (int): The device group of the client, for its rate limit.
+
+    Returns:
+        StreamingResponse: The delta or the whole version.
+    """
+    blobs = get_blob_storage()
+    headers = {"X-Package-Version": str(target.PV_number)}
+    source = find_version(session, package.PACK_id, from_version) if from_version is not None else None
+    if source is not None and get_delta(source, target) is not None:
+        name = delta_name(source, target)
+        headers.update({"X-Delta-From": str(source.PV_number), "X-Delta-Window-Log": str(window_log(source, target))})
+        return file_response(blobs.open(name), blobs.size(name), f"{package.PACK_name}.{source.PV_number}-{target.PV_number}.zst",
+                             target.PV_sha256, client, group, headers)
+    return file_response(blobs.open(target.PV_sha256), target.PV_size, package.PACK_name, target.PV_sha256, client, group, headers)
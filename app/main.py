@@ -1,12 +1,34 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .routers import devices, device_groups, packages, package_groups, users, files
+from .routers import devices, device_groups, packages, package_groups, users, files, search, stats, agents, events, changes, deployments, deletions, exports, audit, profiles, cache_node
 from .db.database import create_db
 from .internal import auth
-from .dependencies import *
+from .internal.admission import AdmissionMiddleware
+from .internal.compression import CompressionMiddleware
+from .internal.profiling import ProfileMiddleware
+from .internal.agents import heartbeats
+from .internal.audit import audit_events, purge_periodically as purge_audit_periodically
+from .internal.cache_node import prefetch_periodically
+from .internal.changelog import purge_periodically
+from .internal.logger import audit_file_handler, logger
+from .internal.deployments import scheduler
+from .internal.deletions import deletions as deletion_worker
+from .internal.events import changes as change_feed
+from .internal.replicas import replicas
+from .dependencies import get_engine
+from .settings import get_settings
+import anyio.to_thread
+import asyncio
 
 app = FastAPI()
 
+app.add_middleware(CompressionMiddleware)
+if get_settings().node_mode != "cache":
+    # inside admission control, so time spent queued for a slot is not profiled
+    app.add_middleware(ProfileMiddleware)
+# added before CORS so that CORS wraps it and refusals carry its headers
+app.add_middleware(AdmissionMiddleware)
+
 origins = [
     "http://localhost:8000",
     "http://localhost:5173",
@@ -20,15 +42,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-app.include_router(devices.router)
-app.include_router(device_groups.router)
-app.include_router(packages.router)
-app.include_router(files.router)
-app.include_router(package_groups.router)
-app.include_router(users.router)
-app.include_router(auth.router)
+cache_mode = get_settings().node_mode == "cache"
+
+if cache_mode:
+    app.include_router(cache_node.router)
+else:
+    app.include_router(devices.router)
+    app.include_router(device_groups.router)
+    app.include_router(packages.router)
+    app.include_router(files.router)
+    app.include_router(package_groups.router)
+    app.include_router(users.router)
+    app.include_router(search.router)
+    app.include_router(stats.router)
+    app.include_router(agents.router)
+    app.include_router(events.router)
+    app.include_router(changes.router)
+    app.include_router(deployments.router)
+    app.include_router(deletions.router)
+    app.include_router(exports.router)
+    app.include_router(audit.router)
+    app.include_router(profiles.router)
+    app.include_router(auth.router)
 
 
 @app.on_event("startup")
 def on_startup():
-    create_db(engine)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = get_settings().threadpool_size
+    if not cache_mode:
+        create_db(get_engine())
+
+background_tasks = []
+log_handlers = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # attached here rather than on import, so set_settings() can change the file
+    file_handler = audit_file_handler(get_settings().audit_log_file)
+    if file_handler is not None:
+        logger.addHandler(file_handler)
+        log_handlers.append(file_handler)
+    if cache_mode:
+        background_tasks.append(asyncio.create_task(prefetch_periodically()))
+        return
+    background_tasks.append(asyncio.create_task(heartbeats.run()))
+    background_tasks.append(asyncio.create_task(change_feed.run()))
+    background_tasks.append(asyncio.create_task(purge_periodically()))
+    background_tasks.append(asyncio.create_task(scheduler.run()))
+    background_tasks.append(asyncio.create_task(deletion_worker.run()))
+    background_tasks.append(asyncio.create_task(replicas.run()))
+    logger.addHandler(audit_events)
+    background_tasks.append(asyncio.create_task(audit_events.run()))
+    background_tasks.append(asyncio.create_task(purge_audit_periodically()))
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    logger.removeHandler(audit_events)
+    for handler in log_handlers:
+        logger.removeHandler(handler)
+        handler.close()
+    log_handlers.clear()
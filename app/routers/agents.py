@@ -0,0 +1,247 @@
+from fastapi import Request, Header, HTTPException, APIRouter, Depends, Query, Response, status
+from typing import Annotated, Optional
+from pydantic import BaseModel, Field
+from sqlmodel import select
+from datetime import datetime
+from ..db.database import Device, DeploymentJob, DeploymentTarget
+from ..dependencies import SessionDep
+from ..internal.logger import logger
+from ..internal.agents import device_tokens, heartbeats
+from ..internal.bundles import manifest, zipfiles
+from ..internal.deployments import awaiting_wave, claim_target, device_package, fail_target, job_packages
+from ..internal.versions import latest_version, version_response
+
+router = APIRouter(
+    prefix="/agents",
+    tags=["agents"],
+    responses={404: {"description": "Not found"}},
+)
+
+class CheckIn(BaseModel):
+    DEV_id: int
+    packages: list[str] = Field(default=[], max_length=10000)
+
+class DeploymentResult(BaseModel):
+    success: bool
+
+async def get_current_device(request: Request, x_device_id: Annotated[int, Header()], x_device_token: Annotated[str, Header()]):
+    """
+    Authenticate a device agent from its X-Device-Id and X-Device-Token headers.
+
+    Args:
+        request (Request): The request sent.
+        x_device_id (int): The device ID.
+        x_device_token (str): The device token.
+
+    Returns:
+        int: The ID of the authenticated device.
+    """
+    if not await device_tokens.verify(x_device_id, x_device_token):
+        logger.warning("Invalid device token.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{x_device_id}"
+        })
+        raise HTTPException(status_code=401, detail="Invalid device token")
+    return x_device_id
+
+@router.post("/checkin", status_code=status.HTTP_202_ACCEPTED)
+async def check_in(check_in: CheckIn, request: Request, x_device_token: Annotated[str, Header()]):
+    """
+    Record a heartbeat from a device agent.
+
+    Agents authenticate with the token issued by `POST /devices/{device_id}/token`
+    in the `X-Device-Token` header. The check-in is buffered in memory and
+    written with the next batch, so the device status lags by up to
+    HEARTBEAT_FLUSH_INTERVAL seconds.
+
+    Args:
+        check_in (CheckIn): The device ID and the packages installed on it.
+        request (Request): The request sent.
+        x_device_token (str): The device token.
+
+    Returns:
+        dict: An acknowledgement.
+    """
+    if not await device_tokens.verify(check_in.DEV_id, x_device_token):
+        logger.warning("Invalid device token.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{check_in.DEV_id}"
+        })
+        raise HTTPException(status_code=401, detail="Invalid device token")
+    heartbeats.record(check_in.DEV_id, request.client.host if request.client else None, check_in.packages)
+    return {"detail": "Check-in accepted"}
+
+@router.get("/deployments")
+def read_released_deployments(session: SessionDep, device_id: int = Depends(get_current_device)):
+    """
+    List the deployment jobs that released this device and wait for its download.
+
+    Args:
+        session (SessionDep): The database session.
+        device_id (int): The authenticated device.
+
+    Returns:
+        list[int]: The IDs of the jobs to download with `/agents/deployments/{job_id}/bundle`.
+    """
+    return session.exec(
+        select(DeploymentTarget.DEPJ_id)
+        .where(DeploymentTarget.DEV_id == device_id, DeploymentTarget.DEPT_status == "ready")
+    ).all()
+
+@router.get("/deployments/{job_id}/bundle")
+def download_deployment(
+    job_id: int,
+    session: SessionDep,
+    request: Request,
+    device_id: int = Depends(get_current_device),
+    manifest_only: Annotated[bool, Query(alias="manifest")] = False
+):
+    """
+    Download the packages of a deployment job, once the scheduler released this device.
+
+    With `?manifest=true` the download is claimed the same way, but only the
+    file list is returned: cache nodes build the bundle from their local copies.
+
+    Args:
+        job_id (int): The ID of the job.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        device_id (int): The authenticated device.
+        manifest_only (bool): Return the file manifest instead of the archive.
+
+    Returns:
+        StreamingResponse: The zip archive containing the packages.
+    """
+    if not claim_target(session, job_id, device_id):
+        logger.warning("Deployment not released for device.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{device_id}"
+        })
+        raise HTTPException(status_code=409, detail="Deployment not released for this device")
+    job = session.get(DeploymentJob, job_id)
+    device = session.get(Device, device_id)
+    filenames = job_packages(session, job, device)
+    logger.warning("Deployment downloaded successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': f"device:{device_id}"
+    })
+    if manifest_only:
+        return {"DG_id": device.DG_id, "files": manifest(filenames)}
+    return zipfiles(filenames, f"device:{device_id}", device.DG_id)
+
+@router.post("/deployments/{job_id}/result")
+def report_deployment(job_id: int, result: DeploymentResult, session: SessionDep, request: Request, device_id: int = Depends(get_current_device)):
+    """
+    Report whether the packages of a deployment job were installed.
+
+    A failure is retried with exponential backoff until the job's
+    DEPJ_maxAttempts is reached.
+
+    Args:
+        job_id (int): The ID of the job.
+        result (DeploymentResult): The outcome.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        device_id (int): The authenticated device.
+
+    Returns:
+        Dict: A success message.
+    """
+    target = session.get(DeploymentTarget, (job_id, device_id))
+    if not target or target.DEPT_status != "downloading":
+        logger.warning("Deployment not in progress for device.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{device_id}"
+        })
+        raise HTTPException(status_code=409, detail="Deployment not in progress for this device")
+    if result.success:
+        target.DEPT_status = "done"
+        target.DEPT_updated = datetime.utcnow()
+        session.add(target)
+    else:
+        fail_target(session, target, session.get(DeploymentJob, job_id).DEPJ_maxAttempts)
+    session.commit()
+    logger.warning("Deployment result recorded.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success' if result.success else 'fail',
+        'current_user': f"device:{device_id}"
+    })
+    return {"detail": "Result recorded"}
+
+@router.get("/packages/{package_id}")
+def download_package(
+    package_id: int,
+    session: SessionDep,
+    request: Request,
+    device_id: int = Depends(get_current_device),
+    from_version: Optional[int] = None
+):
+    """
+    Download the latest version of a package, as a delta when the agent reports the version it holds.
+
+    Only the packages of the device, assigned to it or inherited from its
+    groups, are served; while a deployment job covering the package has not
+    released the device yet, the download waits for its wave (409).
+
+    An agent already on the latest version gets an empty 304 response. With
+    an older `from_version`, only the delta from it is sent when smaller, as
+    marked by the X-Delta-From header; the X-Package-Version header holds
+    the version the agent then has.
+
+    Args:
+        package_id (int): The ID of the package.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        device_id (int): The authenticated device.
+        from_version (int): The version installed on the device.
+
+    Returns:
+        StreamingResponse: The delta or the whole version.
+    """
+    package = device_package(session, device_id, package_id)
+    if not package:
+        logger.warning("Package not found for device.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{device_id}"
+        })
+        raise HTTPException(status_code=404, detail="Package not found")
+    if awaiting_wave(session, device_id, package):
+        logger.warning("Package held for a deployment wave.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{device_id}"
+        })
+        raise HTTPException(status_code=409, detail="Deployment not released for this device")
+    version = latest_version(session, package_id)
+    if not version:
+        logger.warning("Package version not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': f"device:{device_id}"
+        })
+        raise HTTPException(status_code=404, detail="Package has no version")
+    logger.warning("Package downloaded successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': f"device:{device_id}"
+    })
+    if from_version == version.PV_number:
+        return Response(status_code=304, headers={"ETag": f'"{version.PV_sha256}"', "X-Package-Version": str(version.PV_number)})
+    device = session.get(Device, device_id)
+    return version_response(session, package, version, from_version, f"device:{device_id}", device.DG_id if device else None)
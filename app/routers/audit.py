@@ -0,0 +1,83 @@
+from fastapi import Request, Depends, HTTPException, APIRouter, Query
+from typing import Annotated, Optional
+from datetime import datetime
+from ..db.database import User, AuditEvent
+from ..dependencies import ReadSessionDep, get_current_user
+from ..internal.logger import logger
+from ..internal.auth import verify_access
+from ..internal.audit import parse_cursor, search_events
+
+router = APIRouter(
+    prefix="/audit",
+    tags=["audit"],
+    responses={404: {"description": "Not found"}},
+)
+
+@router.get("/")
+def read_audit_events(
+    session: ReadSessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    user: Optional[str] = None,
+    method: Optional[str] = None,
+    route: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(gt=0, le=500)] = 100
+):
+    """
+    Search the audit events, newest first.
+
+    E.g. `?route=/devices/8/delete/&method=DELETE` tells who deleted device 8.
+    Pass the returned cursor to get the next page, until it is null.
+
+    Args:
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        user (str): Only the events of this user.
+        method (str): Only the requests with this HTTP method.
+        route (str): Only the requests to this path.
+        status (str): Only the events with this status, "success" or "fail".
+        since (datetime): Only the events at or after this UTC time.
+        until (datetime): Only the events before this UTC time.
+        cursor (str): The cursor returned by the previous page.
+        limit (int): The maximum number of events.
+
+    Returns:
+        Dict: The events and the cursor of the next page.
+    """
+    verify_access(0, current_user.USER_type)
+    conditions = []
+    if user is not None:
+        conditions.append(AuditEvent.AE_user == user)
+    if method is not None:
+        conditions.append(AuditEvent.AE_method == method.upper())
+    if route is not None:
+        conditions.append(AuditEvent.AE_route == route)
+    if status is not None:
+        conditions.append(AuditEvent.AE_status == status)
+    if since is not None:
+        conditions.append(AuditEvent.AE_time >= since)
+    if until is not None:
+        conditions.append(AuditEvent.AE_time < until)
+    try:
+        position = parse_cursor(cursor) if cursor is not None else None
+    except ValueError:
+        logger.warning("Invalid audit cursor.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+    events, next_cursor = search_events(session, conditions, position, limit)
+    logger.warning("Audit events read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"events": events, "cursor": next_cursor}
@@ -0,0 +1,82 @@
+from fastapi import Request, APIRouter
+from ..internal.bundles import file_response, zip_response
+from ..internal.cache_node import blobs, upstream, forwarded_headers
+import os
+
+# served instead of every other router when NODE_MODE=cache
+router = APIRouter(
+    tags=["cache"],
+    responses={404: {"description": "Not found"}},
+)
+
+def cached_bundle(entries: dict, headers: dict, client: str):
+    """
+    Zip the files of a manifest from the local cache, fetching the missing ones.
+
+    Args:
+        entries (dict): The manifest returned by the primary.
+        headers (dict): The credentials forwarded to the primary.
+        client (str): The client downloading the archive, for its rate limit.
+
+    Returns:
+        StreamingResponse: The zip archive.
+    """
+    files = entries["files"]
+    with blobs.pinned([entry["sha256"] for entry in files]):
+        paths = [(entry["name"], entry["size"], blobs.fetch(entry["name"], entry["sha256"], headers)) for entry in files]
+        return zip_response(
+            [(name, size, lambda path=path: open(path, "rb")) for name, size, path in paths], client, entries["DG_id"]
+        )
+
+@router.get("/devices/{device_id}/deploy")
+def download_packages(device_id: int, request: Request):
+    """
+    Download packages for a device, from the local cache.
+
+    The primary authorises the request and lists the files with their SHA-256.
+
+    Args:
+        device_id (int): The ID of the device.
+        request (Request): The request sent.
+
+    Returns:
+        StreamingResponse: The zip archive containing the packages.
+    """
+    headers = forwarded_headers(request)
+    entries = upstream.request("GET", f"/devices/{device_id}/manifest", headers).json()
+    return cached_bundle(entries, headers, request.client.host if request.client else "unknown")
+
+@router.get("/agents/deployments/{job_id}/bundle")
+def download_deployment(job_id: int, request: Request):
+    """
+    Download the packages of a deployment job, from the local cache.
+
+    The primary claims the download for the device and lists the files.
+
+    Args:
+        job_id (int): The ID of the job.
+        request (Request): The request sent.
+
+    Returns:
+        StreamingResponse: The zip archive containing the packages.
+    """
+    headers = forwarded_headers(request)
+    entries = upstream.request("GET", f"/agents/deployments/{job_id}/bundle", headers, params={"manifest": "true"}).json()
+    return cached_bundle(entries, headers, f"device:{request.headers.get('x-device-id')}")
+
+@router.get("/files/{filename}")
+def download_file(filename: str, request: Request):
+    """
+    Download one file, from the local cache once the primary confirmed it is current.
+
+    Args:
+        filename (str): The name of the file.
+        request (Request): The request sent.
+
+    Returns:
+        StreamingResponse: The file content.
+    """
+    path, digest = blobs.revalidate(filename, forwarded_headers(request))
+    with blobs.pinned([digest]):
+        file = open(path, "rb")
+    return file_response(file, os.fstat(file.fileno()).st_size, filename, digest, request.client.host if request.client else "unknown")
@@ -0,0 +1,87 @@
+from fastapi import Request, Depends, HTTPException, APIRouter, Query
+from typing import Annotated
+from ..db.database import User
+from ..dependencies import SessionDep, get_current_user
+from ..internal.logger import logger
+from ..internal.auth import verify_access
+from ..internal.changelog import read_changes, oldest_change, settled_cursor
+
+router = APIRouter(
+    prefix="/changes",
+    tags=["changes"],
+    responses={404: {"description": "Not found"}},
+)
+
+@router.get("/cursor")
+def read_change_cursor(session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Get the cursor to start following the changes from, before a full load.
+
+    Take the cursor, then read every device, device group, package and
+    package group from their list endpoints, then call `/changes/` with it.
+    Changes made during the load come again and apply as the same data.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The cursor.
+    """
+    verify_access(2, current_user.USER_type)
+    cursor = settled_cursor(session)
+    logger.warning("Change cursor read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"cursor": cursor}
+
+@router.get("/")
+def read_changes_since(
+    session: SessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    since: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(gt=0, le=5000)] = 1000
+):
+    """
+    Retrieve the devices, device groups, packages and package groups changed after a cursor.
+
+    Start with since=0, then pass the returned cursor to the next call until
+    has_more is false. Each changed row appears once with its current data;
+    deleted rows are returned as tombstones (op "delete", data null). Once
+    the change log retention purged entries, since=0 and older cursors get a
+    410: take a cursor from `/changes/cursor`, reload everything from the
+    list endpoints, then follow the changes from that cursor.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        since (int): The cursor returned by the previous call.
+        limit (int): The maximum number of change log entries to read.
+
+    Returns:
+        Dict: The changes, the next cursor and whether more changes are waiting.
+    """
+    verify_access(2, current_user.USER_type)
+    oldest = oldest_change(session)
+    if oldest is not None and since < oldest - 1:
+        logger.warning("Change cursor expired.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=410, detail="Cursor expired, a full resync is needed")
+    changes, cursor, has_more = read_changes(session, since, limit)
+    logger.warning("Changes read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"changes": changes, "cursor": cursor, "has_more": has_more}
@@ -0,0 +1,76 @@
+from fastapi import Request, Depends, HTTPException, APIRouter, Query
+from typing import Annotated
+from ..db.database import User, DeletionJob
+from ..dependencies import SessionDep, get_current_user
+from ..internal.logger import logger
+from sqlmodel import select
+from ..internal.auth import verify_access
+
+router = APIRouter(
+    prefix="/deletions",
+    tags=["deletions"],
+    responses={404: {"description": "Not found"}},
+)
+
+@router.get("/", response_model=list[DeletionJob])
+def read_deletions(
+    session: SessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    offset: int = 0,
+    limit: Annotated[int, Query(le=100)] = 100
+):
+    """
+    Retrieve the group deletion jobs, newest first.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        offset (int): The offset for pagination.
+        limit (int): The limit for pagination.
+
+    Returns:
+        List[DeletionJob]: A list of jobs.
+    """
+    verify_access(2, current_user.USER_type)
+    jobs = session.exec(select(DeletionJob).order_by(DeletionJob.DELJ_id.desc()).offset(offset).limit(limit)).all()
+    logger.warning("Deletions read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return jobs
+
+@router.get("/{job_id}/", response_model=DeletionJob)
+def read_deletion(job_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Retrieve a group deletion job and its progress.
+
+    Args:
+        job_id (int): The ID of the job.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        DeletionJob: The job, with DELJ_done out of DELJ_total rows processed.
+    """
+    verify_access(2, current_user.USER_type)
+    job = session.get(DeletionJob, job_id)
+    if not job:
+        logger.warning("Deletion not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Deletion not found")
+    logger.warning("Deletion read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return job
@@ -0,0 +1,193 @@
+from fastapi import Request, Depends, HTTPException, APIRouter, Query
+from typing import Annotated, Optional
+from pydantic import BaseModel, Field
+from sqlalchemy import update
+from ..db.database import User, DeviceGroup, PackageGroup, DeploymentJob, DeploymentTarget
+from ..dependencies import SessionDep, get_current_user
+from ..internal.logger import logger
+from sqlmodel import select
+from ..internal.auth import verify_access
+from ..internal.deletions import reject_deleted_groups
+from ..internal.deployments import create_targets, job_progress
+from datetime import datetime
+
+router = APIRouter(
+    prefix="/deployments",
+    tags=["deployments"],
+    responses={404: {"description": "Not found"}},
+)
+
+class DeploymentCreate(BaseModel):
+    # validated here: table models skip the Field constraints of DeploymentJob
+    DG_id: Optional[int] = None
+    PG_id: Optional[int] = None
+    DEPJ_waveSize: int = Field(default=50, gt=0)
+    DEPJ_maxInFlight: int = Field(default=20, gt=0)
+    DEPJ_bandwidthLimit: Optional[int] = Field(default=None, gt=0)
+    DEPJ_maxAttempts: int = Field(default=3, gt=0)
+
+@router.post("/")
+def create_deployment(deployment: DeploymentCreate, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Schedule the deployment of a device group or a package group.
+
+    Set exactly one of DG_id or PG_id. The target devices are split into waves
+    of DEPJ_waveSize devices, released at most DEPJ_maxInFlight at a time.
+
+    Args:
+        deployment (DeploymentCreate): The job to create.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The created job and its number of target devices.
+    """
+    verify_access(1, current_user.USER_type)
+    job = DeploymentJob(**deployment.model_dump())
+    if (job.DG_id is None) == (job.PG_id is None):
+        logger.warning("Deployment needs one target group.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=400, detail="Set exactly one of DG_id or PG_id")
+    group = session.get(DeviceGroup, job.DG_id) if job.DG_id is not None else session.get(PackageGroup, job.PG_id)
+    if not group:
+        logger.warning("Group not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="group not found")
+    reject_deleted_groups(session, DG_id=job.DG_id, PG_id=job.PG_id)
+    session.add(job)
+    session.flush()
+    targets = create_targets(session, job)
+    session.commit()
+    session.refresh(job)
+    logger.warning("Deployment created successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"job": job, "targets": targets}
+
+@router.get("/", response_model=list[DeploymentJob])
+def read_deployments(
+    session: SessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    offset: int = 0,
+    limit: Annotated[int, Query(le=100)] = 100
+):
+    """
+    Retrieve the deployment jobs, newest first.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        offset (int): The offset for pagination.
+        limit (int): The limit for pagination.
+
+    Returns:
+        List[DeploymentJob]: A list of jobs.
+    """
+    verify_access(2, current_user.USER_type)
+    jobs = session.exec(select(DeploymentJob).order_by(DeploymentJob.DEPJ_id.desc()).offset(offset).limit(limit)).all()
+    logger.warning("Deployments read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return jobs
+
+@router.get("/{job_id}/")
+def read_deployment(job_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Retrieve a deployment job and its progress.
+
+    Args:
+        job_id (int): The ID of the job.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The job and the number of target devices per state.
+    """
+    verify_access(2, current_user.USER_type)
+    job = session.get(DeploymentJob, job_id)
+    if not job:
+        logger.warning("Deployment not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Deployment not found")
+    logger.warning("Deployment read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"job": job, "progress": job_progress(session, job_id)}
+
+@router.post("/{job_id}/cancel")
+def cancel_deployment(job_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Cancel a pending or running deployment job. Devices already downloading finish their download.
+
+    Args:
+        job_id (int): The ID of the job.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: A success message.
+    """
+    verify_access(1, current_user.USER_type)
+    now = datetime.utcnow()
+    # conditional, so a job the scheduler just finished keeps its final state
+    cancelled = session.exec(
+        update(DeploymentJob)
+        .where(DeploymentJob.DEPJ_id == job_id, DeploymentJob.DEPJ_status.in_(("pending", "running")))
+        .values(DEPJ_status="cancelled", DEPJ_updated=now)
+    ).rowcount
+    if not cancelled:
+        session.rollback()
+        if not session.get(DeploymentJob, job_id):
+            logger.warning("Deployment not found.", extra={
+                'method': request.method,
+                'url': request.url.path,
+                'status': 'fail',
+                'current_user': current_user.USER_username
+            })
+            raise HTTPException(status_code=404, detail="Deployment not found")
+        logger.warning("Deployment already finished.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=409, detail="Deployment is not pending or running")
+    session.exec(
+        update(DeploymentTarget)
+        .where(DeploymentTarget.DEPJ_id == job_id, DeploymentTarget.DEPT_status.in_(("waiting", "ready")))
+        .values(DEPT_status="cancelled", DEPT_updated=now)
+    )
+    session.commit()
+    logger.warning("Deployment cancelled successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"detail": "Deployment cancelled successfully"}
@@ -1,10 +1,18 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, Query, status, APIRouter
-from typing import Annotated
-from ..db.database import User, DeviceGroup
-from ..dependencies import SessionDep, engine, get_current_user
+from fastapi import Request, Depends, HTTPException, APIRouter
+from typing import Optional
+from pydantic import BaseModel
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+from ..db.database import User, Device, DeviceGroup, DeviceGroupClosure, Package
+from ..dependencies import ReadSessionDep, SessionDep, get_current_user
 from ..internal.logger import logger
 from sqlmodel import select
 from ..internal.auth import verify_access
+from ..internal import crud
+from ..internal.bundles import manifest
+from ..internal.deletions import reject_deleted_groups, start_deletion
+from ..internal.expand import parse_expand, expand_options, dump_expanded
+from ..internal import groups
 
 router = APIRouter(
     prefix="/devicegroups",
@@ -12,22 +20,43 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+class GroupMove(BaseModel):
+    parent_id: Optional[int] = None
+
+def check_group(session, device_group_id: int, request: Request, current_user: User):
+    """
+    Raise a 404 error if a device group does not exist.
+    """
+    if not session.get(DeviceGroup, device_group_id):
+        logger.warning("Device group not found", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="device group not found")
+
 @router.post("/")
-def create_device_group(device_group: DeviceGroup, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+def create_device_group(device_group: DeviceGroup, session: SessionDep, request: Request, current_user: User = Depends(get_current_user), parent_id: Optional[int] = None):
     """
-    Create a new device group.
+    Create a new device group, at the root or nested in another group.
 
     Args:
         device_group (DeviceGroup): The device group to create.
         session (SessionDep): The database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        parent_id (int): The group to nest it in.
 
     Returns:
         DeviceGroup: The created device group.
     """
     verify_access(1, current_user.USER_type)
-    if session.get(DeviceGroup, device_group.DG_id):
+    if parent_id is not None:
+        check_group(session, parent_id, request, current_user)
+        reject_deleted_groups(session, DG_id=parent_id)
+    device_group = groups.create_group(session, device_group, parent_id)
+    if not device_group:
         logger.warning("Device group id already exists", extra={
             'method': request.method,
             'url': request.url.path,
@@ -35,9 +64,6 @@ def create_device_group(device_group: DeviceGroup, session: SessionDep, request:
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=400, detail="Device group id already exists")
-    session.add(device_group)
-    session.commit()
-    session.refresh(device_group)
     logger.warning("Device group created successfully", extra={
         'method': request.method,
         'url': request.url.path,
@@ -46,44 +72,49 @@ def create_device_group(device_group: DeviceGroup, session: SessionDep, request:
     })
     return device_group
 
-@router.get("/", response_model=list[DeviceGroup])
-def read_device_groups(session: SessionDep, request: Request, current_user: User = Depends(get_current_user)) -> list[DeviceGroup]:
+@router.get("/")
+def read_device_groups(session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Read all device groups.
 
     Args:
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: devices, packages.
 
     Returns:
         list[DeviceGroup]: A list of device groups.
     """
     verify_access(2, current_user.USER_type)
+    names = parse_expand(DeviceGroup, expand)
+    device_groups = session.exec(select(DeviceGroup).options(*expand_options(DeviceGroup, names))).all()
     logger.warning("Reading all device groups", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return session.exec(select(DeviceGroup)).all()
+    return [dump_expanded(device_group, names) for device_group in device_groups]
 
 @router.get("/{device_group_id}/")
-def read_device_group(device_group_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+def read_device_group(device_group_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Read a specific device group by ID.
 
     Args:
         device_group_id (int): The ID of the device group to read.
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: devices, packages.
 
     Returns:
         DeviceGroup: The device group with the specified ID.
     """
     verify_access(2, current_user.USER_type)
-    device_group = session.get(DeviceGroup, device_group_id)
+    names = parse_expand(DeviceGroup, expand)
+    device_group = session.get(DeviceGroup, device_group_id, options=expand_options(DeviceGroup, names))
     if not device_group:
         logger.warning("Device group not found", extra={
             'method': request.method,
@@ -98,7 +129,7 @@ def read_device_group(device_group_id: int, session: SessionDep, request: Reques
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return device_group
+    return dump_expanded(device_group, names)
 
 @router.put("/{device_group_id}/")
 def update_device_group(device_group_id: int, device_group: DeviceGroup, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
@@ -116,7 +147,7 @@ def update_device_group(device_group_id: int, device_group: DeviceGroup, session
         DeviceGroup: The updated device group.
     """
     verify_access(1, current_user.USER_type)
-    db_device_group = session.get(DeviceGroup, device_group_id)
+    db_device_group = crud.update(session, DeviceGroup, device_group_id, crud.sent_fields(device_group, ["DG_libelle"]), "devicegroup")
     if not db_device_group:
         logger.warning("Device group not found", extra={
             'method': request.method,
@@ -125,11 +156,6 @@ def update_device_group(device_group_id: int, device_group: DeviceGroup, session
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="device group not found")
-
-    db_device_group.DG_libelle = device_group.DG_libelle
-    session.add(db_device_group)
-    session.commit()
-    session.refresh(db_device_group)
     logger.warning("Device group updated successfully", extra={
         'method': request.method,
         'url': request.url.path,
@@ -138,10 +164,13 @@ def update_device_group(device_group_id: int, device_group: DeviceGroup, session
     })
     return db_device_group
 
-@router.delete("/{device_group_id}/delete/")
+@router.delete("/{device_group_id}/delete/", status_code=202)
 def delete_device_group(device_group_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
-    Delete a specific device group by ID.
+    Queue the deletion of a device group. Groups nested in it must be moved or deleted first.
+
+    Its devices and packages are detached from it and its deployments
+    removed in the background, batch by batch, then the group is deleted.
 
     Args:
         device_group_id (int): The ID of the device group to delete.
@@ -150,11 +179,88 @@ def delete_device_group(device_group_id: int, session: SessionDep, request: Requ
         current_user (User): the user who does the request
 
     Returns:
-        dict: A message indicating the success of the deletion.
+        DeletionJob: The deletion job, to follow with `GET /deletions/{id}/`.
     """
     verify_access(1, current_user.USER_type)
-    device_group = session.get(DeviceGroup, device_group_id)
-    if not device_group:
+    check_group(session, device_group_id, request, current_user)
+    if groups.has_children(session, device_group_id):
+        logger.warning("Device group has subgroups", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=409, detail="device group has subgroups")
+    job = start_deletion(session, "devicegroup", device_group_id, current_user.USER_username)
+    logger.warning("Device group deletion queued", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return job
+
+@router.put("/{device_group_id}/move")
+def move_device_group(device_group_id: int, move: GroupMove, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Move a device group, with the groups nested in it, below another group or to the root.
+
+    Args:
+        device_group_id (int): The ID of the device group to move.
+        move (GroupMove): The new parent, null for the root.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        dict: The group and its new parent.
+    """
+    verify_access(1, current_user.USER_type)
+    check_group(session, device_group_id, request, current_user)
+    if move.parent_id is not None:
+        check_group(session, move.parent_id, request, current_user)
+        reject_deleted_groups(session, DG_id=move.parent_id)
+    if not groups.move_group(session, device_group_id, move.parent_id):
+        logger.warning("Device group moved under itself", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=400, detail="A device group cannot be moved under itself")
+    logger.warning("Device group moved successfully", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"DG_id": device_group_id, "parent_id": move.parent_id}
+
+@router.get("/{device_group_id}/subtree")
+def read_device_group_subtree(device_group_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read a device group and all the groups nested under it, at any depth.
+
+    Args:
+        device_group_id (int): The ID of the device group.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        list[dict]: Each group with its depth below the group read and its parent, shallowest first.
+    """
+    verify_access(2, current_user.USER_type)
+    link = aliased(DeviceGroupClosure)
+    parent_link = aliased(DeviceGroupClosure)
+    rows = session.exec(
+        select(DeviceGroup, link.DGC_depth, parent_link.DGC_ancestor)
+        .join(link, link.DGC_descendant == DeviceGroup.DG_id)
+        .outerjoin(parent_link, (parent_link.DGC_descendant == DeviceGroup.DG_id) & (parent_link.DGC_depth == 1))
+        .where(link.DGC_ancestor == device_group_id)
+        .order_by(link.DGC_depth, DeviceGroup.DG_id)
+    ).all()
+    if not rows:
         logger.warning("Device group not found", extra={
             'method': request.method,
             'url': request.url.path,
@@ -162,13 +268,104 @@ def delete_device_group(device_group_id: int, session: SessionDep, request: Requ
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="device group not found")
+    logger.warning("Device group subtree read successfully", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return [{**group.model_dump(), "depth": depth, "parent_id": parent_id} for group, depth, parent_id in rows]
+
+@router.get("/{device_group_id}/ancestors")
+def read_device_group_ancestors(device_group_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the groups a device group is nested in, from the root down to the group itself.
+
+    Args:
+        device_group_id (int): The ID of the device group.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
 
-    session.delete(device_group)
-    session.commit()
-    logger.warning("Device group deleted successfully", extra={
+    Returns:
+        list[DeviceGroup]: The path of the group.
+    """
+    verify_access(2, current_user.USER_type)
+    path = session.exec(
+        select(DeviceGroup)
+        .join(DeviceGroupClosure, DeviceGroupClosure.DGC_ancestor == DeviceGroup.DG_id)
+        .where(DeviceGroupClosure.DGC_descendant == device_group_id)
+        .order_by(DeviceGroupClosure.DGC_depth.desc())
+    ).all()
+    if not path:
+        logger.warning("Device group not found", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="device group not found")
+    logger.warning("Device group ancestors read successfully", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return path
+
+@router.get("/{device_group_id}/devices")
+def read_device_group_devices(device_group_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the devices of a device group and of all the groups nested under it.
+
+    Args:
+        device_group_id (int): The ID of the device group.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        list[Device]: The devices.
+    """
+    verify_access(2, current_user.USER_type)
+    devices = session.exec(groups.subtree_devices(device_group_id).order_by(Device.DEV_id)).all()
+    logger.warning("Device group devices read successfully", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return devices
+
+@router.get("/{device_group_id}/manifest")
+def read_package_manifest(device_group_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Describe the files of the packages the devices of a device group get: assigned to them,
+    to the group, to the groups above it or to the groups nested under it.
+
+    Cache nodes use it to prefetch the files of their local device groups.
+
+    Args:
+        device_group_id (int): The ID of the device group.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The device group and the name, size and SHA-256 of each file.
+    """
+    verify_access(3, current_user.USER_type)
+    filenames = session.exec(
+        select(Package.PACK_name).distinct().where(or_(
+            Package.DG_id.in_(groups.ancestors(device_group_id)),
+            Package.DG_id.in_(groups.subtree(device_group_id)),
+            Package.DEV_id.in_(select(Device.DEV_id).where(Device.DG_id.in_(groups.subtree(device_group_id)))),
+        ))
+    ).all()
+    logger.warning("Package manifest read successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return {"detail": "DeviceGroup deleted successfully"}
+    return {"DG_id": device_group_id, "files": manifest(filenames)}
@@ -1,16 +1,19 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, Query, status, APIRouter
-from typing import Annotated
-from ..db.database import User, Device, User, Package
-from ..dependencies import SessionDep, engine, get_current_user
+from fastapi import Request, Depends, HTTPException, Query, APIRouter
+from typing import Annotated, Optional
+from pydantic import BaseModel
+from sqlalchemy import delete, update
+from ..db.database import User, Device, DeviceGroup, DeviceStatus, DeviceToken, DeploymentTarget, Package
+from ..dependencies import ReadSessionDep, SessionDep, get_current_user
 from ..internal.logger import logger
 from sqlmodel import select
-
-from fastapi.responses import FileResponse
 from ..internal.auth import verify_access
-import os
-import zipfile as zf
-import io
-from fastapi.responses import StreamingResponse
+from ..internal.changelog import record_bulk_change
+from ..internal import crud
+from ..internal.agents import new_device_token, device_tokens
+from ..internal.bundles import manifest, zipfiles
+from ..internal.deletions import reject_deleted_groups
+from ..internal.expand import parse_expand, expand_options, dump_expanded
+from ..internal.groups import inherited_packages
 
 router = APIRouter(
     prefix="/devices",
@@ -18,36 +21,51 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+class DeviceFilter(BaseModel):
+    DEV_os: Optional[str] = None
+    DG_id: Optional[int] = None
+
+class DeviceGroupAssignment(BaseModel):
+    DG_id: Optional[int]
+    DEV_ids: Optional[list[int]] = None
+    filter: Optional[DeviceFilter] = None
+
 @router.get("/")
 def read_devices(
-    session: SessionDep,
+    session: ReadSessionDep,
     request: Request,
     current_user: User = Depends(get_current_user),
     offset: int = 0,
-    limit: Annotated[int, Query(le=100)] = 100
+    limit: Annotated[int, Query(le=100)] = 100,
+    expand: Optional[str] = None
 ):
     """
     Retrieve a list of devices with pagination.
 
+    `?expand=group,packages` includes the device group and the packages of
+    each device, read with one extra query per collection for the whole page.
+
     Args:
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
         offset (int): The offset for pagination.
         limit (int): The limit for pagination.
+        expand (str): Comma-separated relationships to include: group, packages.
 
     Returns:
         List[Device]: A list of devices.
     """
     verify_access(2, current_user.USER_type)
-    devices = session.exec(select(Device).offset(offset).limit(limit)).all()
+    names = parse_expand(Device, expand)
+    devices = session.exec(select(Device).options(*expand_options(Device, names)).offset(offset).limit(limit)).all()
     logger.warning("Devices read successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return devices
+    return [dump_expanded(device, names) for device in devices]
 
 @router.post("/")
 def create_device(device: Device, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
@@ -64,7 +82,9 @@ def create_device(device: Device, session: SessionDep, request: Request, current
         Device: The created device.
     """
     verify_access(3, current_user.USER_type)
-    if session.get(Device, device.DEV_id):
+    reject_deleted_groups(session, DG_id=device.DG_id)
+    device = crud.create(session, device, "device")
+    if not device:
         logger.warning("Device id already exists.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -72,9 +92,6 @@ def create_device(device: Device, session: SessionDep, request: Request, current
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=400, detail="Device id already exists")
-    session.add(device)
-    session.commit()
-    session.refresh(device)
     logger.warning("Device created successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -84,21 +101,23 @@ def create_device(device: Device, session: SessionDep, request: Request, current
     return device
 
 @router.get("/{device_id}/")
-def read_device(device_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+def read_device(device_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Retrieve a device by its ID.
 
     Args:
         device_id (int): The ID of the device.
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: group, packages.
 
     Returns:
         Device: The retrieved device.
     """
     verify_access(2, current_user.USER_type)
-    device = session.get(Device, device_id)
+    names = parse_expand(Device, expand)
+    device = session.get(Device, device_id, options=expand_options(Device, names))
     if not device:
         logger.warning("Device not found.", extra={
             'method': request.method,
@@ -113,7 +132,7 @@ def read_device(device_id: int, session: SessionDep, request: Request, current_u
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return device
+    return dump_expanded(device, names)
 
 @router.put("/{device_id}/")
 def update_device(device_id: int, device: Device, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
@@ -131,7 +150,9 @@ def update_device(device_id: int, device: Device, session: SessionDep, request:
         Device: The updated device.
     """
     verify_access(3, current_user.USER_type)
-    db_device = session.get(Device, device_id)
+    values = crud.sent_fields(device, ["DEV_name", "DEV_os", "DG_id"])
+    reject_deleted_groups(session, DG_id=values.get("DG_id"))
+    db_device = crud.update(session, Device, device_id, values, "device")
     if not db_device:
         logger.warning("Device not found.", extra={
             'method': request.method,
@@ -140,12 +161,6 @@ def update_device(device_id: int, device: Device, session: SessionDep, request:
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="Device not found")
-    db_device.DEV_name = device.DEV_name
-    db_device.DEV_os = device.DEV_os
-    db_device.DG_id = device.DG_id
-    session.add(db_device)
-    session.commit()
-    session.refresh(db_device)
     logger.warning("Device updated successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -157,7 +172,9 @@ def update_device(device_id: int, device: Device, session: SessionDep, request:
 @router.delete("/{device_id}/delete/")
 def delete_device(device_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
-    Delete a device by its ID.
+    Delete a device by its ID, with its agent token, its status and its deployment targets.
+
+    Packages assigned to the device are kept, detached from it.
 
     Args:
         device_id (int): The ID of the device to delete.
@@ -169,8 +186,13 @@ def delete_device(device_id: int, session: SessionDep, request: Request, current
         Dict: A success message.
     """
     verify_access(1, current_user.USER_type)
-    device = session.get(Device, device_id)
-    if not device:
+    # in the same transaction as the device row; tables created before the
+    # foreign keys cascaded still need it
+    for model in (DeviceToken, DeviceStatus, DeploymentTarget):
+        session.exec(delete(model).where(model.DEV_id == device_id))
+    record_bulk_change(session, "package", [Package.DEV_id == device_id])
+    session.exec(update(Package).where(Package.DEV_id == device_id).values(DEV_id=None).execution_options(synchronize_session=False))
+    if not crud.delete(session, Device, device_id, "device"):
         logger.warning("Device not found.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -178,8 +200,7 @@ def delete_device(device_id: int, session: SessionDep, request: Request, current
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="Device not found")
-    session.delete(device)
-    session.commit()
+    device_tokens.forget(device_id)
     logger.warning("Device deleted successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -188,25 +209,157 @@ def delete_device(device_id: int, session: SessionDep, request: Request, current
     })
     return {"detail": "Device deleted successfully"}
 
-def zipfiles(filenames):
+@router.post("/{device_id}/token")
+def issue_device_token(device_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Issue a new agent token for a device, replacing the previous one.
+
+    The token is only returned here; the database keeps its hash.
+
+    Args:
+        device_id (int): The ID of the device.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The device ID and its new token.
+    """
+    verify_access(1, current_user.USER_type)
+    if not session.get(Device, device_id):
+        logger.warning("Device not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Device not found")
+    token, token_hash = new_device_token()
+    device_token = session.get(DeviceToken, device_id) or DeviceToken(DEV_id=device_id)
+    device_token.DT_tokenHash = token_hash
+    session.add(device_token)
+    session.commit()
+    device_tokens.forget(device_id)
+    logger.warning("Device token issued successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"DEV_id": device_id, "token": token}
+
+@router.get("/{device_id}/status/", response_model=DeviceStatus)
+def read_device_status(device_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Retrieve the last check-in of a device.
+
+    Args:
+        device_id (int): The ID of the device.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        DeviceStatus: When the device was last seen, from where, and its installed packages.
+    """
+    verify_access(2, current_user.USER_type)
+    device_status = session.get(DeviceStatus, device_id)
+    if not device_status:
+        logger.warning("Device status not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Device has never checked in")
+    logger.warning("Device status read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return device_status
+
+@router.get("/{device_id}/packages")
+def read_device_packages(device_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Retrieve the packages of a device: assigned to it, or inherited from its group and every group above it.
+
+    Args:
+        device_id (int): The ID of the device.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        List[Package]: The packages.
+    """
+    verify_access(2, current_user.USER_type)
+    packages = session.exec(inherited_packages(device_id).order_by(Package.PACK_id)).all()
+    logger.warning("Device packages read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return packages
+
+@router.put("/bulk/group/")
+def assign_devices_to_group(assignment: DeviceGroupAssignment, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
-    Create a zip archive from a list of filenames.
+    Move many devices to a device group in one UPDATE statement.
+
+    Devices are selected by ID, by filter, or both. Only the filter fields
+    that are sent are applied, so `{"DG_id": null}` selects ungrouped devices.
 
     Args:
-        filenames (List[str]): The list of filenames to include in the zip archive.
+        assignment (DeviceGroupAssignment): The target group and the devices to move.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
 
     Returns:
-        StreamingResponse: The zip archive as a streaming response.
-    """
-    zip_io = io.BytesIO()
-    with zf.ZipFile(zip_io, mode='w', compression=zf.ZIP_DEFLATED) as temp_zip:
-        for name in filenames:
-            temp_zip.write(f"db/deploy/{name}")
-    return StreamingResponse(
-        iter([zip_io.getvalue()]),
-        media_type="application/x-zip-compressed",
-        headers = { "Content-Disposition": f"attachment; filename=archive.zip"}
+        Dict: The number of devices updated.
+    """
+    verify_access(3, current_user.USER_type)
+    conditions = []
+    if assignment.DEV_ids is not None:
+        conditions.append(Device.DEV_id.in_(assignment.DEV_ids))
+    if assignment.filter is not None:
+        for field in assignment.filter.model_fields_set:
+            conditions.append(getattr(Device, field) == getattr(assignment.filter, field))
+    if not conditions:
+        logger.warning("No devices selected.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=400, detail="No devices selected")
+    if assignment.DG_id is not None and not session.get(DeviceGroup, assignment.DG_id):
+        logger.warning("Device group not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="device group not found")
+    reject_deleted_groups(session, DG_id=assignment.DG_id)
+    record_bulk_change(session, "device", conditions)
+    result = session.exec(
+        update(Device)
+        .where(*conditions)
+        .values(DG_id=assignment.DG_id)
+        .execution_options(synchronize_session=False)
     )
+    session.commit()
+    logger.warning("Devices assigned to group successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"updated": result.rowcount}
 
 @router.get("/{device_id}/deploy")
 def download_packages(device_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
@@ -232,4 +385,32 @@ def download_packages(device_id: int, session: SessionDep, request: Request, cur
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return zipfiles(filepaths)
+    device = session.get(Device, device_id)
+    return zipfiles(filepaths, request.client.host if request.client else "unknown", device.DG_id if device else None)
+
+@router.get("/{device_id}/manifest")
+def read_package_manifest(device_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Describe the files `/devices/{device_id}/deploy` bundles, without sending them.
+
+    Cache nodes use it to build the bundle from their local copies.
+
+    Args:
+        device_id (int): The ID of the device.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The device group of the device and the name, size and SHA-256 of each file.
+    """
+    verify_access(3, current_user.USER_type)
+    device = session.get(Device, device_id)
+    filenames = [package.PACK_name for package in session.exec(select(Package).where(Package.DEV_id == device_id))]
+    logger.warning("Package manifest read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"DG_id": device.DG_id if device else None, "files": manifest(filenames)}
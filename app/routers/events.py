@@ -0,0 +1,118 @@
+from fastapi import Request, Depends, APIRouter, Query, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session
+from typing import Annotated, Optional
+from ..db.database import User
+from ..dependencies import get_current_user, get_engine
+from ..internal.logger import logger
+from ..internal.auth import verify_access
+from ..internal.events import changes
+from ..settings import get_settings
+import asyncio
+
+router = APIRouter(
+    prefix="/events",
+    tags=["events"],
+    responses={404: {"description": "Not found"}},
+)
+
+def parse_topics(topics: Optional[str]):
+    """
+    Parse a comma separated list of entities.
+
+    Args:
+        topics (Optional[str]): e.g. "device,devicegroup", or None for all entities.
+
+    Returns:
+        set[str] | None: The entities to subscribe to.
+    """
+    if not topics:
+        return None
+    return {topic.strip() for topic in topics.split(",") if topic.strip()}
+
+@router.get("/stream")
+async def stream_changes(request: Request, current_user: User = Depends(get_current_user), topics: Optional[str] = None):
+    """
+    Stream create, update and delete events as Server-Sent Events.
+
+    Args:
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        topics (Optional[str]): The entities to receive, comma separated: device,
+            devicegroup, package, packagegroup. All of them by default.
+
+    Returns:
+        StreamingResponse: The event stream.
+    """
+    verify_access(2, current_user.USER_type)
+    subscription = await changes.subscribe(parse_topics(topics))
+    logger.warning("Change stream opened.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+
+    async def event_stream():
+        keepalive = get_settings().events_keepalive
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {event}\n\n"
+        finally:
+            changes.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.websocket("/ws")
+async def websocket_changes(websocket: WebSocket, token: Annotated[str, Query()], topics: Optional[str] = None):
+    """
+    Send create, update and delete events over a WebSocket.
+
+    Browsers cannot set headers on WebSockets, so the access token is passed
+    in the query string.
+
+    Args:
+        websocket (WebSocket): The client connection.
+        token (str): The access token.
+        topics (Optional[str]): The entities to receive, comma separated. All of them by default.
+    """
+    def authenticate():
+        with Session(get_engine()) as session:
+            return get_current_user(session, token)
+
+    try:
+        current_user = await run_in_threadpool(authenticate)
+        verify_access(2, current_user.USER_type)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    subscription = await changes.subscribe(parse_topics(topics))
+    receiver = asyncio.create_task(websocket.receive())
+    try:
+        while True:
+            sender = asyncio.create_task(subscription.queue.get())
+            done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if sender in done:
+                await websocket.send_text(sender.result())
+            else:
+                sender.cancel()
+            if receiver in done:
+                if receiver.result()["type"] == "websocket.disconnect":
+                    break
+                receiver = asyncio.create_task(websocket.receive())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        changes.unsubscribe(subscription)
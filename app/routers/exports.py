@@ -0,0 +1,60 @@
+from fastapi import Request, Depends, HTTPException, APIRouter
+from fastapi.responses import StreamingResponse
+from typing import Literal
+from ..db.database import User
+from ..dependencies import get_current_user
+from ..internal.logger import logger
+from ..internal.auth import verify_access
+from ..internal.exports import TABLES, FORMATS, export, pyarrow_available
+from ..settings import get_settings
+
+router = APIRouter(
+    prefix="/exports",
+    tags=["exports"],
+    responses={404: {"description": "Not found"}},
+)
+
+@router.get("/{table}")
+def export_table(
+    table: Literal["devices", "devicegroups", "devicestatus", "packages", "packagegroups"],
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    format: Literal["csv.gz", "arrow", "parquet"] = "csv.gz"
+):
+    """
+    Stream a whole table for analytics, in a compact format.
+
+    Rows are read with a server-side cursor and encoded EXPORT_BATCH_SIZE at
+    a time, so memory use does not grow with the table. Arrow and Parquet
+    need the optional pyarrow package.
+
+    Args:
+        table (str): The table to export.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        format (str): csv.gz (gzip-compressed CSV with a header row), arrow (Arrow IPC stream) or parquet.
+
+    Returns:
+        StreamingResponse: The encoded table.
+    """
+    verify_access(2, current_user.USER_type)
+    if format != "csv.gz" and not pyarrow_available():
+        logger.warning("Export format unavailable.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=400, detail=f"The {format} format requires pyarrow")
+    media_type, extension = FORMATS[format]
+    logger.warning("Table exported successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return StreamingResponse(
+        export(TABLES[table], format, get_settings().export_batch_size),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={table}.{extension}"}
+    )
@@ -1,10 +1,13 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, APIRouter, UploadFile
+from fastapi import Request, Depends, HTTPException, APIRouter, UploadFile, Header, Response
+from fastapi.responses import RedirectResponse
+from typing import Annotated, Optional
 from ..internal.auth import verify_access
 from ..dependencies import get_current_user
 from ..internal.logger import logger
 from ..db.database import User
-import os
-import shutil
+from ..internal.bundles import file_response
+from ..internal.storage import get_storage, save_upload
+import anyio.to_thread
 
 router = APIRouter(
     prefix="/files",
@@ -12,13 +15,14 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-UPLOAD_DIRECTORY = "app/db/deploy"
-
 @router.post("/")
-def create_package(file: UploadFile, request: Request, current_user: User = Depends(get_current_user)):
+async def create_package(file: UploadFile, request: Request, current_user: User = Depends(get_current_user)):
     """
     Upload a new file package.
 
+    The file is copied to storage in UPLOAD_CHUNK_SIZE chunks and only
+    becomes visible once complete (fsynced, then renamed into place).
+
     Args:
         file (UploadFile): The file to upload.
         request (Request): The request sent.
@@ -28,8 +32,8 @@ def create_package(file: UploadFile, request: Request, current_user: User = Depe
         str: The filename of the uploaded file.
     """
     verify_access(1, current_user.USER_type)
-    file_location = os.path.join(UPLOAD_DIRECTORY, file.filename)
-    if os.path.isfile(file_location):
+    storage = get_storage()
+    if await anyio.to_thread.run_sync(storage.exists, file.filename):
         logger.warning("File name already exists.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -37,8 +41,7 @@ def create_package(file: UploadFile, request: Request, current_user: User = Depe
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=400, detail="File name already exists")
-    with open(file_location, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    await save_upload(storage, file.filename, file)
     logger.warning("File uploaded successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -47,8 +50,56 @@ def create_package(file: UploadFile, request: Request, current_user: User = Depe
     })
     return file.filename
 
+@router.get("/{filename}")
+def download_file(
+    filename: str,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    if_none_match: Annotated[Optional[str], Header()] = None
+):
+    """
+    Download one file, with its SHA-256 as ETag.
+
+    A request whose If-None-Match matches the ETag gets an empty 304
+    response, so cache nodes can revalidate their copy cheaply. With
+    STORAGE_PRESIGNED_DOWNLOADS, the client is redirected to download the
+    file from the bucket directly.
+
+    Args:
+        filename (str): The name of the file.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        if_none_match (str): The ETag of the copy held by the client.
+
+    Returns:
+        StreamingResponse: The file content.
+    """
+    verify_access(3, current_user.USER_type)
+    storage = get_storage()
+    if not storage.exists(filename):
+        logger.warning("File not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="File not found")
+    digest = storage.digest(filename)
+    logger.warning("File downloaded successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    if if_none_match == f'"{digest}"':
+        return Response(status_code=304, headers={"ETag": f'"{digest}"'})
+    url = storage.url(filename)
+    if url is not None:
+        return RedirectResponse(url, status_code=307, headers={"ETag": f'"{digest}"'})
+    return file_response(storage.open(filename), storage.size(filename), filename, digest, request.client.host if request.client else "unknown")
+
 @router.delete("/{filename}/delete/")
-def delete_file(filename: str, request: Request, current_user: User = Depends(get_current_user)):
+async def delete_file(filename: str, request: Request, current_user: User = Depends(get_current_user)):
     """
     Delete a file by its filename.
 
@@ -59,9 +110,7 @@ def delete_file(filename: str, request: Request, current_user: User = Depends(ge
         Dict: A success message.
     """
     verify_access(1, current_user.USER_type)
-    file_location = os.path.join(UPLOAD_DIRECTORY, filename)
-    if os.path.exists(file_location):
-        os.remove(file_location)
+    if await anyio.to_thread.run_sync(get_storage().delete, filename):
         logger.warning("File removed successfully.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -1,10 +1,13 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, Query, status, APIRouter
-from typing import Annotated
+from fastapi import Request, Depends, HTTPException, APIRouter
+from typing import Optional
 from ..db.database import User, PackageGroup
-from ..dependencies import SessionDep, engine, get_current_user
+from ..dependencies import ReadSessionDep, SessionDep, get_current_user
 from ..internal.logger import logger
 from sqlmodel import select
 from ..internal.auth import verify_access
+from ..internal import crud
+from ..internal.deletions import start_deletion
+from ..internal.expand import parse_expand, expand_options, dump_expanded
 
 router = APIRouter(
     prefix="/packagegroups",
@@ -27,7 +30,8 @@ def create_package_group(package_group: PackageGroup, session: SessionDep, reque
         PackageGroup: The created package group.
     """
     verify_access(1, current_user.USER_type)
-    if session.get(PackageGroup, package_group.PG_id):
+    package_group = crud.create(session, package_group, "packagegroup")
+    if not package_group:
         logger.warning("Package group id already exists.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -35,9 +39,6 @@ def create_package_group(package_group: PackageGroup, session: SessionDep, reque
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=400, detail="Package group id already exists")
-    session.add(package_group)
-    session.commit()
-    session.refresh(package_group)
     logger.warning("Package group created successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -46,45 +47,49 @@ def create_package_group(package_group: PackageGroup, session: SessionDep, reque
     })
     return package_group
 
-@router.get("/", response_model=list[PackageGroup])
-def read_package_groups(session: SessionDep, request: Request, current_user: User = Depends(get_current_user)) -> list[PackageGroup]:
+@router.get("/")
+def read_package_groups(session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Retrieve a list of all package groups.
 
     Args:
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: packages.
 
     Returns:
         List[PackageGroup]: A list of package groups.
     """
     verify_access(2, current_user.USER_type)
-    package_groups = session.exec(select(PackageGroup)).all()
+    names = parse_expand(PackageGroup, expand)
+    package_groups = session.exec(select(PackageGroup).options(*expand_options(PackageGroup, names))).all()
     logger.warning("Package groups read successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return package_groups
+    return [dump_expanded(package_group, names) for package_group in package_groups]
 
 @router.get("/{package_group_id}/")
-def read_package_group(package_group_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+def read_package_group(package_group_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Retrieve a package group by its ID.
 
     Args:
         package_group_id (int): The ID of the package group.
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: packages.
 
     Returns:
         PackageGroup: The retrieved package group.
     """
     verify_access(2, current_user.USER_type)
-    package_group = session.get(PackageGroup, package_group_id)
+    names = parse_expand(PackageGroup, expand)
+    package_group = session.get(PackageGroup, package_group_id, options=expand_options(PackageGroup, names))
     if not package_group:
         logger.warning("Package group not found.", extra={
             'method': request.method,
@@ -99,7 +104,7 @@ def read_package_group(package_group_id: int, session: SessionDep, request: Requ
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return package_group
+    return dump_expanded(package_group, names)
 
 @router.put("/{package_group_id}/")
 def update_package_group(package_group_id: int, package_group: PackageGroup, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
@@ -117,7 +122,7 @@ def update_package_group(package_group_id: int, package_group: PackageGroup, ses
         PackageGroup: The updated package group.
     """
     verify_access(1, current_user.USER_type)
-    db_package_group = session.get(PackageGroup, package_group_id)
+    db_package_group = crud.update(session, PackageGroup, package_group_id, crud.sent_fields(package_group, ["PG_libelle"]), "packagegroup")
     if not db_package_group:
         logger.warning("Package group not found.", extra={
             'method': request.method,
@@ -126,10 +131,6 @@ def update_package_group(package_group_id: int, package_group: PackageGroup, ses
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="Package group not found")
-    db_package_group.PG_libelle = package_group.PG_libelle
-    session.add(db_package_group)
-    session.commit()
-    session.refresh(db_package_group)
     logger.warning("Package group updated successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -138,10 +139,13 @@ def update_package_group(package_group_id: int, package_group: PackageGroup, ses
     })
     return db_package_group
 
-@router.delete("/{package_group_id}/delete/")
+@router.delete("/{package_group_id}/delete/", status_code=202)
 def delete_package_group(package_group_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
-    Delete a package group by its ID.
+    Queue the deletion of a package group by its ID.
+
+    Its packages are detached from it and its deployments removed in the
+    background, batch by batch, then the group is deleted.
 
     Args:
         package_group_id (int): The ID of the package group to delete.
@@ -150,11 +154,10 @@ def delete_package_group(package_group_id: int, session: SessionDep, request: Re
         current_user (User): the user who does the request
 
     Returns:
-        Dict: A success message.
+        DeletionJob: The deletion job, to follow with `GET /deletions/{id}/`.
     """
     verify_access(1, current_user.USER_type)
-    package_group = session.get(PackageGroup, package_group_id)
-    if not package_group:
+    if not session.get(PackageGroup, package_group_id):
         logger.warning("Package group not found.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -162,12 +165,11 @@ def delete_package_group(package_group_id: int, session: SessionDep, request: Re
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="Package group not found")
-    session.delete(package_group)
-    session.commit()
-    logger.warning("Package group deleted successfully.", extra={
+    job = start_deletion(session, "packagegroup", package_group_id, current_user.USER_username)
+    logger.warning("Package group deletion queued.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return {"detail": "PackageGroup deleted successfully"}
+    return job
@@ -1,10 +1,18 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, Query, status, APIRouter
-from typing import Annotated
-from ..db.database import User, Package
-from ..dependencies import SessionDep, engine, get_current_user
+from fastapi import Request, Depends, HTTPException, APIRouter, UploadFile
+from typing import Optional
+from pydantic import BaseModel
+from sqlalchemy import update
+from ..db.database import User, Package, PackageVersion, DeviceGroup, PackageGroup
+from ..dependencies import ReadSessionDep, SessionDep, get_current_user
 from ..internal.logger import logger
 from sqlmodel import select
 from ..internal.auth import verify_access
+from ..internal.changelog import record_change, record_bulk_change
+from ..internal import crud
+from ..internal.deletions import reject_deleted_groups
+from ..internal.storage import get_storage
+from ..internal.versions import find_version, publish_version, version_response
+from ..internal.expand import parse_expand, expand_options, dump_expanded
 
 import os
 
@@ -14,6 +22,19 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+class PackageFilter(BaseModel):
+    PACK_type: Optional[str] = None
+    PACK_os_supported: Optional[str] = None
+    DEV_id: Optional[int] = None
+    DG_id: Optional[int] = None
+    PG_id: Optional[int] = None
+
+class PackageGroupAssignment(BaseModel):
+    PG_id: Optional[int] = None
+    DG_id: Optional[int] = None
+    PACK_ids: Optional[list[int]] = None
+    filter: Optional[PackageFilter] = None
+
 @router.post("/")
 def create_package(package: Package, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
@@ -29,7 +50,9 @@ def create_package(package: Package, session: SessionDep, request: Request, curr
         Package: The created package.
     """
     verify_access(1, current_user.USER_type)
-    if session.get(Package, package.PACK_id):
+    reject_deleted_groups(session, DG_id=package.DG_id, PG_id=package.PG_id)
+    package = crud.create(session, package, "package")
+    if not package:
         logger.warning("Package id already exists.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -37,9 +60,6 @@ def create_package(package: Package, session: SessionDep, request: Request, curr
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=400, detail="Package id already exists")
-    session.add(package)
-    session.commit()
-    session.refresh(package)
     logger.warning("Package created successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -48,45 +68,49 @@ def create_package(package: Package, session: SessionDep, request: Request, curr
     })
     return package
 
-@router.get("/", response_model=list[Package])
-def read_packages(session: SessionDep, request: Request, current_user: User = Depends(get_current_user)) -> list[Package]:
+@router.get("/")
+def read_packages(session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Retrieve a list of all packages.
 
     Args:
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: device, device_group, package_group.
 
     Returns:
         List[Package]: A list of packages.
     """
     verify_access(2, current_user.USER_type)
-    packages = session.exec(select(Package)).all()
+    names = parse_expand(Package, expand)
+    packages = session.exec(select(Package).options(*expand_options(Package, names))).all()
     logger.warning("Packages read successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return packages
+    return [dump_expanded(package, names) for package in packages]
 
 @router.get("/{package_id}/")
-def read_package(package_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+def read_package(package_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user), expand: Optional[str] = None):
     """
     Retrieve a package by its ID.
 
     Args:
         package_id (int): The ID of the package.
-        session (SessionDep): The database session.
+        session (ReadSessionDep): The read-only database session.
         request (Request): The request sent.
         current_user (User): the user who does the request
+        expand (str): Comma-separated relationships to include: device, device_group, package_group.
 
     Returns:
         Package: The retrieved package.
     """
     verify_access(2, current_user.USER_type)
-    package = session.get(Package, package_id)
+    names = parse_expand(Package, expand)
+    package = session.get(Package, package_id, options=expand_options(Package, names))
     if not package:
         logger.warning("Package not found.", extra={
             'method': request.method,
@@ -101,7 +125,7 @@ def read_package(package_id: int, session: SessionDep, request: Request, current
         'status': 'success',
         'current_user': current_user.USER_username
     })
-    return package
+    return dump_expanded(package, names)
 
 @router.put("/{package_id}/")
 def update_package(package_id: int, package: Package, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
@@ -119,7 +143,9 @@ def update_package(package_id: int, package: Package, session: SessionDep, reque
         Package: The updated package.
     """
     verify_access(1, current_user.USER_type)
-    db_package = session.get(Package, package_id)
+    values = crud.sent_fields(package, ["PACK_name", "PACK_type", "PACK_os_supported", "DEV_id", "DG_id", "PG_id"])
+    reject_deleted_groups(session, DG_id=values.get("DG_id"), PG_id=values.get("PG_id"))
+    db_package = crud.update(session, Package, package_id, values, "package")
     if not db_package:
         logger.warning("Package not found.", extra={
             'method': request.method,
@@ -128,15 +154,6 @@ def update_package(package_id: int, package: Package, session: SessionDep, reque
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="Package not found")
-    db_package.PACK_name = package.PACK_name
-    db_package.PACK_type = package.PACK_type
-    db_package.PACK_os_supported = package.PACK_os_supported
-    db_package.DEV_id = package.DEV_id
-    db_package.DG_id = package.DG_id
-    db_package.PG_id = package.PG_id
-    session.add(db_package)
-    session.commit()
-    session.refresh(db_package)
     logger.warning("Package updated successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -160,8 +177,7 @@ def delete_package(package_id: int, session: SessionDep, request: Request, curre
         Dict: A success message.
     """
     verify_access(1, current_user.USER_type)
-    package = session.get(Package, package_id)
-    if not package:
+    if not crud.delete(session, Package, package_id, "package"):
         logger.warning("Package not found.", extra={
             'method': request.method,
             'url': request.url.path,
@@ -169,8 +185,6 @@ def delete_package(package_id: int, session: SessionDep, request: Request, curre
             'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="Package not found")
-    session.delete(package)
-    session.commit()
     logger.warning("Package deleted successfully.", extra={
         'method': request.method,
         'url': request.url.path,
@@ -179,6 +193,121 @@ def delete_package(package_id: int, session: SessionDep, request: Request, curre
     })
     return {"detail": "Package deleted successfully"}
 
+@router.post("/{package_id}/versions")
+def create_package_version(package_id: int, file: UploadFile, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Upload a new version of a package. It becomes the file deployed under the package name.
+
+    Args:
+        package_id (int): The ID of the package.
+        file (UploadFile): The new content.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The version, and whether it was created: false when the content is the latest version's.
+    """
+    verify_access(1, current_user.USER_type)
+    package = session.get(Package, package_id)
+    if not package:
+        logger.warning("Package not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Package not found")
+    published = publish_version(session, package, file.file)
+    if published is None:
+        logger.warning("Concurrent package version upload.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=409, detail="Another version of this package was uploaded at the same time")
+    version, created = published
+    logger.warning("Package version uploaded successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"version": version, "created": created}
+
+@router.get("/{package_id}/versions")
+def read_package_versions(package_id: int, session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    List the versions of a package, newest first.
+
+    Args:
+        package_id (int): The ID of the package.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        List[PackageVersion]: The number, SHA-256, size and upload time of each version.
+    """
+    verify_access(2, current_user.USER_type)
+    versions = session.exec(
+        select(PackageVersion).where(PackageVersion.PACK_id == package_id).order_by(PackageVersion.PV_number.desc())
+    ).all()
+    logger.warning("Package versions read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return versions
+
+@router.get("/{package_id}/versions/{number}/download")
+def download_package_version(
+    package_id: int,
+    number: int,
+    session: SessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    from_version: Optional[int] = None
+):
+    """
+    Download a version of a package, or only its delta from the version the client holds.
+
+    A delta is sent when `from_version` is an older version of the package
+    and the delta is smaller; the X-Delta-From header then names the version
+    it applies to, e.g. `zstd -d --patch-from=<that version> --long=<X-Delta-Window-Log>`.
+
+    Args:
+        package_id (int): The ID of the package.
+        number (int): The version to download.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        from_version (int): The version the client holds.
+
+    Returns:
+        StreamingResponse: The delta or the whole version.
+    """
+    verify_access(3, current_user.USER_type)
+    package = session.get(Package, package_id)
+    version = find_version(session, package_id, number) if package else None
+    if not version:
+        logger.warning("Package version not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Package version not found")
+    logger.warning("Package version downloaded successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return version_response(session, package, version, from_version, request.client.host if request.client else "unknown", package.DG_id)
+
 @router.get("/autoupdate")
 def auto_update(session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
@@ -195,7 +324,8 @@ def auto_update(session: SessionDep, request: Request, current_user: User = Depe
     verify_access(1, current_user.USER_type)
     filesInDB = [packageInDB for packageInDB in session.exec(select(Package)).all()]
     filenamesInDB = [package.PACK_name+package.PACK_type for package in filesInDB]
-    fichiers = os.listdir("app/db/deploy/")
+    storage = get_storage()
+    fichiers = storage.names()
     for fichier in fichiers:
         if fichier not in filenamesInDB:
             Fnom, Fextension = os.path.splitext(fichier)
@@ -206,12 +336,15 @@ def auto_update(session: SessionDep, request: Request, current_user: User = Depe
                 PACK_os_supported="any"
             )
             session.add(package)
+            session.flush()
+            record_change(session, "package", package.PACK_id, "create")
             session.commit()
             session.refresh(package)
     
     for filename in filenamesInDB:
-        if not (os.path.isfile(os.path.join("app/db/deploy/", filename))):
+        if not (storage.exists(filename)):
             package = filesInDB[filenamesInDB.index(filename)]
+            record_change(session, "package", package.PACK_id, "delete")
             session.delete(package)
             session.commit()
     logger.warning(f"Autoupdate successful.", extra={
@@ -221,3 +354,63 @@ def auto_update(session: SessionDep, request: Request, current_user: User = Depe
         'current_user': current_user.USER_username
     })
     return {"detail": "Autoupdate successful"}
+
+@router.put("/bulk/group/")
+def assign_packages_to_groups(assignment: PackageGroupAssignment, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Attach many packages to a package group and/or a device group in one UPDATE statement.
+
+    Packages are selected by ID, by filter, or both. Only the group fields and
+    filter fields that are sent are applied, so `{"PG_id": 3, "filter": {"PG_id": null}}`
+    attaches every package without a package group to group 3.
+
+    Args:
+        assignment (PackageGroupAssignment): The target groups and the packages to update.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The number of packages updated.
+    """
+    verify_access(1, current_user.USER_type)
+    conditions = []
+    if assignment.PACK_ids is not None:
+        conditions.append(Package.PACK_id.in_(assignment.PACK_ids))
+    if assignment.filter is not None:
+        for field in assignment.filter.model_fields_set:
+            conditions.append(getattr(Package, field) == getattr(assignment.filter, field))
+    values = {field: getattr(assignment, field) for field in ("PG_id", "DG_id") if field in assignment.model_fields_set}
+    if not conditions or not values:
+        logger.warning("No packages or groups selected.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=400, detail="No packages or groups selected")
+    for field, model in (("PG_id", PackageGroup), ("DG_id", DeviceGroup)):
+        if values.get(field) is not None and not session.get(model, values[field]):
+            logger.warning("Group not found.", extra={
+                'method': request.method,
+                'url': request.url.path,
+                'status': 'fail',
+                'current_user': current_user.USER_username
+            })
+            raise HTTPException(status_code=404, detail="group not found")
+    reject_deleted_groups(session, DG_id=values.get("DG_id"), PG_id=values.get("PG_id"))
+    record_bulk_change(session, "package", conditions)
+    result = session.exec(
+        update(Package)
+        .where(*conditions)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+    logger.warning("Packages assigned to groups successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {"updated": result.rowcount}
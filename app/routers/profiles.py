@@ -0,0 +1,123 @@
+from fastapi import Request, Depends, APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from typing import Annotated, Optional
+from sqlmodel import select
+from ..db.database import User, RequestProfile
+from ..dependencies import SessionDep, get_current_user
+from ..internal.logger import logger
+from ..internal.auth import verify_access
+import json
+
+router = APIRouter(
+    prefix="/profiles",
+    tags=["profiles"],
+    responses={404: {"description": "Not found"}},
+)
+
+# the columns listed, the reports can be large
+SUMMARY = [
+    RequestProfile.PROF_id, RequestProfile.PROF_time, RequestProfile.PROF_user, RequestProfile.PROF_method,
+    RequestProfile.PROF_route, RequestProfile.PROF_statusCode, RequestProfile.PROF_duration,
+    RequestProfile.PROF_samples, RequestProfile.PROF_queries, RequestProfile.PROF_queryTime,
+]
+
+def read_profile(session, profile_id: int, request: Request, current_user: User):
+    """
+    Get a profile, or raise a 404 error.
+
+    Returns:
+        RequestProfile: The profile.
+    """
+    profile = session.get(RequestProfile, profile_id)
+    if not profile:
+        logger.warning("Profile not found.", extra={
+            'method': request.method,
+            'url': request.url.path,
+            'status': 'fail',
+            'current_user': current_user.USER_username
+        })
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
+
+@router.get("/")
+def read_profiles(
+    session: SessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    route: Optional[str] = None,
+    limit: Annotated[int, Query(gt=0, le=500)] = 50
+):
+    """
+    List the stored request profiles, newest first, without their reports.
+
+    Args:
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        route (str): Only the profiles of requests to this path.
+        limit (int): The maximum number of profiles.
+
+    Returns:
+        list[Dict]: The time, request, duration, samples and SQL totals of each profile.
+    """
+    verify_access(0, current_user.USER_type)
+    query = select(*SUMMARY).order_by(RequestProfile.PROF_id.desc()).limit(limit)
+    if route is not None:
+        query = query.where(RequestProfile.PROF_route == route)
+    profiles = [row._asdict() for row in session.exec(query).all()]
+    logger.warning("Profiles read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return profiles
+
+@router.get("/{profile_id}")
+def read_profile_report(profile_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read a request profile: its sampled stacks and SQL statements.
+
+    Args:
+        profile_id (int): The ID of the profile.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        Dict: The summary of the profile and its report.
+    """
+    verify_access(0, current_user.USER_type)
+    profile = read_profile(session, profile_id, request, current_user)
+    logger.warning("Profile read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return {**{column.key: getattr(profile, column.key) for column in SUMMARY}, "report": json.loads(profile.PROF_report)}
+
+@router.get("/{profile_id}/collapsed", response_class=PlainTextResponse)
+def read_profile_stacks(profile_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the sampled stacks of a request profile in the collapsed format of flamegraph.pl and speedscope.
+
+    Args:
+        profile_id (int): The ID of the profile.
+        session (SessionDep): The database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        str: One "frame;frame;... count" line per distinct stack.
+    """
+    verify_access(0, current_user.USER_type)
+    profile = read_profile(session, profile_id, request, current_user)
+    stacks = json.loads(profile.PROF_report)["stacks"]
+    logger.warning("Profile read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.items())
@@ -0,0 +1,131 @@
+from fastapi import Request, Depends, APIRouter, Query
+from typing import Annotated
+from sqlalchemy import case, or_
+from ..db.database import User, Device, Package
+from ..dependencies import ReadSessionDep, get_current_user
+from ..internal.logger import logger
+from sqlmodel import select
+from ..internal.auth import verify_access
+import re
+
+router = APIRouter(
+    prefix="/search",
+    tags=["search"],
+    responses={404: {"description": "Not found"}},
+)
+
+# InnoDB ignores shorter words in FULLTEXT indexes (innodb_ft_min_token_size)
+MIN_TOKEN_SIZE = 3
+
+def ranked_search(session, model, name_column, columns, q: str, offset: int, limit: int):
+    """
+    Search rows whose columns contain the query, best matches first.
+
+    On MariaDB the query words are matched as prefixes against the FULLTEXT
+    index over the columns and ranked by relevance. Other databases fall back
+    to a substring scan. In both cases exact and prefix matches on the name
+    come first.
+
+    Args:
+        session (Session): The database session.
+        model (SQLModel): The table to search.
+        name_column: The column exact and prefix matches are ranked on.
+        columns (list): The columns to search, in the order of their FULLTEXT index.
+        q (str): The search string.
+        offset (int): The offset for pagination.
+        limit (int): The limit for pagination.
+
+    Returns:
+        list: The matching rows.
+    """
+    name_rank = case(
+        (name_column == q, 2),
+        (name_column.startswith(q, autoescape=True), 1),
+        else_=0,
+    )
+    words = [word for word in re.findall(r"\w+", q) if len(word) >= MIN_TOKEN_SIZE]
+    if session.get_bind().dialect.name in ("mariadb", "mysql") and words:
+        from sqlalchemy.dialects.mysql import match
+        relevance = match(*columns, against=" ".join(f"+{word}*" for word in words)).in_boolean_mode()
+        statement = (
+            select(model)
+            .where(relevance)
+            .order_by(name_rank.desc(), relevance.desc())
+        )
+    else:
+        statement = (
+            select(model)
+            .where(or_(*[column.contains(q, autoescape=True) for column in columns]))
+            .order_by(name_rank.desc(), name_column)
+        )
+    return session.exec(statement.offset(offset).limit(limit)).all()
+
+@router.get("/devices/", response_model=list[Device])
+def search_devices(
+    q: Annotated[str, Query(min_length=1)],
+    session: ReadSessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    offset: int = 0,
+    limit: Annotated[int, Query(le=100)] = 100
+):
+    """
+    Search devices by name or OS.
+
+    Args:
+        q (str): The search string.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        offset (int): The offset for pagination.
+        limit (int): The limit for pagination.
+
+    Returns:
+        List[Device]: The matching devices, best matches first.
+    """
+    verify_access(2, current_user.USER_type)
+    devices = ranked_search(
+        session, Device, Device.DEV_name, [Device.DEV_name, Device.DEV_os], q, offset, limit
+    )
+    logger.warning("Devices searched successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return devices
+
+@router.get("/packages/", response_model=list[Package])
+def search_packages(
+    q: Annotated[str, Query(min_length=1)],
+    session: ReadSessionDep,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    offset: int = 0,
+    limit: Annotated[int, Query(le=100)] = 100
+):
+    """
+    Search packages by name or type.
+
+    Args:
+        q (str): The search string.
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+        offset (int): The offset for pagination.
+        limit (int): The limit for pagination.
+
+    Returns:
+        List[Package]: The matching packages, best matches first.
+    """
+    verify_access(2, current_user.USER_type)
+    packages = ranked_search(
+        session, Package, Package.PACK_name, [Package.PACK_name, Package.PACK_type], q, offset, limit
+    )
+    logger.warning("Packages searched successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return packages
@@ -0,0 +1,142 @@
+from fastapi import Request, Depends, APIRouter
+from sqlalchemy import func
+from ..db.database import User, Device, Package
+from ..dependencies import ReadSessionDep, get_current_user
+from ..internal.logger import logger
+from ..internal.cache import TTLCache
+from ..internal.shaping import downloads
+from ..internal.replicas import replicas
+from ..internal.admission import stats as admission_stats
+from sqlmodel import select
+from ..internal.auth import verify_access
+from ..settings import get_settings
+
+router = APIRouter(
+    prefix="/stats",
+    tags=["stats"],
+    responses={404: {"description": "Not found"}},
+)
+
+stats_cache = TTLCache()
+
+def count_by(session, column):
+    """
+    Count the rows of a table grouped by one column.
+
+    Args:
+        session (Session): The database session.
+        column: The column to group by.
+
+    Returns:
+        list[dict]: One {column: value, "count": n} entry per value, largest first.
+    """
+    count = func.count().label("count")
+    rows = session.exec(select(column, count).group_by(column).order_by(count.desc())).all()
+    return [{column.key: value, "count": n} for value, n in rows]
+
+def compute_fleet_stats(session):
+    """
+    Compute the fleet statistics.
+
+    Args:
+        session (Session): The database session.
+
+    Returns:
+        dict: The counts per OS, group and package type.
+    """
+    return {
+        "devices_per_os": count_by(session, Device.DEV_os),
+        "devices_per_group": count_by(session, Device.DG_id),
+        "packages_per_group": count_by(session, Package.PG_id),
+        "packages_per_device_group": count_by(session, Package.DG_id),
+        "packages_per_type": count_by(session, Package.PACK_type),
+    }
+
+@router.get("/")
+def read_fleet_stats(session: ReadSessionDep, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the device and package counts used by the dashboards.
+
+    The counts are computed with GROUP BY queries and cached for
+    STATS_CACHE_TTL seconds, so frequent refreshes stay cheap.
+
+    Args:
+        session (ReadSessionDep): The read-only database session.
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        dict: The counts per OS, group and package type.
+    """
+    verify_access(2, current_user.USER_type)
+    stats = stats_cache.get_or_set("fleet", get_settings().stats_cache_ttl, lambda: compute_fleet_stats(session))
+    logger.warning("Stats read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return stats
+
+@router.get("/downloads")
+def read_download_stats(request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the live download throughput, to tune the DOWNLOAD_*_RATE_LIMIT settings.
+
+    Args:
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        dict: The current rate, bytes served and open streams, globally, per device group and per client.
+    """
+    verify_access(2, current_user.USER_type)
+    logger.warning("Download stats read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return downloads.stats()
+
+@router.get("/replicas")
+def read_replica_stats(request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the lag of each read replica and whether it takes reads.
+
+    Args:
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        list[dict]: The URL, lag in seconds and state of each replica.
+    """
+    verify_access(2, current_user.USER_type)
+    logger.warning("Replica stats read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return replicas.stats()
+
+@router.get("/admission")
+def read_admission_stats(request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Read the state of the admission control: slots in use, queued and refused requests.
+
+    Args:
+        request (Request): The request sent.
+        current_user (User): the user who does the request
+
+    Returns:
+        dict: The active and queued requests, the queue latency and the refusal counts.
+    """
+    verify_access(2, current_user.USER_type)
+    logger.warning("Admission stats read successfully.", extra={
+        'method': request.method,
+        'url': request.url.path,
+        'status': 'success',
+        'current_user': current_user.USER_username
+    })
+    return admission_stats()
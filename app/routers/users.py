@@ -1,11 +1,11 @@
-from fastapi import Request, Depends, FastAPI, HTTPException, Query, status, APIRouter
-from typing import Annotated
-from ..db.database import User, User
-from ..dependencies import SessionDep, engine, get_current_user
+from fastapi import Request, Depends, HTTPException, APIRouter
+from sqlalchemy import case, delete
+from ..db.database import RefreshToken, User
+from ..dependencies import SessionDep, get_current_user
 from ..internal.logger import logger
 from sqlmodel import select
-from ..internal.auth import verify_password, create_access_token, get_password_hash, verify_access
-from bcrypt import checkpw
+from ..internal.auth import get_password_hash, verify_access
+from ..internal import crud
 
 router = APIRouter(
     prefix="/users",
@@ -28,23 +28,21 @@ def create_user(user: User, session: SessionDep, request: Request, current_user:
         User: The created user.
     """
     verify_access(0, current_user.USER_type)
-    if session.get(User, user.USER_id):
+    user.USER_passHash = get_password_hash(user.USER_passHash)
+    user = crud.create(session, user)
+    if not user:
         logger.warning("User id already exists.", extra={
             'method': request.method,
             'url': request.url.path,
             'status': 'fail',
-            'user': current_user.USER_username
+            'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=400, detail="User id already exists")
-    user.USER_passHash = get_password_hash(user.USER_passHash)
-    session.add(user)
-    session.commit()
-    session.refresh(user)
     logger.warning("User created successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
-        'user': current_user.USER_username
+        'current_user': current_user.USER_username
     })
     return user
 
@@ -67,7 +65,7 @@ def read_users(session: SessionDep, request: Request, current_user: User = Depen
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
-        'user': current_user.USER_username
+        'current_user': current_user.USER_username
     })
     return users
 
@@ -92,14 +90,14 @@ def read_user(user_id: int, session: SessionDep, request: Request, current_user:
             'method': request.method,
             'url': request.url.path,
             'status': 'fail',
-            'user': current_user.USER_username
+            'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="User not found")
     logger.warning("User read successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
-        'user': current_user.USER_username
+        'current_user': current_user.USER_username
     })
     return user
 
@@ -119,35 +117,34 @@ def update_user(user_id: int, user: User, session: SessionDep, request: Request,
         User: The updated user.
     """
     verify_access(0, current_user.USER_type)
-    db_user = session.get(User, user_id)
+    values = crud.sent_fields(user, ["USER_username", "USER_passHash", "USER_type", "USER_isActive"])
+    if "USER_passHash" in values:
+        # sending back the stored hash keeps the password, anything else is a new password
+        values["USER_passHash"] = case(
+            (User.USER_passHash == user.USER_passHash, User.USER_passHash),
+            else_=get_password_hash(user.USER_passHash),
+        )
+    db_user = crud.update(session, User, user_id, values)
     if not db_user:
         logger.warning("User not found.", extra={
             'method': request.method,
             'url': request.url.path,
             'status': 'fail',
-            'user': current_user.USER_username
+            'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="User not found")
-    db_user.USER_username = user.USER_username
-    if checkpw(get_password_hash(user.USER_passHash).encode('utf-8'), db_user.USER_passHash.encode('utf-8')):
-        db_user.USER_passHash = get_password_hash(user.USER_passHash)
-    db_user.USER_type = user.USER_type
-    db_user.USER_isActive = user.USER_isActive
-    session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
     logger.warning("User updated successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
-        'user': current_user.USER_username
+        'current_user': current_user.USER_username
     })
     return db_user
 
 @router.delete("/{user_id}/delete/")
-async def delete_user(user_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
+def delete_user(user_id: int, session: SessionDep, request: Request, current_user: User = Depends(get_current_user)):
     """
-    Delete a user by their ID.
+    Delete a user by their ID, with their refresh tokens.
 
     Args:
         user_id (int): The ID of the user to delete.
@@ -158,22 +155,22 @@ async def delete_user(user_id: int, session: SessionDep, request: Request, curre
     Returns:
         Dict: A success message.
     """
-    await verify_access(0, current_user.USER_type)
-    user = session.get(User, user_id)
-    if not user:
+    verify_access(0, current_user.USER_type)
+    # in the same transaction as the user row; tables created before the
+    # foreign key cascaded still need it
+    session.exec(delete(RefreshToken).where(RefreshToken.USER_id == user_id))
+    if not crud.delete(session, User, user_id):
         logger.warning("User not found.", extra={
             'method': request.method,
             'url': request.url.path,
             'status': 'fail',
-            'user': current_user.USER_username
+            'current_user': current_user.USER_username
         })
         raise HTTPException(status_code=404, detail="User not found")
-    session.delete(user)
-    session.commit()
     logger.warning("User deleted successfully.", extra={
         'method': request.method,
         'url': request.url.path,
         'status': 'success',
-        'user': current_user.USER_username
+        'current_user': current_user.USER_username
     })
     return {"detail": "User deleted successfully"}
@@ -0,0 +1,303 @@
+from functools import lru_cache
+from os import environ
+from typing import Optional
+from dotenv import load_dotenv
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+
+
+class Settings(BaseModel):
+    """
+    Application configuration.
+
+    Every field is read from the environment variable of the same name in
+    upper case (e.g. `db_pool_size` from `DB_POOL_SIZE`), after loading `.env`.
+    """
+    model_config = ConfigDict(frozen=True)
+
+    # database
+    db_user: str = ""
+    db_pass: str = ""
+    db_host: str = "127.0.0.1:3306"
+    db_name: str = "itam_db"
+    database_url: Optional[str] = None
+    db_pool_size: int = Field(default=5, ge=1)
+    db_max_overflow: int = Field(default=10, ge=0)
+    db_pool_recycle: int = 3600
+    db_pool_pre_ping: bool = True
+    # comma-separated SQLAlchemy URLs of read replicas, used by read-only endpoints
+    db_replica_urls: str = ""
+    db_replica_max_lag: float = Field(default=5.0, gt=0)
+    db_replica_check_interval: float = Field(default=2.0, gt=0)
+
+    # authentication
+    secret_key: str
+    algorithm: str = "HS256"
+    access_token_expire_minutes: int = Field(default=15, gt=0)
+    refresh_token_expire_days: int = Field(default=30, gt=0)
+
+    # deploy files: "local" keeps them in DEPLOY_DIRECTORY, "s3" in an S3-compatible bucket
+    storage_backend: str = "local"
+    deploy_directory: str = "app/db/deploy"
+    s3_bucket: str = ""
+    s3_prefix: str = ""
+    s3_endpoint_url: Optional[str] = None
+    s3_region: Optional[str] = None
+    s3_access_key: str = ""
+    s3_secret_key: str = ""
+    s3_presign_expiry: int = Field(default=300, gt=0)
+    storage_presigned_downloads: bool = False
+    upload_chunk_size: int = Field(default=1024 * 1024, gt=0)
+    zip_compression_level: int = Field(default=6, ge=0, le=9)
+    bundle_spool_size: int = Field(default=16 * 1024 * 1024, ge=0)
+    download_chunk_size: int = Field(default=64 * 1024, gt=0)
+    # download rate limits in bytes per second, 0 for unlimited
+    download_rate_limit: int = Field(default=0, ge=0)
+    download_group_rate_limit: int = Field(default=0, ge=0)
+    download_client_rate_limit: int = Field(default=0, ge=0)
+    # package versions: zstd level of the deltas between versions, the largest version given deltas,
+    # and how many deltas are computed at a time
+    package_delta_level: int = Field(default=19, ge=1, le=22)
+    package_delta_max_size: int = Field(default=256 * 1024 * 1024, gt=0)
+    package_delta_workers: int = Field(default=1, gt=0)
+
+    # deployment jobs
+    deploy_tick_interval: float = Field(default=5.0, gt=0)
+    deploy_timeout: float = Field(default=900.0, gt=0)
+    deploy_retry_base: float = Field(default=30.0, gt=0)
+    deploy_retry_max: float = Field(default=3600.0, gt=0)
+    deploy_client_rate: int = Field(default=1024 * 1024, gt=0)
+
+    # group deletion jobs
+    deletion_batch_size: int = Field(default=1000, gt=0)
+    deletion_batch_pause: float = Field(default=0.05, ge=0)
+    deletion_tick_interval: float = Field(default=5.0, gt=0)
+
+    # device agents
+    heartbeat_flush_interval: float = Field(default=5.0, gt=0)
+    heartbeat_batch_size: int = Field(default=1000, gt=0)
+    agent_token_cache_ttl: float = Field(default=60.0, ge=0)
+
+    # change feed
+    events_queue_size: int = Field(default=256, gt=0)
+    events_keepalive: float = Field(default=15.0, gt=0)
+    events_poll_interval: float = Field(default=1.0, gt=0)
+    events_batch_size: int = Field(default=500, gt=0)
+
+    # change log
+    changelog_retention_days: int = Field(default=30, gt=0)
+    changelog_purge_interval: float = Field(default=3600.0, gt=0)
+    # longest write transaction: readers wait this long for a change log ID to commit
+    changelog_settle_time: float = Field(default=10.0, gt=0)
+
+    # audit events; AUDIT_LOG_FILE also appends them to a text file, empty to disable
+    audit_log_file: str = "api.log"
+    audit_flush_interval: float = Field(default=2.0, gt=0)
+    audit_batch_size: int = Field(default=1000, gt=0)
+    audit_queue_size: int = Field(default=100000, gt=0)
+    audit_retention_days: int = Field(default=365, gt=0)
+    audit_purge_interval: float = Field(default=3600.0, gt=0)
+
+    # exports
+    export_batch_size: int = Field(default=10000, gt=0)
+
+    # profiling of admin requests flagged with X-Profile
+    profile_sample_interval: float = Field(default=0.005, gt=0)
+    profile_max_queries: int = Field(default=1000, gt=0)
+    profile_retention: int = Field(default=200, gt=0)
+
+    # caches
+    stats_cache_ttl: float = Field(default=5.0, ge=0)
+
+    # workers
+    threadpool_size: int = Field(default=40, gt=0)
+
+    # response compression: encodings by preference, zstd needs zstandard and br needs brotli
+    compression_encodings: str = "zstd,br,gzip"
+    compression_types: str = "application/json,text/plain,text/html,text/css,application/javascript"
+    compression_min_size: int = Field(default=1024, ge=0)
+    compression_gzip_level: int = Field(default=6, ge=1, le=9)
+    compression_brotli_quality: int = Field(default=4, ge=0, le=11)
+    compression_zstd_level: int = Field(default=3, ge=1, le=22)
+
+    # admission control: requests handled at once (0 for no cap), and how long others may queue
+    max_concurrent_requests: int = Field(default=0, ge=0)
+    admission_queue_timeout: float = Field(default=5.0, gt=0)
+    admission_shed_latency: float = Field(default=1.0, gt=0)
+    # requests per second per user, device or anonymous address, 0 for unlimited
+    rate_limit_user: float = Field(default=0, ge=0)
+    rate_limit_agent: float = Field(default=0, ge=0)
+    rate_limit_anonymous: float = Field(default=0, ge=0)
+    rate_limit_burst: int = Field(default=20, gt=0)
+    # comma-separated path_prefix=rate limits, per principal, e.g. "/packages/=2,/exports/=0.1"
+    rate_limit_routes: str = ""
+
+    # cache node: "primary" serves everything, "cache" only proxies downloads to UPSTREAM_URL
+    node_mode: str = "primary"
+    upstream_url: Optional[str] = None
+    upstream_username: str = ""
+    upstream_password: str = ""
+    upstream_timeout: float = Field(default=60.0, gt=0)
+    cache_directory: str = "app/db/cache"
+    cache_max_bytes: int = Field(default=10 * 1024 * 1024 * 1024, gt=0)
+    # comma-separated device group IDs whose packages are fetched ahead of time
+    cache_prefetch_groups: str = ""
+    cache_prefetch_interval: float = Field(default=300.0, gt=0)
+
+    @field_validator("algorithm")
+    @classmethod
+    def check_algorithm(cls, value):
+        if value not in ("HS256", "HS384", "HS512"):
+            raise ValueError(f"unsupported JWT algorithm: {value}")
+        return value
+
+    @field_validator("storage_backend")
+    @classmethod
+    def check_storage_backend(cls, value):
+        if value not in ("local", "s3"):
+            raise ValueError(f"unsupported storage backend: {value}")
+        return value
+
+    @field_validator("node_mode")
+    @classmethod
+    def check_node_mode(cls, value):
+        if value not in ("primary", "cache"):
+            raise ValueError(f"unsupported node mode: {value}")
+        return value
+
+    @field_validator("compression_encodings")
+    @classmethod
+    def check_compression_encodings(cls, value):
+        for encoding in filter(None, value.split(",")):
+            if encoding.strip() not in ("zstd", "br", "gzip"):
+                raise ValueError(f"unsupported compression encoding: {encoding}")
+        return value
+
+    @field_validator("rate_limit_routes")
+    @classmethod
+    def check_rate_limit_routes(cls, value):
+        for rule in filter(None, value.split(",")):
+            prefix, rate = rule.split("=")
+            if not prefix.startswith("/") or float(rate) <= 0:
+                raise ValueError(f"invalid route rate limit: {rule}")
+        return value
+
+    @field_validator("cache_prefetch_groups")
+    @classmethod
+    def check_prefetch_groups(cls, value):
+        for group in filter(None, value.split(",")):
+            int(group)
+        return value
+
+    @model_validator(mode="after")
+    def check_required(self):
+        if self.node_mode == "cache" and not self.upstream_url:
+            raise ValueError("UPSTREAM_URL is required in cache mode")
+        if self.storage_backend == "s3" and not self.s3_bucket:
+            raise ValueError("S3_BUCKET is required with the s3 storage backend")
+        return self
+
+    @property
+    def prefetch_groups(self):
+        """
+        The device groups whose packages a cache node prefetches.
+
+        Returns:
+            list[int]: The device group IDs.
+        """
+        return [int(group) for group in self.cache_prefetch_groups.split(",") if group.strip()]
+
+    @property
+    def compression_encoding_list(self):
+        """
+        The response encodings, most preferred first.
+
+        Returns:
+            list[str]: The Content-Encoding names.
+        """
+        return [encoding.strip() for encoding in self.compression_encodings.split(",") if encoding.strip()]
+
+    @property
+    def compression_type_list(self):
+        """
+        The media types whose responses are compressed.
+
+        Returns:
+            list[str]: Media types, or prefixes of them.
+        """
+        return [media_type.strip().lower() for media_type in self.compression_types.split(",") if media_type.strip()]
+
+    @property
+    def route_rate_limits(self):
+        """
+        The per-route rate limits.
+
+        Returns:
+            list[tuple[str, float]]: Each path prefix with its rate in requests per second.
+        """
+        return [(prefix.strip(), float(rate)) for prefix, rate in
+                (rule.split("=") for rule in self.rate_limit_routes.split(",") if rule.strip())]
+
+    @property
+    def replica_urls(self):
+        """
+        The URLs of the read replicas.
+
+        Returns:
+            list[str]: The SQLAlchemy URLs.
+        """
+        return [url.strip() for url in self.db_replica_urls.split(",") if url.strip()]
+
+    @property
+    def sqlalchemy_url(self):
+        """
+        The database URL, built from the DB_* variables unless DATABASE_URL is set.
+
+        Returns:
+            str: The SQLAlchemy database URL.
+        """
+        if self.database_url:
+            return self.database_url
+        return f"mariadb+mariadbconnector://{self.db_user}:{self.db_pass}@{self.db_host}/{self.db_name}"
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build the settings from the environment.
+
+        Returns:
+            Settings: The validated settings.
+        """
+        load_dotenv()
+        values = {name: environ[name.upper()] for name in cls.model_fields if name.upper() in environ}
+        return cls(**values)
+
+
+_override: Optional[Settings] = None
+
+
+@lru_cache
+def _load_settings():
+    return Settings.from_env()
+
+
+def get_settings():
+    """
+    Get the application settings, loaded once from the environment.
+
+    Returns:
+        Settings: The current settings.
+    """
+    if _override is not None:
+        return _override
+    return _load_settings()
+
+
+def set_settings(settings: Optional[Settings]):
+    """
+    Replace the settings used by the application, e.g. in tests or benchmarks.
+
+    Args:
+        settings (Optional[Settings]): The settings to use, or None to go back to the environment.
+    """
+    global _override
+    _override = settings
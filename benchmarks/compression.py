@@ -0,0 +1,88 @@
+"""
+Measure what response compression saves on the wire and costs in CPU.
+
+Builds the JSON body of GET /packages/ for a number of package rows and,
+for each encoding installed (gzip always, brotli and zstd when their
+modules are) and a few levels, times compressing it the way
+CompressionMiddleware does. Prints the bytes sent, the ratio to the
+uncompressed body, and the CPU time per response.
+
+Usage:
+    python benchmarks/compression.py [--rows 500] [--iterations 50]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LEVELS = {
+    "gzip": [1, 6, 9],
+    "br": [1, 4, 6, 11],
+    "zstd": [1, 3, 9, 19],
+}
+
+
+def payload(rows):
+    """
+    The JSON body of a list of package rows, as the packages router returns it.
+
+    Args:
+        rows (int): The number of packages.
+
+    Returns:
+        bytes: The body.
+    """
+    packages = [{
+        "PACK_id": i,
+        "PACK_name": f"package-{i}-{'x64' if i % 2 else 'arm64'}.zip",
+        "PACK_type": ("msi", "deb", "rpm", "pkg")[i % 4],
+        "PACK_os_supported": ("windows", "linux", "linux", "macos")[i % 4],
+        "PACK_description": f"Deployment bundle {i} for the {('finance', 'support', 'dev', 'ops')[i % 4]} team",
+    } for i in range(rows)]
+    return json.dumps(packages, separators=(",", ":")).encode()
+
+
+def measure(name, level, body, iterations):
+    """
+    Compress body `iterations` times with a new encoder each time.
+
+    Returns:
+        tuple[int, float]: The compressed size and the mean CPU time per response in microseconds.
+    """
+    from app.internal.compression import ENCODERS
+
+    start = time.process_time()
+    for _ in range(iterations):
+        compressor = ENCODERS[name][0](level)
+        compressed = compressor.compress(body) + compressor.finish()
+    return len(compressed), (time.process_time() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "sqlite://")
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-of-32-bytes!")
+    sys.path.insert(0, ROOT)
+    from app.internal.compression import available_encodings
+
+    body = payload(args.rows)
+    print(f"{args.rows} packages, {len(body)} bytes uncompressed")
+    print(f"{'encoding':<10} {'level':>5} {'bytes':>10} {'ratio':>7} {'us/resp':>10} {'MB/s':>8}")
+    for name, levels in LEVELS.items():
+        if name not in available_encodings():
+            print(f"{name:<10} not installed")
+            continue
+        for level in levels:
+            size, micros = measure(name, level, body, args.iterations)
+            print(f"{name:<10} {level:>5} {size:>10} {len(body) / size:>7.1f} {micros:>10.0f} {len(body) / micros:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
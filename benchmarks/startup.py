@@ -0,0 +1,82 @@
+"""
+Measure the cold start cost of the API.
+
+Runs `python -X importtime -c "import app.main"` in fresh interpreters and
+reports the wall time together with the slowest imports of the last run.
+
+Usage:
+    python benchmarks/startup.py [--runs 5] [--top 15]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_once():
+    """
+    Import the application in a new interpreter.
+
+    Returns:
+        tuple[float, str]: The wall time in seconds and the importtime report.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    return elapsed, result.stderr
+
+
+def slowest_imports(report, top):
+    """
+    Parse an importtime report and return the imports with the highest cumulative time.
+
+    Args:
+        report (str): The stderr output of `python -X importtime`.
+        top (int): The number of entries to return.
+
+    Returns:
+        list[tuple[int, str]]: Cumulative microseconds and module name.
+    """
+    entries = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        entries.append((int(cumulative_us), name.strip()))
+    entries.sort(reverse=True)
+    return entries[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    timings = []
+    report = ""
+    for _ in range(args.runs):
+        elapsed, report = run_once()
+        timings.append(elapsed)
+
+    print(f"import app.main over {args.runs} runs: "
+          f"median {statistics.median(timings) * 1000:.1f} ms, "
+          f"min {min(timings) * 1000:.1f} ms, max {max(timings) * 1000:.1f} ms")
+    print("\nslowest imports (cumulative, last run):")
+    for cumulative_us, name in slowest_imports(report, args.top):
+        print(f"{cumulative_us / 1000:10.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measure the per-request cost of authenticating with a bearer token.
+
+Times, per call:
+- decoding and checking the signature of an access token with PyJWT, and
+  with python-jose when it is installed, for comparison;
+- decode_access_token, which keeps the tokens it already verified;
+- the whole get_current_user dependency (decode plus user lookup) against a
+  temporary SQLite database;
+- hashing a refresh token, which is what POST /auth/refresh pays, next to
+  the bcrypt verify POST /auth/login pays.
+
+Usage:
+    python benchmarks/token_verify.py [--iterations 20000] [--bcrypt-iterations 20]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(workdir):
+    """
+    Point the application at a temporary database holding one user.
+
+    Args:
+        workdir (str): The temporary directory.
+
+    Returns:
+        str: An access token of that user.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key-of-32-bytes!")
+    sys.path.insert(0, ROOT)
+
+    from sqlmodel import Session
+    from app.db.database import User, create_db
+    from app.dependencies import get_engine
+    from app.internal.auth import create_access_token, get_password_hash
+
+    create_db(get_engine())
+    with Session(get_engine()) as session:
+        session.add(User(USER_username="bench", USER_passHash=get_password_hash("bench"), USER_type=0, USER_isActive=True))
+        session.commit()
+    return create_access_token({"username": "bench"})
+
+
+def measure(function, iterations):
+    """
+    Call function `iterations` times.
+
+    Returns:
+        float: The mean time per call in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--bcrypt-iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="itam-token-bench-")
+    try:
+        token = setup(workdir)
+
+        import jwt
+        from sqlmodel import Session
+        from app.db.database import User
+        from app.dependencies import decode_access_token, get_current_user, get_engine
+        from app.internal.auth import hash_refresh_token, verify_password
+        from app.settings import get_settings
+
+        settings = get_settings()
+        results = [("PyJWT decode", measure(
+            lambda: jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm]), args.iterations
+        ))]
+        try:
+            from jose import jwt as jose_jwt
+        except ImportError:
+            pass
+        else:
+            results.append(("python-jose decode", measure(
+                lambda: jose_jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm]), args.iterations
+            )))
+        results.append(("decode_access_token", measure(lambda: decode_access_token(token), args.iterations)))
+        with Session(get_engine()) as session:
+            results.append(("get_current_user", measure(lambda: get_current_user(session, token), args.iterations)))
+            pass_hash = session.get(User, 1).USER_passHash
+        results.append(("refresh token hash", measure(lambda: hash_refresh_token(token), args.iterations)))
+        results.append(("bcrypt verify (login)", measure(lambda: verify_password("bench", pass_hash), args.bcrypt_iterations)))
+
+        print(f"{'operation':<24} {'us/call':>10} {'calls/s':>10}")
+        for name, micros in results:
+            print(f"{name:<24} {micros:>10.1f} {1e6 / micros:>10.0f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
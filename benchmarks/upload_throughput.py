@@ -0,0 +1,110 @@
+"""
+Measure the throughput of file uploads through POST /files/.
+
+Runs the application in-process against a temporary SQLite database and
+deploy directory, and uploads files of several sizes at several
+concurrency levels. The number of worker threads is kept at THREADPOOL_SIZE,
+so a blocking upload path shows up as a throughput plateau.
+
+Usage:
+    python benchmarks/upload_throughput.py [--sizes 1,16,64] [--concurrency 1,4,16]
+        [--requests 16] [--chunk-size 1048576]
+
+Sizes are in MiB.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup(workdir, chunk_size):
+    """
+    Point the application at a temporary database and deploy directory.
+
+    Args:
+        workdir (str): The temporary directory.
+        chunk_size (int): The UPLOAD_CHUNK_SIZE to use.
+
+    Returns:
+        tuple[FastAPI, dict]: The application and the headers of an admin user.
+    """
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["DEPLOY_DIRECTORY"] = os.path.join(workdir, "deploy")
+    os.environ["UPLOAD_CHUNK_SIZE"] = str(chunk_size)
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.makedirs(os.environ["DEPLOY_DIRECTORY"])
+    sys.path.insert(0, ROOT)
+
+    from sqlmodel import Session
+    from app.main import app
+    from app.db.database import User, create_db
+    from app.dependencies import get_engine
+    from app.internal.auth import create_access_token
+    from app.internal.logger import logger
+
+    # keep the access log of the repository out of the measurement
+    logger.disabled = True
+    create_db(get_engine())
+    with Session(get_engine()) as session:
+        session.add(User(USER_username="bench", USER_passHash="-", USER_type=0, USER_isActive=True))
+        session.commit()
+    return app, {"Authorization": f"Bearer {create_access_token({'username': 'bench'})}"}
+
+
+async def run(app, headers, size, concurrency, requests):
+    """
+    Upload `requests` files of `size` bytes, `concurrency` at a time.
+
+    Returns:
+        float: The elapsed time in seconds.
+    """
+    import anyio.to_thread
+    import httpx
+    from app.settings import get_settings
+
+    anyio.to_thread.current_default_thread_limiter().total_tokens = get_settings().threadpool_size
+    payload = os.urandom(size)
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def upload(index):
+            async with semaphore:
+                response = await client.post(
+                    "/files/", headers=headers, files={"file": (f"bench-{size}-{concurrency}-{index}.bin", payload)}
+                )
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(upload(index) for index in range(requests)))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,16,64")
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="itam-upload-bench-")
+    try:
+        app, headers = setup(workdir, args.chunk_size)
+        print(f"{'size':>8} {'concurrency':>12} {'seconds':>9} {'MiB/s':>9} {'req/s':>8}")
+        for size_mib in (int(size) for size in args.sizes.split(",")):
+            for concurrency in (int(level) for level in args.concurrency.split(",")):
+                elapsed = asyncio.run(run(app, headers, size_mib * 1024 * 1024, concurrency, args.requests))
+                print(f"{size_mib:>6}MB {concurrency:>12} {elapsed:>9.2f} "
+                      f"{size_mib * args.requests / elapsed:>9.1f} {args.requests / elapsed:>8.1f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
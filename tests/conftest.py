@@ -0,0 +1,6 @@
+import os
+
+# the app reads its settings once, on first use: tests run without a .env
+os.environ.setdefault("SECRET_KEY", "test" * 8)
+os.environ.setdefault("AUDIT_LOG_FILE", "")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
@@ -0,0 +1,71 @@
+"""
+Package downloads of device agents, in process on a SQLite file.
+"""
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+from app.db.database import User, create_db
+from app.dependencies import get_engine
+from app.internal.auth import create_access_token
+from app.main import app
+from app.settings import get_settings, set_settings
+import pytest
+
+BUILD = b"installer build " * 1024
+
+
+@pytest.fixture
+def client(tmp_path):
+    set_settings(get_settings().model_copy(update={
+        "database_url": f"sqlite:///{tmp_path / 'itam.db'}",
+        "deploy_directory": str(tmp_path / "deploy"),
+        "audit_log_file": "",
+    }))
+    try:
+        create_db(get_engine())
+        with Session(get_engine()) as session:
+            session.add(User(USER_username="admin", USER_passHash="-", USER_type=0, USER_isActive=True))
+            session.commit()
+        client = TestClient(app)
+        client.headers["Authorization"] = "Bearer " + create_access_token({"username": "admin"})
+        yield client
+    finally:
+        get_engine().dispose()
+        set_settings(None)
+
+
+@pytest.fixture
+def fleet(client):
+    """
+    Device 1 in group 1, which has a package with one version; device 2 in group 2, which has none.
+    """
+    groups = [client.post("/devicegroups/", json={"DG_libelle": name}).json()["DG_id"] for name in ("site", "other")]
+    devices = [
+        client.post("/devices/", json={"DEV_name": f"pc{group}", "DEV_os": "win", "DG_id": group}).json()["DEV_id"]
+        for group in groups
+    ]
+    package = client.post("/packages/", json={
+        "PACK_name": "agent.msi", "PACK_type": "msi", "PACK_os_supported": "win", "DG_id": groups[0],
+    }).json()["PACK_id"]
+    assert client.post(f"/packages/{package}/versions", files={"file": ("agent.msi", BUILD)}).status_code == 200
+    tokens = [client.post(f"/devices/{device}/token").json()["token"] for device in devices]
+    agents = [{"X-Device-Id": str(device), "X-Device-Token": token} for device, token in zip(devices, tokens)]
+    return {"groups": groups, "package": package, "agents": agents}
+
+
+def test_device_downloads_its_package(client, fleet):
+    response = client.get(f"/agents/packages/{fleet['package']}", headers=fleet["agents"][0])
+    assert response.status_code == 200
+    assert response.content == BUILD
+
+
+def test_device_cannot_download_package_of_another_group(client, fleet):
+    response = client.get(f"/agents/packages/{fleet['package']}", headers=fleet["agents"][1])
+    assert response.status_code == 404
+    assert response.content != BUILD
+
+
+def test_device_waits_for_its_deployment_wave(client, fleet):
+    assert client.post("/deployments/", json={"DG_id": fleet["groups"][0]}).status_code == 200
+    # the scheduler is not running: the device is still waiting for its wave
+    response = client.get(f"/agents/packages/{fleet['package']}", headers=fleet["agents"][0])
+    assert response.status_code == 409
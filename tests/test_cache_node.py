@@ -0,0 +1,170 @@
+"""
+A primary and a cache node, each in its own uvicorn process, as deployed.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+from sqlmodel import Session, SQLModel, create_engine
+from app.db.database import User
+from app.internal.auth import get_password_hash
+from app.internal.cache_node import BlobCache
+import hashlib
+import io
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTENT = b"agent installer " * 4096
+TOOL = b"device tool " * 4096
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start(env: dict, log_path):
+    """
+    Start the app in a uvicorn process and wait until it answers.
+
+    Returns:
+        tuple[subprocess.Popen, str]: The process and its base URL.
+    """
+    port = free_port()
+    log = open(log_path, "wb")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT, env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited, see {log_path}")
+        try:
+            httpx.get(url + "/docs", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{url} did not start, see {log_path}")
+
+
+@pytest.fixture(scope="module")
+def nodes(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("nodes")
+    database_url = f"sqlite:///{tmp / 'primary.db'}"
+    engine = create_engine(database_url)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(USER_username="admin", USER_passHash=get_password_hash("secret"), USER_type=0, USER_isActive=True))
+        session.commit()
+    engine.dispose()
+
+    common = {"SECRET_KEY": "k" * 32, "AUDIT_LOG_FILE": "", "DATABASE_URL": database_url}
+    primary, primary_url = start({**common, "DEPLOY_DIRECTORY": str(tmp / "deploy")}, tmp / "primary.log")
+    try:
+        cache, cache_url = start({
+            **common,
+            "NODE_MODE": "cache",
+            "UPSTREAM_URL": primary_url,
+            "CACHE_DIRECTORY": str(tmp / "cache"),
+        }, tmp / "cache.log")
+    except Exception:
+        primary.terminate()
+        raise
+    try:
+        token = httpx.post(primary_url + "/auth/login", data={"username": "admin", "password": "secret"}).json()["access_token"]
+        yield {"primary": primary_url, "cache": cache_url, "headers": {"Authorization": f"Bearer {token}"}, "tmp": tmp}
+    finally:
+        for process in (cache, primary):
+            process.terminate()
+            process.wait(10)
+
+
+@pytest.fixture(scope="module")
+def fleet(nodes):
+    primary, headers = nodes["primary"], nodes["headers"]
+    group = httpx.post(primary + "/devicegroups/", headers=headers, json={"DG_libelle": "site"}).json()["DG_id"]
+    device = httpx.post(primary + "/devices/", headers=headers, json={"DEV_name": "pc", "DEV_os": "win", "DG_id": group}).json()["DEV_id"]
+    for name in ("agent.msi", "missing.msi"):
+        response = httpx.post(primary + "/packages/", headers=headers, json={
+            "PACK_name": name, "PACK_type": "msi", "PACK_os_supported": "win", "DG_id": group,
+        })
+        assert response.status_code == 200, response.text
+    response = httpx.post(primary + "/packages/", headers=headers, json={
+        "PACK_name": "tool.msi", "PACK_type": "msi", "PACK_os_supported": "win", "DEV_id": device,
+    })
+    assert response.status_code == 200, response.text
+    # missing.msi is never uploaded
+    for name, content in (("agent.msi", CONTENT), ("tool.msi", TOOL)):
+        response = httpx.post(primary + "/files/", headers=headers, files={"file": (name, content)})
+        assert response.status_code == 200, response.text
+    return {"group": group, "device": device}
+
+
+def test_manifest_skips_files_never_uploaded(nodes, fleet):
+    response = httpx.get(f"{nodes['primary']}/devicegroups/{fleet['group']}/manifest", headers=nodes["headers"])
+    assert response.status_code == 200, response.text
+    # the group's own package and the package of its device, without missing.msi
+    assert sorted(response.json()["files"], key=lambda entry: entry["name"]) == [
+        {"name": "agent.msi", "size": len(CONTENT), "sha256": hashlib.sha256(CONTENT).hexdigest()},
+        {"name": "tool.msi", "size": len(TOOL), "sha256": hashlib.sha256(TOOL).hexdigest()},
+    ]
+
+
+def test_cache_node_serves_bundle_from_cache(nodes, fleet):
+    digest = hashlib.sha256(TOOL).hexdigest()
+    for _ in range(2):
+        response = httpx.get(f"{nodes['cache']}/devices/{fleet['device']}/deploy", headers=nodes["headers"])
+        assert response.status_code == 200, response.text
+        with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+            assert archive.namelist() == ["tool.msi"]
+            assert archive.read("tool.msi") == TOOL
+    assert os.path.getsize(nodes["tmp"] / "cache" / digest[:2] / digest) == len(TOOL)
+
+
+def test_cache_node_revalidates_changed_file(nodes, fleet):
+    primary, cache, headers = nodes["primary"], nodes["cache"], nodes["headers"]
+    assert httpx.get(cache + "/files/agent.msi", headers=headers).content == CONTENT
+    assert httpx.delete(primary + "/files/agent.msi/delete/", headers=headers).status_code == 200
+    changed = CONTENT + b"patched"
+    assert httpx.post(primary + "/files/", headers=headers, files={"file": ("agent.msi", changed)}).status_code == 200
+    response = httpx.get(cache + "/files/agent.msi", headers=headers)
+    assert response.content == changed
+    assert response.headers["etag"] == f'"{hashlib.sha256(changed).hexdigest()}"'
+
+
+def test_cache_node_refuses_bad_credentials(nodes, fleet):
+    response = httpx.get(f"{nodes['cache']}/devices/{fleet['device']}/deploy", headers={"Authorization": "Bearer nope"})
+    assert response.status_code == 401
+
+
+def test_single_flight_serialises_late_callers():
+    cache = BlobCache()
+    inside = []
+    overlap = []
+
+    def fetch():
+        with cache.single_flight("blob"):
+            inside.append(1)
+            overlap.append(len(inside))
+            time.sleep(0.05)
+            inside.pop()
+
+    threads = []
+    for _ in range(3):
+        threads.append(threading.Thread(target=fetch))
+        threads[-1].start()
+        time.sleep(0.03)
+    for thread in threads:
+        thread.join()
+    assert overlap == [1, 1, 1]
+    assert cache.fetch_locks == {}
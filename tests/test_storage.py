@@ -0,0 +1,86 @@
+"""
+The S3 storage backend against a moto bucket, and the local one in a temporary directory.
+"""
+from app.internal.storage import LocalStorage, S3Storage, Storage
+from app.settings import get_settings
+import hashlib
+import io
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+# above the 5 MiB part size, so it is sent as a multipart upload
+LARGE = b"0123456789abcdef" * (384 * 1024)
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        settings = get_settings().model_copy(update={
+            "storage_backend": "s3",
+            "s3_bucket": "deploy",
+            "s3_prefix": "files/",
+            "s3_region": "us-east-1",
+            "s3_access_key": "test",
+            "s3_secret_key": "test",
+            "storage_presigned_downloads": True,
+        })
+        storage = S3Storage(settings)
+        storage.client.create_bucket(Bucket="deploy")
+        yield storage
+
+
+@pytest.fixture(params=["local", "s3"])
+def storage(request, tmp_path):
+    if request.param == "local":
+        return LocalStorage(str(tmp_path))
+    return request.getfixturevalue("s3")
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_round_trip(storage):
+    assert storage.save("agent.msi", io.BytesIO(LARGE)) == hashlib.sha256(LARGE).hexdigest()
+    assert storage.names() == ["agent.msi"]
+    assert storage.exists("agent.msi")
+    assert storage.size("agent.msi") == len(LARGE)
+    assert storage.digest("agent.msi") == hashlib.sha256(LARGE).hexdigest()
+    with storage.open("agent.msi") as file:
+        assert file.read() == LARGE
+    assert storage.delete("agent.msi")
+    assert not storage.exists("agent.msi")
+    assert not storage.delete("agent.msi")
+    assert storage.names() == []
+
+
+def test_missing_file(storage):
+    with pytest.raises(FileNotFoundError):
+        storage.size("missing.msi")
+    with pytest.raises(FileNotFoundError):
+        storage.open("missing.msi")
+
+
+def test_aborted_write_is_not_visible(storage):
+    writer = storage.writer("agent.msi")
+    writer.write(b"partial")
+    writer.abort()
+    assert not storage.exists("agent.msi")
+    assert storage.names() == []
+
+
+def test_s3_hashes_objects_uploaded_by_other_tools(s3):
+    s3.client.put_object(Bucket="deploy", Key="files/tool.msi", Body=b"tool")
+    assert s3.digest("tool.msi") == hashlib.sha256(b"tool").hexdigest()
+    # kept in the object metadata for the next reads
+    head = s3.client.head_object(Bucket="deploy", Key="files/tool.msi")
+    assert head["Metadata"]["sha256"] == hashlib.sha256(b"tool").hexdigest()
+
+
+def test_s3_presigned_url(s3):
+    s3.save("agent.msi", io.BytesIO(b"agent"))
+    url = s3.url("agent.msi")
+    assert "files/agent.msi" in url and "Signature" in url